@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+################################################################################
+# bench_gravity.py
+#
+# Benchmarks for the time-critical methods of gravity.py. Every benchmark is
+# timed for each body and input size, and the results are written as JSON so
+# that runs from different commits can be compared.
+#
+# Usage:
+#   python bench_gravity.py [--sizes N ...] [--bodies NAME ...]
+#                           [--only TEXT] [--repeat N] [--output FILE]
+#
+# A size of 1 is timed with scalar inputs. Benchmarks that are too slow for
+# the largest inputs have a size limit; use --no-limits to time them anyway.
+################################################################################
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import timeit
+import warnings
+
+import numpy as np
+
+import gravity
+
+# Defaults
+SIZES = (1, 10**3, 10**6, 10**7)
+BODIES = ('MOON', 'URANUS', 'SATURN', 'PLUTO_CHARON')   # 0, 2, 4 and 5 J terms
+REPEAT = 3
+MIN_TIME = 0.2
+
+################################################################################
+# Input generation
+################################################################################
+
+def _radii(body, size, rng):
+    """Semimajor axes between 1.5 and 2.5 body radii; a scalar for size 1."""
+
+    if size == 1:
+        return 2. * body.rp
+
+    return body.rp * (1.5 + rng.random(size))
+
+def _elements(body, size, rng):
+    """A tuple of six orbital elements of low eccentricity and inclination."""
+
+    if size == 1:
+        return (2. * body.rp, 0.005, 0.002, 1., 2., 3.)
+
+    return (body.rp * (1.5 + rng.random(size)),
+            0.01 * rng.random(size),
+            0.005 * rng.random(size),
+            gravity.TWOPI * rng.random(size),
+            gravity.TWOPI * rng.random(size),
+            gravity.TWOPI * rng.random(size))
+
+################################################################################
+# Benchmarks. Each function receives a body, a size and a random generator and
+# returns the function to be timed.
+################################################################################
+
+def _frequency(name):
+    def setup(body, size, rng):
+        method = getattr(body, name)
+        a = _radii(body, size, rng)
+        return lambda: method(a)
+    return setup
+
+def _combo(name, factors):
+    def setup(body, size, rng):
+        method = getattr(body, name)
+        a = _radii(body, size, rng)
+        return lambda: method(a, factors)
+    return setup
+
+def _solve_a(body, size, rng):
+    freq = body.omega(_radii(body, size, rng))
+    return lambda: body.solve_a(freq, (1,0,0))
+
+def _ilr_pattern(body, size, rng):
+    n = body.omega(_radii(body, size, rng))
+    return lambda: body.ilr_pattern(n, 2)
+
+def _olr_pattern(body, size, rng):
+    n = body.omega(_radii(body, size, rng))
+    return lambda: body.olr_pattern(n, 2)
+
+def _resonance_catalog(body, size, rng):
+    n = body.omega(3. * body.rp)
+    m = np.arange(1, size + 1)
+    return lambda: body.resonance_catalog(n, m)
+
+def _to_state(name):
+    def setup(body, size, rng):
+        method = getattr(body, name)
+        elements = _elements(body, size, rng)
+        return lambda: method(elements)
+    return setup
+
+def _from_state(name, converter):
+    def setup(body, size, rng):
+        method = getattr(body, name)
+        (pos, vel) = getattr(body, converter)(_elements(body, size, rng))
+        return lambda: method(pos, vel)
+    return setup
+
+# Tuples (name, setup function, largest size or None)
+BENCHMARKS = [
+    ('omega',                 _frequency('omega'),             None),
+    ('kappa',                 _frequency('kappa'),             None),
+    ('nu',                    _frequency('nu'),                None),
+    ('frequencies',           _frequency('frequencies'),       None),
+    ('combo[1,0,0]',          _combo('combo', (1,0,0)),        None),
+    ('combo[3,-2,0]',         _combo('combo', (3,-2,0)),       None),
+    ('combo[1,-1,0]',         _combo('combo', (1,-1,0)),       None),
+    ('combo[2,-1,-1]',        _combo('combo', (2,-1,-1)),      None),
+    ('dcombo_da[1,0,0]',      _combo('dcombo_da', (1,0,0)),    None),
+    ('dcombo_da[1,-1,0]',     _combo('dcombo_da', (1,-1,0)),   None),
+    ('dcombo_da[2,-1,-1]',    _combo('dcombo_da', (2,-1,-1)),  None),
+    ('solve_a',               _solve_a,                        None),
+    ('ilr_pattern',           _ilr_pattern,                    None),
+    ('olr_pattern',           _olr_pattern,                    None),
+    ('resonance_catalog',     _resonance_catalog,              10**5),
+    ('state_from_osc',        _to_state('state_from_osc'),     None),
+    ('state_from_geom',       _to_state('state_from_geom'),    None),
+    ('osc_from_state',        _from_state('osc_from_state',
+                                          'state_from_osc'),   None),
+    ('geom_from_state',       _from_state('geom_from_state',
+                                          'state_from_geom'),  10**6),
+]
+
+################################################################################
+# Timing
+################################################################################
+
+def time_function(function, repeat=REPEAT, min_time=MIN_TIME):
+    """Return the best time per call in seconds. The number of calls per
+    measurement is doubled until a measurement lasts at least min_time."""
+
+    timer = timeit.Timer(function)
+
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    times = [elapsed] + timer.repeat(repeat - 1, number)
+    return min(times) / number
+
+def run_benchmarks(sizes=SIZES, bodies=BODIES, only=None, repeat=REPEAT,
+                   min_time=MIN_TIME, limits=True, log=None):
+    """Run the benchmarks and return a list of result dictionaries.
+
+    Input:
+        sizes       input sizes to time; 1 means scalar inputs.
+        bodies      names of the bodies in gravity.LOOKUP.
+        only        if given, only benchmarks whose name contains this text.
+        repeat      number of measurements; the best one is reported.
+        min_time    minimum duration of each measurement in seconds.
+        limits      False to ignore the size limits of slow benchmarks.
+        log         optional file to receive one line of progress per result.
+
+    Return:         a list of dictionaries with keys "benchmark", "body",
+                    "jterms", "size", "seconds" and "per_element". Skipped
+                    combinations have seconds equal to None.
+    """
+
+    results = []
+    for (name, setup, limit) in BENCHMARKS:
+        if only and only not in name:
+            continue
+
+        for body_name in bodies:
+            body = gravity.LOOKUP[body_name]
+            for size in sizes:
+                result = {'benchmark': name, 'body': body_name,
+                          'jterms': len(body.jn), 'size': size,
+                          'seconds': None, 'per_element': None}
+
+                if not limits or limit is None or size <= limit:
+                    rng = np.random.default_rng(size)
+                    function = setup(body, size, rng)
+                    seconds = time_function(function, repeat, min_time)
+                    result['seconds'] = seconds
+                    result['per_element'] = seconds / size
+                    del function
+
+                results.append(result)
+                if log is not None:
+                    if result['seconds'] is None:
+                        timing = 'skipped'
+                    else:
+                        timing = '%.3e s' % result['seconds']
+                    print('%-20s %-14s %9d  %s' % (name, body_name, size,
+                                                   timing), file=log)
+
+    return results
+
+def _metadata():
+    """Information identifying the environment and the code under test."""
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.STDOUT)
+        commit = commit.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'date': datetime.datetime.now().isoformat(),
+            'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor()}
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmarks for gravity.py')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES),
+                        help='input sizes; 1 means scalar inputs')
+    parser.add_argument('--bodies', nargs='+', default=list(BODIES),
+                        help='names of bodies in gravity.LOOKUP')
+    parser.add_argument('--only', default=None,
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help='number of measurements per result')
+    parser.add_argument('--min-time', type=float, default=MIN_TIME,
+                        help='minimum duration of a measurement in seconds')
+    parser.add_argument('--no-limits', action='store_true',
+                        help='time slow benchmarks at every size')
+    parser.add_argument('--output', default=None,
+                        help='JSON output file; default is standard output')
+    args = parser.parse_args(argv)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        results = run_benchmarks(args.sizes, args.bodies, args.only,
+                                 args.repeat, args.min_time,
+                                 limits=not args.no_limits, log=sys.stderr)
+
+    report = {'metadata': _metadata(), 'results': results}
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
+
+################################################################################
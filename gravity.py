@@ -31,23 +31,1051 @@
 #     kappa and nu. Formulas are adapted from from Renner & Sicardy, Use of the
 #     Geometric Elements in Numerical Simulations, Cel. Mech. and  Dyn. Astron.
 #     94, 237-248 (2006). See Eqs. 14-16.
+#
+# Revised October 2026
+#   - Added frequencies() to evaluate omega, kappa, nu and their radial
+#     derivatives in one shared pass.
+#   - Added class FrequencyTable for fast, cancellation-safe interpolation of
+#     frequencies over a range of semimajor axes.
+#   - solve_a() now iterates only the unconverged elements; added tol and iters
+#     options.
+#   - combo() and solve_a() accept array-valued factors. Added
+#     resonance_catalog() to find many resonances in a single solve_a() call.
+#   - geom_from_state() iterates only the unfinished elements, has an iteration
+#     limit, and can return a status array instead of issuing warnings.
+#   - The state and element conversions accept an out argument to write into
+#     preallocated arrays, and release their temporaries early.
+#   - state_from_osc() refines any element not converged by its fixed Kepler
+#     solution, so it now handles all e < 1; added tol and max_iters options.
+#   - Added convert_chunks() and convert_npy() to convert arrays of states or
+#     elements in bounded memory, including memory-mapped .npy files.
+#   - Added convert_parallel() to divide a conversion among worker processes
+#     that share the input and output arrays through shared memory.
+#   - Added set_threads() to evaluate the frequency methods over large arrays
+#     with a pool of threads.
+#   - The body constants and LOOKUP entries are now built on first access.
+#     Unit tests moved to test_gravity.py.
+#   - Gravity objects are immutable, slotted and hashable; added with_gm() and
+#     with_jn().
+#   - Added bench_gravity.py to time the main methods across bodies and input
+#     sizes, with results written as JSON.
+#   - Added class SolverDiagnostics and diagnostics hooks to record iteration
+#     counts, residuals, failures and timing of solve_a() and geom_from_state().
+#   - combo() keeps its cancellation-safe form for nonzero e and sin(i), which
+#     can now be arrays in all the frequency methods.
+#   - solve_a() has a warm_start option that takes its initial guess from a
+#     cached inverse table, and stops at the machine precision.
+#   - Added class GravityEnsemble to evaluate many gravity models at once.
+#   - Added uncertainty_bands() to propagate the covariance of gm and the
+#     J-values into percentile bands, sampled in batches with streaming
+#     histograms.
+#   - Added ephemeris() to generate state vectors over a grid of times and
+#     particles in chunks, with the rates evaluated once per particle.
+#   - Added class SinglePrecision to evaluate the frequencies and state vectors
+#     in float32, with optional error bounds.
+#   - state_from_osc() and state_from_geom() can return the Jacobian of the
+#     state with respect to the elements in the same pass.
+#   - Added fit_geom() to fit geometric elements to the positions or radii of
+#     many targets at once by batched Levenberg-Marquardt iteration.
+#   - Added class OrbitArray to hold elements or states in one (..., 6) buffer
+#     with zero-copy field views; the four conversions accept and return it.
+#   - Added set_cache() and class FrequencyCache to memoize combo(), solve_a(),
+#     ilr_pattern() and olr_pattern() in a bounded LRU cache with statistics.
+#   - Added a command-line interface, python -m gravity, to convert files of
+#     states and elements, solve for semimajor axes and write resonance
+#     catalogs.
 ################################################################################
 
 from __future__ import print_function
 
+import collections
+import functools
+import hashlib
+import inspect
+import itertools
+import mmap
+import numbers
 import numpy as np
-import unittest
+import sys
+import threading
+import time
 import warnings
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
 # Useful unit conversions
 DPR = 180. / np.pi      # Converts radians to degrees
 DPD = DPR * 86400.      # Converts radians per second to degrees per day 
 TWOPI = 2. * np.pi
+EPSILON = np.finfo('float').eps
+
+# Resonance types known to Gravity.resonance_catalog()
+RESONANCE_KINDS = ('ILR', 'OLR', 'IVR', 'OVR', 'ICR', 'OCR')
+
+RESONANCE_DTYPE = np.dtype([('kind', 'U3'), ('perturber', 'int'),
+                            ('m', 'int'), ('p', 'int'),
+                            ('pattern', 'float'), ('a', 'float')])
+
+# Status codes returned by Gravity.geom_from_state()
+STATUS_CONVERGED = 0
+STATUS_DIVERGED  = 1
+STATUS_MAX_ITERS = 2
+
+# Conversions supported by Gravity.convert_chunks() and Gravity.convert_npy()
+CONVERSIONS = ('state_from_osc', 'state_from_geom',
+               'osc_from_state', 'geom_from_state')
+
+# Kinds of OrbitArray: osculating or geometric elements, or state vectors
+ORBIT_KINDS = ('osc', 'geom', 'state')
+
+# Default number of rows converted at a time
+CHUNK_SIZE = 65536
+
+# Default minimum number of elements per chunk in threaded evaluation
+THREAD_MIN_SIZE = 16384
+
+# Default number of results held by a FrequencyCache
+CACHE_SIZE = 1024
+
+# Inverse tables for warm starts in Gravity.solve_a() span semimajor axes from
+# the body radius outward by this factor, with this many samples
+INVERSE_TABLE_RANGE = 1.e4
+INVERSE_TABLE_SIZE = 4096
+
+################################################################################
+# Threaded evaluation
+################################################################################
+
+_THREAD_POOL = {'workers': 1, 'min_size': THREAD_MIN_SIZE, 'executor': None}
+_THREAD_STATE = threading.local()
+
+def set_threads(workers=1, min_size=THREAD_MIN_SIZE):
+    """Enable or disable threaded evaluation of the frequency methods.
+
+    When enabled, the Gravity methods omega(), kappa(), nu(), their radial
+    derivatives, frequencies(), combo() and dcombo_da() divide a large array of
+    semimajor axes into chunks that are evaluated concurrently by a pool of
+    threads. NumPy releases the GIL inside its array operations, so this uses
+    multiple cores without the overhead of separate processes.
+
+    Input:
+        workers     number of threads; 1 to disable threaded evaluation.
+        min_size    minimum number of elements per chunk. Smaller arrays are
+                    evaluated in the calling thread.
+    """
+
+    if workers < 1 or min_size < 1:
+        raise ValueError('workers and min_size must be positive')
+
+    if _THREAD_POOL['executor'] is not None:
+        _THREAD_POOL['executor'].shutdown()
+
+    executor = None
+    if workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(workers)
+
+    _THREAD_POOL['workers'] = workers
+    _THREAD_POOL['min_size'] = min_size
+    _THREAD_POOL['executor'] = executor
+
+def _threaded(method):
+    """Decorator for a Gravity method with a semimajor axis as its first
+    argument. If threads are enabled via set_threads() and the array is large
+    enough, it is divided into chunks that are evaluated concurrently.
+
+    Any other array argument, including the members of a tuple or list of
+    factors, is divided along with the semimajor axis if it has the same
+    shape. Otherwise, the method is evaluated in the calling thread.
+    """
+
+    # Position of the factors among the arguments that follow the semimajor
+    # axis, or None if the method has none
+    names = list(inspect.signature(method).parameters)
+    position = names.index('factors') - 2 if 'factors' in names else None
+
+    @functools.wraps(method)
+    def wrapper(self, a, *args, **kwargs):
+
+        executor = _THREAD_POOL['executor']
+        size = np.size(a)
+        chunks = min(_THREAD_POOL['workers'], size // _THREAD_POOL['min_size'])
+
+        # Calls made from within a worker thread are never divided further
+        if (executor is None or chunks < 2 or
+            getattr(_THREAD_STATE, 'active', False)):
+            return method(self, a, *args, **kwargs)
+
+        # Factors given as a list are divided like a tuple; any other list is
+        # treated as an array
+        if position is not None:
+            if len(args) > position and isinstance(args[position], list):
+                args = (args[:position] + (tuple(args[position]),) +
+                        args[position + 1:])
+            elif isinstance(kwargs.get('factors'), list):
+                kwargs = dict(kwargs, factors=tuple(kwargs['factors']))
+
+        shape = np.shape(a)
+        if not all(_divisible(arg, shape)
+                   for arg in list(args) + list(kwargs.values())):
+            return method(self, a, *args, **kwargs)
+
+        bounds = np.linspace(0, size, chunks + 1).astype('int')
+        futures = []
+        for k in range(chunks):
+            chunk = slice(bounds[k], bounds[k+1])
+            futures.append(executor.submit(_run_chunk, method, self,
+                                _chunk(a, shape, chunk),
+                                [_chunk(arg, shape, chunk) for arg in args],
+                                dict((key, _chunk(arg, shape, chunk))
+                                     for (key, arg) in kwargs.items())))
+
+        results = [future.result() for future in futures]
+        counts = np.diff(bounds)
+
+        if isinstance(results[0], tuple):
+            return tuple(_join(parts, counts, shape) for parts in
+                         zip(*results))
+
+        return _join(results, counts, shape)
+
+    return wrapper
+
+def _divisible(arg, shape):
+    """True if a method argument can be divided into chunks with an array of
+    the given shape."""
+
+    if isinstance(arg, tuple):
+        return all(_divisible(item, shape) for item in arg)
+
+    return np.shape(arg) in ((), shape)
+
+def _chunk(arg, shape, chunk):
+    """One chunk of a method argument; scalars are returned unchanged."""
+
+    if isinstance(arg, tuple):
+        return tuple(_chunk(item, shape, chunk) for item in arg)
+
+    if np.shape(arg) == ():
+        return arg
+
+    return np.asarray(arg).ravel()[chunk]
+
+def _join(parts, counts, shape):
+    """Concatenate the results of the chunks and restore the shape."""
+
+    parts = [np.broadcast_to(part, (count,))
+             for (part, count) in zip(parts, counts)]
+    return np.concatenate(parts).reshape(shape)
+
+def _run_chunk(method, gravity, a, args, kwargs):
+    """Evaluate one chunk inside a worker thread."""
+
+    _THREAD_STATE.active = True
+    try:
+        return method(gravity, a, *args, **kwargs)
+    finally:
+        _THREAD_STATE.active = False
+
+################################################################################
+# Memoization
+################################################################################
+
+_MEMO = {'cache': None}
+_MEMO_STATE = threading.local()
+
+class FrequencyCache(object):
+    """A bounded, least-recently-used store of the results of the Gravity
+    methods combo(), solve_a(), ilr_pattern() and olr_pattern().
+
+    Results are keyed on the method, the Gravity object, which compares by
+    value, and a fingerprint of every argument. Array arguments are
+    fingerprinted by their dtype, shape and a hash of their contents, so equal
+    arrays hit the same entry without being kept alive by the cache. A call
+    with any other kind of argument is evaluated without the cache.
+
+    Attributes:
+        maxsize     the largest number of results held.
+        hits        the number of calls answered from the cache.
+        misses      the number of calls that were evaluated.
+        evictions   the number of results discarded to respect maxsize.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+
+        if maxsize < 1:
+            raise ValueError('maxsize must be positive')
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return ('FrequencyCache(maxsize=%d, size=%d, hits=%d, misses=%d)' %
+                (self.maxsize, len(self), self.hits, self.misses))
+
+    def info(self):
+        """Returns a dictionary of the hits, misses, evictions, current size,
+        maxsize and the fraction of calls answered from the cache."""
+
+        calls = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self),
+                'maxsize': self.maxsize,
+                'hit_rate': self.hits / calls if calls else 0.}
+
+    def clear(self, gravity=None):
+        """Discard the cached results, only those of the given Gravity object
+        if one is specified. The statistics are reset when all are cleared."""
+
+        with self._lock:
+            if gravity is None:
+                self._entries.clear()
+                self.hits = 0
+                self.misses = 0
+                self.evictions = 0
+            else:
+                for key in [key for key in self._entries if key[1] == gravity]:
+                    del self._entries[key]
+
+    def _lookup(self, key, function):
+        """Return the result for a key, calling function() to evaluate it on a
+        miss. The caller always receives its own copy of any array."""
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return _copy_result(self._entries[key])
+
+        result = function()
+
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = _copy_result(result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        return result
+
+def set_cache(maxsize=CACHE_SIZE):
+    """Enable or disable memoization of the Gravity methods combo(), solve_a(),
+    ilr_pattern() and olr_pattern().
+
+    When enabled, a call repeating the body and arguments of an earlier call
+    returns a copy of the earlier result. Calls to solve_a() with a
+    diagnostics object are always evaluated, as are the calls these methods
+    make to one another.
+
+    Input:
+        maxsize     the largest number of results held, or 0 to disable
+                    memoization.
+
+    Return:         the new FrequencyCache, which reports the statistics and
+                    can be cleared; None if memoization is disabled.
+    """
+
+    if maxsize < 0:
+        raise ValueError('maxsize must not be negative')
+
+    _MEMO['cache'] = FrequencyCache(maxsize) if maxsize else None
+    return _MEMO['cache']
+
+def _memoized(method):
+    """Decorator for a Gravity method whose results are held in the cache
+    enabled via set_cache()."""
+
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+
+        cache = _MEMO['cache']
+        if cache is None or getattr(_MEMO_STATE, 'active', False):
+            return method(self, *args, **kwargs)
+
+        # Calls made while evaluating this one are never cached
+        def evaluate():
+            _MEMO_STATE.active = True
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                _MEMO_STATE.active = False
+
+        # Bind the arguments so that a diagnostics object is found however it
+        # is passed, and so that equivalent calls share one key
+        try:
+            bound = signature.bind(self, *args, **kwargs)
+        except TypeError:
+            return method(self, *args, **kwargs)
+
+        bound.apply_defaults()
+        if bound.arguments.get('diagnostics') is not None:
+            return evaluate()
+
+        try:
+            key = (method.__name__, self,
+                   _fingerprint(tuple(bound.arguments.values())[1:]))
+        except _Uncacheable:
+            return evaluate()
+
+        return cache._lookup(key, evaluate)
+
+    return wrapper
+
+class _Uncacheable(Exception):
+    """Raised by _fingerprint() for an argument it cannot summarize by
+    value."""
+
+def _fingerprint(arg):
+    """A hashable summary of a method argument that compares equal for equal
+    values. Only None, booleans, strings, numbers, numeric arrays and tuples
+    of these are accepted; for anything else, such as an object whose array
+    form would hash its address, _Uncacheable is raised."""
+
+    if isinstance(arg, tuple):
+        return tuple(_fingerprint(item) for item in arg)
+
+    if arg is None or isinstance(arg, (bool, str)):
+        return arg
+
+    if not isinstance(arg, (numbers.Number, np.generic, np.ndarray)):
+        raise _Uncacheable(type(arg).__name__)
+
+    array = np.ascontiguousarray(arg)
+    if array.dtype.hasobject:
+        raise _Uncacheable('object array')
+
+    digest = hashlib.blake2b(array, digest_size=16).digest()
+    return (array.dtype.str, array.shape, digest)
+
+def _copy_result(result):
+    """A copy of a method result in which no array is shared."""
+
+    if isinstance(result, tuple):
+        return tuple(_copy_result(item) for item in result)
+
+    if isinstance(result, np.ndarray):
+        return result.copy()
+
+    return result
+
+################################################################################
+# Solver diagnostics
+################################################################################
+
+_DIAGNOSTICS_HOOKS = []
+
+def add_diagnostics_hook(function):
+    """Register a function to be called after every call to Gravity.solve_a(),
+    Gravity.geom_from_state() or Gravity.fit_geom(). It receives the call's
+    SolverDiagnostics object as its only argument."""
+
+    if function not in _DIAGNOSTICS_HOOKS:
+        _DIAGNOSTICS_HOOKS.append(function)
+
+def remove_diagnostics_hook(function):
+    """Remove a function registered by add_diagnostics_hook()."""
+
+    if function in _DIAGNOSTICS_HOOKS:
+        _DIAGNOSTICS_HOOKS.remove(function)
+
+class SolverDiagnostics(object):
+    """A record of the work done by one call to an iterative solver.
+
+    Pass an instance as the diagnostics argument of Gravity.solve_a(),
+    Gravity.geom_from_state() or Gravity.fit_geom() to have it filled in by
+    that call. Objects are also created automatically for every call while a
+    hook is registered via add_diagnostics_hook().
+
+    Attributes:
+        solver      name of the method that was called.
+        size        number of elements solved.
+        iterations  flattened array of the iterations applied to each element.
+        residuals   flattened array of the magnitude of each element's final
+                    correction to the semimajor axis (km).
+        status      flattened array of STATUS_CONVERGED, STATUS_DIVERGED or
+                    STATUS_MAX_ITERS for each element.
+        phases      dictionary of the wall time in seconds spent in each phase
+                    of the call.
+    """
+
+    def __init__(self):
+        self.solver = None
+        self.size = 0
+        self.iterations = None
+        self.residuals = None
+        self.status = None
+        self.phases = {}
+        self._clock = None
+
+    @property
+    def unconverged(self):
+        """The number of elements that did not converge."""
+
+        if self.status is None:
+            return 0
+
+        return int(np.sum(self.status != STATUS_CONVERGED))
+
+    def summary(self):
+        """Returns a dictionary summarizing the call: the solver, the number of
+        elements and of unconverged elements, the mean and maximum iteration
+        counts, the 50th, 90th and 99th percentiles and maximum of the
+        residuals, and the time spent in each phase."""
+
+        result = {'solver': self.solver, 'size': self.size,
+                  'unconverged': self.unconverged,
+                  'phases': dict(self.phases),
+                  'seconds': sum(self.phases.values())}
+
+        if self.size:
+            result['mean_iterations'] = float(np.mean(self.iterations))
+            result['max_iterations'] = int(np.max(self.iterations))
+
+            residuals = self.residuals[~np.isnan(self.residuals)]
+            if residuals.size:
+                (p50, p90, p99) = np.percentile(residuals, [50, 90, 99])
+                result['residuals'] = {'p50': p50, 'p90': p90, 'p99': p99,
+                                       'max': np.max(residuals)}
+
+        return result
+
+    def _start(self, solver, size):
+        self.solver = solver
+        self.size = size
+        self.phases = {}
+        self._clock = time.perf_counter()
+
+    def _mark(self, phase):
+        """Charge the time since the previous mark to the given phase."""
+
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.) + now - self._clock
+        self._clock = now
+
+    def _finish(self, iterations, residuals, status):
+        self.iterations = iterations
+        self.residuals = residuals
+        self.status = status
+        self._mark('finish')
+
+        for function in list(_DIAGNOSTICS_HOOKS):
+            function(self)
+
+    @staticmethod
+    def _begin(diagnostics, solver, size):
+        """Return the diagnostics object for a solver call, or None if no
+        diagnostics were requested and no hooks are registered."""
+
+        if diagnostics is None:
+            if not _DIAGNOSTICS_HOOKS:
+                return None
+            diagnostics = SolverDiagnostics()
+
+        diagnostics._start(solver, size)
+        return diagnostics
+
+################################################################################
+# Orbit arrays
+################################################################################
+
+class OrbitArray(object):
+    """A set of orbital elements or state vectors held in one float64 buffer of
+    shape (..., 6), the layout used by convert_chunks() and convert_npy().
+
+    The elements have columns (a, e, i, mean longitude, longitude of
+    pericenter, longitude of ascending node); the states have columns
+    (x, y, z, vx, vy, vz). The fields and slices are views of the buffer, so
+    an OrbitArray passes between the conversion methods without repacking.
+    A conversion given an OrbitArray returns one of the other kind, and one
+    given an OrbitArray as out writes its result into that buffer.
+
+    Attributes:
+        array       the buffer, an array of shape (..., 6). It can be a
+                    memory-mapped array.
+        kind        'osc' or 'geom' for elements; 'state' for state vectors.
+    """
+
+    _ELEMENTS = ('a', 'e', 'inc', 'mean_lon', 'long_peri', 'long_node')
+
+    def __init__(self, array, kind):
+        """Constructor for an OrbitArray.
+
+        Input:
+            array       array of shape (..., 6). A float64 array is used
+                        without copying; any other is converted.
+            kind        one of ORBIT_KINDS.
+        """
+
+        if kind not in ORBIT_KINDS:
+            raise ValueError('unknown orbit kind: ' + repr(kind))
+
+        if not (isinstance(array, np.ndarray) and array.dtype == np.float64):
+            array = np.asfarray(array)
+
+        if array.shape[-1:] != (6,):
+            raise ValueError('orbit array must have six columns')
+
+        self.array = array
+        self.kind = kind
+
+    @staticmethod
+    def empty(shape, kind):
+        """Return an uninitialized OrbitArray of the given shape and kind."""
+
+        shape = (shape,) if np.isscalar(shape) else tuple(shape)
+        return OrbitArray(np.empty(shape + (6,)), kind)
+
+    @staticmethod
+    def from_elements(elements, kind='osc'):
+        """Return an OrbitArray from a tuple of six orbital elements, scalars
+        or arrays that broadcast to a common shape."""
+
+        if kind == 'state':
+            raise ValueError('from_elements() requires an element kind')
+
+        elements = np.broadcast_arrays(*[np.asfarray(x) for x in elements])
+        return OrbitArray(np.stack(elements, axis=-1), kind)
+
+    @staticmethod
+    def from_state(pos, vel):
+        """Return an OrbitArray from position and velocity arrays of shape
+        (..., 3)."""
+
+        (pos, vel) = np.broadcast_arrays(np.asfarray(pos), np.asfarray(vel))
+        return OrbitArray(np.concatenate((pos, vel), axis=-1), 'state')
+
+    @staticmethod
+    def load(filename, kind, mmap_mode='r'):
+        """Return an OrbitArray backed by an array of shape (..., 6) in a .npy
+        file, memory-mapped unless mmap_mode is None."""
+
+        return OrbitArray(np.load(filename, mmap_mode=mmap_mode), kind)
+
+    @staticmethod
+    def create(filename, shape, kind):
+        """Return an uninitialized OrbitArray backed by a new memory-mapped .npy
+        file. It can serve as the out argument of a conversion."""
+
+        shape = (shape,) if np.isscalar(shape) else tuple(shape)
+        array = np.lib.format.open_memmap(filename, mode='w+',
+                                          dtype='float64', shape=shape + (6,))
+        return OrbitArray(array, kind)
+
+    def save(self, filename):
+        """Write the buffer to a .npy file. The kind is not recorded; it is
+        given again to load()."""
+
+        np.save(filename, self.array)
+
+    def copy(self):
+        return OrbitArray(self.array.copy(), self.kind)
+
+    @property
+    def shape(self):
+        """The shape of the orbits, excluding the final axis of six values."""
+
+        return self.array.shape[:-1]
+
+    def __len__(self):
+        if self.array.ndim < 2:
+            raise TypeError('len() of unsized OrbitArray')
+
+        return len(self.array)
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+
+        return OrbitArray(self.array[index + (slice(None),)], self.kind)
+
+    def __setitem__(self, index, value):
+        if not isinstance(index, tuple):
+            index = (index,)
+
+        if isinstance(value, OrbitArray):
+            self._require(value.kind)
+            value = value.array
 
-class Gravity():
-    """A class describing the gravity field of a planet."""
+        self.array[index + (slice(None),)] = value
 
-    def __init__(self, gm, jlist=[], radius=1.):
+    def __array__(self, dtype=None):
+        return self.array if dtype is None else self.array.astype(dtype)
+
+    def __repr__(self):
+        return 'OrbitArray(shape=%s, kind=%r)' % (str(self.shape), self.kind)
+
+    ####################################
+    # Field views
+    ####################################
+
+    def _require(self, kind):
+        """Raise a ValueError unless this OrbitArray has the given kind."""
+
+        if self.kind != kind:
+            raise ValueError('%s orbits required, not %s' % (kind, self.kind))
+
+    def _column(self, k):
+        if self.kind == 'state':
+            raise AttributeError('state orbits have no element ' +
+                                 self._ELEMENTS[k])
+
+        return self.array[...,k]
+
+    @property
+    def elements(self):
+        """The tuple of six element columns (a, e, inc, mean_lon, long_peri,
+        long_node), as views of the buffer."""
+
+        return tuple(self._column(k) for k in range(6))
+
+    a         = property(lambda self: self._column(0))
+    e         = property(lambda self: self._column(1))
+    inc       = property(lambda self: self._column(2))
+    mean_lon  = property(lambda self: self._column(3))
+    long_peri = property(lambda self: self._column(4))
+    long_node = property(lambda self: self._column(5))
+
+    @property
+    def pos(self):
+        """The positions of state orbits, a view of shape (..., 3)."""
+
+        if self.kind != 'state':
+            raise AttributeError('element orbits have no pos')
+
+        return self.array[...,:3]
+
+    @property
+    def vel(self):
+        """The velocities of state orbits, a view of shape (..., 3)."""
+
+        if self.kind != 'state':
+            raise AttributeError('element orbits have no vel')
+
+        return self.array[...,3:]
+
+    ####################################
+    # Conversion arguments
+    ####################################
+
+    @staticmethod
+    def _element_args(elements, out, kind):
+        """Internal method to unpack the elements and out arguments of a
+        conversion from elements of the given kind to states. Returns the
+        tuple (elements, out, orbits), where orbits is the OrbitArray to
+        receive the states, or None if neither argument is an OrbitArray."""
+
+        orbits = None
+        if isinstance(elements, OrbitArray):
+            elements._require(kind)
+            if out is None:
+                out = OrbitArray.empty(elements.shape, 'state')
+            elements = elements.elements
+
+        if isinstance(out, OrbitArray):
+            out._require('state')
+            orbits = out
+            out = (out.pos, out.vel)
+
+        return (elements, out, orbits)
+
+    @staticmethod
+    def _state_args(pos, vel, out, kind):
+        """Internal method to unpack the pos, vel and out arguments of a
+        conversion from states to elements of the given kind. Returns the
+        tuple (pos, vel, out, orbits), where orbits is the OrbitArray to
+        receive the elements, or None if no argument is an OrbitArray."""
+
+        orbits = None
+        if isinstance(pos, OrbitArray):
+            pos._require('state')
+            if vel is not None:
+                raise ValueError('vel must be omitted for state orbits')
+            if out is None:
+                out = OrbitArray.empty(pos.shape, kind)
+            (pos, vel) = (pos.pos, pos.vel)
+        elif vel is None:
+            raise ValueError('vel is required')
+
+        if isinstance(out, OrbitArray):
+            out._require(kind)
+            orbits = out
+            out = out.array
+
+        return (pos, vel, out, orbits)
+
+    @staticmethod
+    def _state_result(result, orbits):
+        """Internal method to replace the (pos, vel) at the start of a
+        conversion result by the OrbitArray that holds them."""
+
+        if orbits is None:
+            return result
+
+        if len(result) == 2:
+            return orbits
+
+        return (orbits,) + tuple(result[2:])
+
+################################################################################
+# Frequency kernels shared by Gravity, GravityEnsemble and SinglePrecision
+################################################################################
+
+# Coefficients of e^2 and sin(i)^2 in the second-order corrections to omega,
+# kappa and nu, in units of J2 (Rp/a)^2 sqrt(GM/a^3). From Renner & Sicardy
+# (2006), Eqs. 14-16.
+_EI_CORRECTIONS = {'omega': ( 3., -12.  ),
+                   'kappa': ( 0.,  -9.  ),
+                   'nu'   : ( 6., -12.75)}
+
+def _ei_coefficients(factors):
+    """Return the coefficients (ce, ci) of e^2 and sin(i)^2 in the correction
+    to a combination of omega, kappa and nu with the given factors."""
+
+    ce = 0.
+    ci = 0.
+    for (factor, name) in zip(factors, ('omega', 'kappa', 'nu')):
+        (coefft_e, coefft_i) = _EI_CORRECTIONS[name]
+        ce = ce + coefft_e * factor
+        ci = ci + coefft_i * factor
+
+    return (ce, ci)
+
+def _ei_term(j2, factors, e, sin_i):
+    """Return the dimensionless coefficient J2 (ce e^2 + ci sin(i)^2) of the
+    correction to a frequency combination."""
+
+    (ce, ci) = _ei_coefficients(factors)
+    return j2 * (ce * e**2 + ci * sin_i**2)
+
+def _ei_partials(j2, factors, e, sin_i):
+    """Return the partial derivatives of _ei_term() with respect to e and
+    sin(i)."""
+
+    (ce, ci) = _ei_coefficients(factors)
+    return (2. * j2 * ce * e, 2. * j2 * ci * sin_i)
+
+def _jseries(coefficients, ratio2):
+    """Evaluate the series coefficients[0] * ratio2 + coefficients[1] * ratio2^2
+    ... by Horner's rule. The coefficients have one row per power, so each can
+    be an array of the coefficients of many models."""
+
+    if not len(coefficients):
+        return 0. * ratio2
+
+    result = coefficients[-1]
+    for coefficient in coefficients[-2::-1]:
+        result = result * ratio2 + coefficient
+
+    return result * ratio2
+
+def _combo_safe(gm, r2, coefficients, a, factors):
+    """Return a frequency combination for a circular, equatorial orbit, with
+    factors that can be arrays. The values are summed as differences from
+    sqrt(GM/a^3), which is exact for any factors, and the second-order
+    reformulation of Gravity._combo_circular() is applied to the elements that
+    need it.
+
+    Input:
+        gm          GM of the body, or an array of GM values.
+        r2          square of the body radius, or an array.
+        coefficients  the series coefficients (omega_jn, kappa_jn, nu_jn), each
+                    with one row per power of (Rp/a)^2.
+        a           semimajor axis.
+        factors     coefficients on omega, kappa and nu.
+
+    Return:         (combination, sqrt(GM/a^3), (Rp/a)^2).
+    """
+
+    (f0, f1, f2) = factors
+
+    a2 = a * a
+    ratio2 = r2 / a2
+    gm_over_a3 = gm / (a * a2)
+    sqrt_gm_over_a3 = np.sqrt(gm_over_a3)
+
+    (omega2_jsum, kappa2_jsum, nu2_jsum) = [_jseries(c, ratio2)
+                                            for c in coefficients]
+
+    omega = np.sqrt(gm_over_a3 * (1. + omega2_jsum))
+    kappa = np.sqrt(gm_over_a3 * (1. + kappa2_jsum))
+    nu    = np.sqrt(gm_over_a3 * (1. + nu2_jsum))
+
+    omega_diff = gm_over_a3 * omega2_jsum / (omega + sqrt_gm_over_a3)
+    kappa_diff = gm_over_a3 * kappa2_jsum / (kappa + sqrt_gm_over_a3)
+    nu_diff    = gm_over_a3 * nu2_jsum    / (nu    + sqrt_gm_over_a3)
+
+    sum_factors = f0 + f1 + f2
+    sum_values = (sum_factors * sqrt_gm_over_a3 + f0 * omega_diff +
+                  f1 * kappa_diff + f2 * nu_diff)
+
+    second_order = (sum_factors == 0) & (f1 == f2)
+    if np.any(second_order):
+        sum_values = np.where(second_order,
+                              -f1 * ((nu_diff - omega_diff)
+                                  *  (nu_diff - kappa_diff)
+                                  /  (omega + kappa)), sum_values)
+
+    return (sum_values, sqrt_gm_over_a3, ratio2)
+
+def _solve_a_guess(gm, r2, first_jn, freq, factors, ei_term=0.):
+    """Return the initial guess of solve_a() from power laws in a. With array
+    factors, the law is selected element by element; with scalar factors,
+    only the one needed is evaluated. Where the guess is not positive, such as
+    for cancelling factors without J-terms, there is no solution and NaN is
+    returned.
+
+    Input:
+        gm          GM of the body, or an array of GM values.
+        r2          square of the body radius, or an array.
+        first_jn    the first series coefficients of omega, kappa and nu; zeros
+                    if there are no J-terms.
+        freq        the frequencies.
+        factors     coefficients on omega, kappa and nu.
+        ei_term     the coefficient returned by _ei_term(). The corrections for
+                    e and sin(i) have the same dependence on a as the
+                    first-order term below:
+                      freq(a) ~ J2 * [e and sin(i) terms] * sqrt(GM/a^3) *
+                                Rp^2 / a^2
+    """
+
+    (f0, f1, f2) = factors
+    (omega_j, kappa_j, nu_j) = first_jn
+    sum_factors = f0 + f1 + f2
+
+    # No first-order cancellation:
+    #   freq(a) ~ sum[factors] * sqrt(GM/a^3)
+    #
+    #   a^3 ~ GM * (sum[factors] / freq)^2
+
+    def no_cancellation():
+        return (gm * (sum_factors/freq)**2)**(1./3.)
+
+    # No second-order cancellation:
+    #   freq(a) ~ 1/2 * sum[factor*term] * sqrt(GM/a^3) * Rp^2 / a^2
+    #
+    #   a^7 ~ GM * (sum[factor*term]/2 / freq)^2 Rp^4
+
+    def first_order():
+        term = (f0 * omega_j + f1 * kappa_j + f2 * nu_j) / 2. + ei_term
+        return (gm * (term * r2 / freq)**2)**(1/7.)
+
+    # Second-order cancellation:
+    #   freq(a) ~ -1/8 * sum[factor*term^2] * sqrt(GM/a^3) * Rp^4 / a^4
+    #
+    #   a^11 ~ GM * (-sum[factor*term^2]/8 / freq)^2 Rp^8
+    #
+    # Any e and sin(i) terms fall off more slowly, so take the larger of the
+    # two estimates
+
+    def second_order():
+        term = (f0 * omega_j**2 + f1 * kappa_j**2 + f2 * nu_j**2) / (-8.)
+        a = (gm * (term * r2 * r2 / freq)**2)**(1/11.)
+        return np.maximum(a, (gm * (ei_term * r2 / freq)**2)**(1/7.))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if np.shape(sum_factors):
+            a = np.where(sum_factors != 0, no_cancellation(),
+                         np.where(f1 != f2, first_order(), second_order()))
+        elif sum_factors != 0:
+            a = no_cancellation()
+        elif f1 != f2:
+            a = first_order()
+        else:
+            a = second_order()
+
+        return np.where(a > 0., a, np.nan)
+
+def _solve_a_newton(a, freq, factors, e, sin_i, tol, evaluate):
+    """Refine the guesses of solve_a() by Newton's method, in place.
+
+    Each Newton step is only applied to the elements that have not yet
+    converged. An element is finished when its correction |da| is no larger
+    than tol * a or the machine precision, or when its correction stops
+    decreasing.
+
+    Input:
+        a           flattened array of initial guesses, updated in place.
+        freq        flattened array of frequencies.
+        factors     coefficients on omega, kappa and nu, each a scalar or a
+                    flattened array.
+        e, sin_i    scalars or flattened arrays.
+        tol         relative tolerance on a.
+        evaluate    function(active, a, factors, e, sin_i) returning the
+                    combination and its radial derivative for the elements
+                    selected by the index array active.
+
+    Return:         (counts, da, active), where counts is the number of
+                    iterations applied to each element, da is the magnitude
+                    of its final correction, and active indexes the elements
+                    that were not finished.
+    """
+
+    counts = np.zeros(a.size, dtype='int')
+    da_prev = np.empty(a.size)
+    active = np.arange(a.size)
+
+    for iter in range(20):
+        # a step in Newton's method: x(i+1) = x(i) - f(xi) / fp(xi)
+        # our f(x) = combo() - freq
+        #     fp(x) = dcombo_da()
+
+        a_active = a[active]
+        e_active = e[active] if np.shape(e) else e
+        sin_i_active = sin_i[active] if np.shape(sin_i) else sin_i
+        factors_active = [f[active] if np.shape(f) else f for f in factors]
+
+        (value, slope) = evaluate(active, a_active, factors_active, e_active,
+                                  sin_i_active)
+        da = (value - freq[active]) / slope
+
+        a_active -= da
+        a[active] = a_active
+        counts[active] += 1
+
+        # An element is done when it has converged, or if Newton's method
+        # stops converging, in which case we return what we've got
+        da = np.abs(da)
+        done = ((da <= max(tol, EPSILON) * np.abs(a_active)) |
+                np.isnan(da))
+        if iter > 4:
+            done |= (da >= da_prev[active])
+
+        da_prev[active] = da
+        active = active[~done]
+        if active.size == 0: break
+
+    return (counts, da_prev, active)
+
+################################################################################
+# Gravity class
+################################################################################
+
+class Gravity(object):
+    """A class describing the gravity field of a planet.
+
+    Gravity objects are immutable and hashable. Two objects with the same GM,
+    J-values and radius compare equal, so derived data can be cached per body.
+    Use with_gm() and with_jn() to derive a modified field.
+    """
+
+    __slots__ = ('gm', 'jn', 'rp', 'r2', 'potential_jn',
+                 'omega_jn', 'kappa_jn', 'nu_jn',
+                 'domega_jn', 'dkappa_jn', 'dnu_jn', '_key', '_cache')
+
+    def __init__(self, gm, jlist=(), radius=1.):
         """The constructor for a Gravity object.
 
         Input:
@@ -56,10 +1084,15 @@ class Gravity():
             radius      body radius for associated J-values.
         """
 
-        self.gm = gm
-        self.jn = jlist
-        self.rp = radius
-        self.r2 = radius * radius
+        jlist = tuple(float(j) for j in jlist)
+
+        assign = object.__setattr__
+        assign(self, 'gm', gm)
+        assign(self, 'jn', jlist)
+        assign(self, 'rp', radius)
+        assign(self, 'r2', radius * radius)
+        assign(self, '_key', (float(gm), jlist, float(radius)))
+        assign(self, '_cache', {})
 
         # Evaluate coefficients for frequencies
         n = 0
@@ -85,14 +1118,65 @@ class Gravity():
             dkappa_jn.append(-(n+3) * kappa_jn[i])
             dnu_jn.append(   -(n+3) * nu_jn[i])
 
-        self.potential_jn = np.array(potential_jn)
+        # The coefficient arrays are read-only, like the object itself
+        for (name, values) in (('potential_jn', potential_jn),
+                               ('omega_jn',  omega_jn),
+                               ('kappa_jn',  kappa_jn),
+                               ('nu_jn',     nu_jn),
+                               ('domega_jn', domega_jn),
+                               ('dkappa_jn', dkappa_jn),
+                               ('dnu_jn',    dnu_jn)):
+            array = np.array(values, dtype='float')
+            array.flags.writeable = False
+            assign(self, name, array)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Gravity objects are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Gravity objects are immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, Gravity):
+            return NotImplemented
+        return self._key == other._key
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __reduce__(self):
+        return (Gravity, (self.gm, self.jn, self.rp))
 
-        self.omega_jn  = np.array(omega_jn)
-        self.kappa_jn  = np.array(kappa_jn)
-        self.nu_jn     = np.array(nu_jn)
-        self.domega_jn = np.array(domega_jn)
-        self.dkappa_jn = np.array(dkappa_jn)
-        self.dnu_jn    = np.array(dnu_jn)
+    def __repr__(self):
+        return 'Gravity(%r, %r, %r)' % (self.gm, list(self.jn), self.rp)
+
+    def with_gm(self, gm):
+        """Returns a new Gravity object with a different GM."""
+
+        return Gravity(gm, self.jn, self.rp)
+
+    def with_jn(self, jlist):
+        """Returns a new Gravity object with different J-values."""
+
+        return Gravity(self.gm, jlist, self.rp)
+
+    def _cached(self, key, function):
+        """Internal method to return derived data for this body, calling
+        function() to create it on first use. The cache lives as long as the
+        object does and is never pickled."""
+
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = function()
+            self._cache[key] = value
+            return value
 
     @staticmethod
     def _jseries(coefficients, ratio2):
@@ -107,6 +1191,7 @@ class Gravity():
         return -self.gm/a * (1. - OblateGravity._jseries(self.potential_jn,
                                                          self.r2/a2))
 
+    @_threaded
     def omega(self, a, e=0., sin_i=0.):
         """Returns the mean motion (radians/s) at semimajor axis a.
 
@@ -120,12 +1205,13 @@ class Gravity():
         omega2 = gm_a3 * (1. + Gravity._jseries(self.omega_jn, ratio2))
         omega1 = np.sqrt(omega2)
 
-        if (e or sin_i) and self.jn:
-            omega1 += np.sqrt(gm_a3) * ratio2 * self.jn[0] * \
-                      (3. * e**2 - 12. * sin_i**2)
+        if len(self.jn) and (np.any(e) or np.any(sin_i)):
+            omega1 += np.sqrt(gm_a3) * ratio2 * _ei_term(self.jn[0], (1,0,0),
+                                                         e, sin_i)
 
         return omega1
 
+    @_threaded
     def kappa2(self, a):
         """Returns the square of the radial oscillation frequency (radians/s) at
         semimajor axis a."""
@@ -135,6 +1221,7 @@ class Gravity():
                                                          self.r2/a2))
         return kappa2
 
+    @_threaded
     def kappa(self, a, e=0., sin_i=0.):
         """Returns the radial oscillation frequency (radians/s) at semimajor
         axis a."""
@@ -146,11 +1233,13 @@ class Gravity():
         kappa2 = gm_a3 * (1. + Gravity._jseries(self.kappa_jn, ratio2))
         kappa1 = np.sqrt(kappa2)
 
-        if (e or sin_i) and self.jn:
-            kappa1 += np.sqrt(gm_a3) * ratio2 * self.jn[0] * (-9. * sin_i**2)
+        if len(self.jn) and (np.any(e) or np.any(sin_i)):
+            kappa1 += np.sqrt(gm_a3) * ratio2 * _ei_term(self.jn[0], (0,1,0),
+                                                         e, sin_i)
 
         return kappa1
 
+    @_threaded
     def nu(self, a, e=0., sin_i=0.):
         """Returns the vertical oscillation frequency (radians/s) at semimajor
         axis a."""
@@ -162,12 +1251,13 @@ class Gravity():
         nu2 = gm_a3 * (1. + Gravity._jseries(self.nu_jn, ratio2))
         nu1 = np.sqrt(nu2)
 
-        if (e or sin_i) and self.jn:
-            nu1 += np.sqrt(gm_a3) * ratio2 * self.jn[0] * \
-                      (6. * e**2 - 12.75 * sin_i**2)
+        if len(self.jn) and (np.any(e) or np.any(sin_i)):
+            nu1 += np.sqrt(gm_a3) * ratio2 * _ei_term(self.jn[0], (0,0,1),
+                                                      e, sin_i)
 
         return nu1
 
+    @_threaded
     def domega_da(self, a, e=0., sin_i=0.):
         """Returns the radial derivative of the mean motion (radians/s/km) at
         semimajor axis a."""
@@ -179,12 +1269,13 @@ class Gravity():
         domega2 = gm_a4 * (-3. + Gravity._jseries(self.domega_jn, ratio2))
         domega1 = domega2 / (2. * self.omega(a))
 
-        if (e or sin_i) and self.jn:
-            domega1 -= 3.5 * np.sqrt(self.gm/a)/a2 * ratio2 * self.jn[0] * \
-                       (3. * e**2 - 12. * sin_i**2)
+        if len(self.jn) and (np.any(e) or np.any(sin_i)):
+            domega1 -= 3.5 * np.sqrt(self.gm/a)/a2 * ratio2 * \
+                       _ei_term(self.jn[0], (1,0,0), e, sin_i)
 
         return domega1
 
+    @_threaded
     def dkappa_da(self, a, e=0., sin_i=0.):
         """Returns the radial derivative of the radial oscillation frequency
         (radians/s/km) at semimajor axis a."""
@@ -196,12 +1287,13 @@ class Gravity():
         dkappa2 = gm_a4 * (-3. + Gravity._jseries(self.dkappa_jn, ratio2))
         dkappa1 = dkappa2 / (2. * self.kappa(a))
 
-        if (e or sin_i) and self.jn:
-            dkappa1 -= 3.5 * np.sqrt(self.gm/a)/a2 * ratio2 * self.jn[0] * \
-                       (-9. * sin_i**2)
+        if len(self.jn) and (np.any(e) or np.any(sin_i)):
+            dkappa1 -= 3.5 * np.sqrt(self.gm/a)/a2 * ratio2 * \
+                       _ei_term(self.jn[0], (0,1,0), e, sin_i)
 
         return dkappa1
 
+    @_threaded
     def dnu_da(self, a, e=0., sin_i=0.):
         """Returns the radial derivative of the vertical oscillation frequency
         (radians/s/km) at semimajor axis a."""
@@ -213,33 +1305,107 @@ class Gravity():
         dnu2 = gm_a4 * (-3. + Gravity._jseries(self.dnu_jn, ratio2))
         dnu1 = dnu2 / (2. * self.nu(a))
 
-        if (e or sin_i) and self.jn:
-            dnu1 -= 3.5 * np.sqrt(self.gm/a)/a2 * ratio2 * self.jn[0] * \
-                       (6. * e**2 - 12.75 * sin_i**2)
+        if len(self.jn) and (np.any(e) or np.any(sin_i)):
+            dnu1 -= 3.5 * np.sqrt(self.gm/a)/a2 * ratio2 * \
+                       _ei_term(self.jn[0], (0,0,1), e, sin_i)
 
         return dnu1
 
+    @_threaded
+    def frequencies(self, a, e=0., sin_i=0., derivatives=True):
+        """Returns omega, kappa and nu at semimajor axis a, optionally followed
+        by their radial derivatives, all evaluated in one shared pass.
+
+        The values are identical to those returned by omega(), kappa(), nu(),
+        domega_da(), dkappa_da() and dnu_da(), but the powers of a, the
+        ratio (Rp/a)^2 and the square roots are only computed once.
+
+        Input:
+            a           semimajor axis, scalar or array.
+            e           eccentricity, for second-order corrections.
+            sin_i       sine of the inclination, for second-order corrections.
+            derivatives True to return the radial derivatives as well.
+
+        Return:         (omega, kappa, nu) if derivatives is False;
+                        (omega, kappa, nu, domega_da, dkappa_da, dnu_da)
+                        otherwise.
+        """
+
+        a2 = a * a
+        gm_a3 = self.gm / (a*a2)
+        ratio2 = self.r2 / a2
+
+        omega = np.sqrt(gm_a3 * (1. + Gravity._jseries(self.omega_jn, ratio2)))
+        kappa = np.sqrt(gm_a3 * (1. + Gravity._jseries(self.kappa_jn, ratio2)))
+        nu    = np.sqrt(gm_a3 * (1. + Gravity._jseries(self.nu_jn,    ratio2)))
+
+        if derivatives:
+            gm_a4 = self.gm / (a2*a2)
+            domega = gm_a4 * (-3. + Gravity._jseries(self.domega_jn, ratio2)) \
+                     / (2. * omega)
+            dkappa = gm_a4 * (-3. + Gravity._jseries(self.dkappa_jn, ratio2)) \
+                     / (2. * kappa)
+            dnu    = gm_a4 * (-3. + Gravity._jseries(self.dnu_jn,    ratio2)) \
+                     / (2. * nu)
+
+        # Second-order corrections for e and sin(i)
+        if len(self.jn) and (np.any(e) or np.any(sin_i)):
+            e2 = e**2
+            sin2 = sin_i**2
+            scale = np.sqrt(gm_a3) * ratio2 * self.jn[0]
+            (omega_corr, kappa_corr, nu_corr) = [scale * (ce * e2 + ci * sin2)
+                for (ce, ci) in (_EI_CORRECTIONS['omega'],
+                                 _EI_CORRECTIONS['kappa'],
+                                 _EI_CORRECTIONS['nu'])]
+
+            omega = omega + omega_corr
+            kappa = kappa + kappa_corr
+            nu    = nu    + nu_corr
+
+            if derivatives:
+                dscale = -3.5 / a
+                domega = domega + dscale * omega_corr
+                dkappa = dkappa + dscale * kappa_corr
+                dnu    = dnu    + dscale * nu_corr
+
+        if derivatives:
+            return (omega, kappa, nu, domega, dkappa, dnu)
+
+        return (omega, kappa, nu)
+
+    @_memoized
+    @_threaded
     def combo(self, a, factors, e=0., sin_i=0.):
         """Returns a frequency combination, based on given coefficients for
         omega, kappa and nu. Full numeric precision is preserved in the limit
-        of first- or second-order cancellation of the coefficients."""
+        of first- or second-order cancellation of the coefficients.
 
-        # Shortcut for nonzero e or i, to be refined later
-        if e or sin_i:
-            sum_values = 0.
-            if factors[0]:
-                sum_values = sum_values + factors[0] * self.omega(a, e, sin_i)
-            if factors[1]:
-                sum_values = sum_values + factors[1] * self.kappa(a, e, sin_i)
-            if factors[2]:
-                sum_values = sum_values + factors[2] * self.nu(a, e, sin_i)
+        The factors can also be arrays, broadcastable against a, in which case
+        the appropriate form of cancellation is handled element by element.
+        """
 
-            return sum_values
+        if np.shape(factors[0]) or np.shape(factors[1]) or np.shape(factors[2]):
+            return self._combo_array(a, factors, e, sin_i)
 
         a2 = a * a
         ratio2 = self.r2 / a2
         gm_over_a3 = self.gm / (a * a2)
 
+        sum_values = self._combo_circular(factors, ratio2, gm_over_a3)
+
+        # The corrections for e and sin(i) are linear in the factors, so they
+        # are added to the combination rather than to each frequency
+        if len(self.jn) and (np.any(e) or np.any(sin_i)):
+            sum_values = sum_values + self._combo_correction(factors,
+                                                np.sqrt(gm_over_a3), ratio2,
+                                                e, sin_i)
+
+        return sum_values
+
+    def _combo_circular(self, factors, ratio2, gm_over_a3):
+        """Internal method for combo() with scalar factors, for a circular,
+        equatorial orbit."""
+
         sum_factors = 0
         sum_values = 0.
 
@@ -329,6 +1495,41 @@ class Gravity():
 
         return sum_values
 
+    def _combo_array(self, a, factors, e=0., sin_i=0.):
+        """Internal version of combo() for array-valued factors. The values are
+        always summed as differences from sqrt(GM/a^3), which is exact for any
+        factors, and the second-order reformulation is applied to the elements
+        that need it."""
+
+        (sum_values, sqrt_gm_over_a3, ratio2) = _combo_safe(self.gm, self.r2,
+                                (self.omega_jn, self.kappa_jn, self.nu_jn),
+                                a, factors)
+
+        if len(self.jn) and (np.any(e) or np.any(sin_i)):
+            sum_values = sum_values + self._combo_correction(factors,
+                                                sqrt_gm_over_a3, ratio2,
+                                                e, sin_i)
+
+        return sum_values
+
+    def _combo_correction(self, factors, sqrt_gm_over_a3, ratio2, e, sin_i):
+        """Internal method to return the second-order correction for e and
+        sin(i) to a frequency combination."""
+
+        return sqrt_gm_over_a3 * ratio2 * self._combo_ei_term(factors, e, sin_i)
+
+    def _combo_ei_term(self, factors, e, sin_i):
+        """Internal method to return the dimensionless coefficient of the e and
+        sin(i) corrections to a frequency combination, or zero if there are
+        none. The terms of omega(), kappa() and nu() are combined into one
+        coefficient each on e^2 and sin(i)^2."""
+
+        if not len(self.jn) or not (np.any(e) or np.any(sin_i)):
+            return 0.
+
+        return _ei_term(self.jn[0], factors, e, sin_i)
+
+    @_threaded
     def dcombo_da(self, a, factors, e=0., sin_i=0.):
         """Returns the radial derivative of a frequency combination, based on
         given coefficients for omega, kappa and nu. Unlike method combo(), this
@@ -337,71 +1538,155 @@ class Gravity():
 
         sum_values = 0.
 
-        if factors[0]: sum_values += factors[0] * self.domega_da(a, e, sin_i)
-        if factors[1]: sum_values += factors[1] * self.dkappa_da(a, e, sin_i)
-        if factors[2]: sum_values += factors[2] * self.dnu_da(a, e, sin_i)
+        if np.any(factors[0]):
+            sum_values = sum_values + factors[0] * self.domega_da(a, e, sin_i)
+        if np.any(factors[1]):
+            sum_values = sum_values + factors[1] * self.dkappa_da(a, e, sin_i)
+        if np.any(factors[2]):
+            sum_values = sum_values + factors[2] * self.dnu_da(a, e, sin_i)
 
         return sum_values
 
-    def solve_a(self, freq, factors=(1,0,0), e=0., sin_i=0.):
+    @_memoized
+    def solve_a(self, freq, factors=(1,0,0), e=0., sin_i=0., tol=0.,
+                      iters=False, diagnostics=None, warm_start=False):
         """Solves for the semimajor axis at which the frequency is equal to the
         given combination of factors on omega, kappa and nu. Solution is via
-        Newton's method."""
-
-        # Find an initial guess
-        sum_factors = np.sum(factors)
-
-        # No first-order cancellation:
-        #   freq(a) ~ sum[factors] * sqrt(GM/a^3)
-        #
-        #   a^3 ~ GM * (sum[factors] / freq)^2
-
-        if sum_factors != 0:
-            a = (self.gm * (sum_factors/freq)**2)**(1./3.)
+        Newton's method.
 
-        # No second-order cancellation:
-        #   freq(a) ~ 1/2 * sum[factor*term] * sqrt(GM/a^3) * Rp^2 / a^2
-        #
-        #   a^7 ~ GM * (sum[factor*term]/2 / freq)^2 Rp^4
+        Each Newton step is only applied to the elements that have not yet
+        converged. An element is finished when its correction |da| is no
+        larger than tol * a or the machine precision, or when its correction
+        stops decreasing.
 
-        elif factors[1] != factors[2]:
-            term = (factors[0] * self.omega_jn[0] +
-                    factors[1] * self.kappa_jn[0] +
-                    factors[2] * self.nu_jn[0]) / 2.
-            a = (self.gm * (term * self.r2 / freq)**2)**(1/7.)
+        Input:
+            freq        frequency or array of frequencies (radians/s).
+            factors     coefficients on omega, kappa and nu. These can be
+                        arrays that broadcast against freq.
+            e           eccentricity, for second-order corrections.
+            sin_i       sine of the inclination, for second-order corrections.
+            tol         relative tolerance on a. The default of zero iterates
+                        until the solution is accurate to full precision.
+            iters       True to also return the number of Newton iterations
+                        applied to each element.
+            diagnostics optional SolverDiagnostics object to be filled in with
+                        a record of this call.
+            warm_start  True to take the initial guess from a table of the
+                        inverse of combo(), for scalar factors. The table is
+                        built on first use and cached with the Gravity object.
+                        The guess is then accurate to about 1e-7, so one or
+                        two Newton steps suffice.
+
+        Return:         a, or the tuple (a, iterations) if iters is True.
+        """
 
-        # Second-order cancellation:
-        #   freq(a) ~ -1/8 * sum[factor*term^2] * sqrt(GM/a^3) * Rp^4 / a^4
-        #
-        #   a^11 ~ GM * (-sum[factor*term^2]/8 / freq)^2 Rp^8
+        diagnostics = SolverDiagnostics._begin(diagnostics, 'solve_a',
+                                               np.size(freq))
 
-        else:
-            term = (factors[0] * self.omega_jn[0]**2 +
-                    factors[1] * self.kappa_jn[0]**2 +
-                    factors[2] * self.nu_jn[0]**2) / (-8.)
-            a = (self.gm * (term * self.r2 * self.r2 / freq)**2)**(1/11.)
+        # Find an initial guess
+        first_jn = (0., 0., 0.)
+        if len(self.jn):
+            first_jn = (self.omega_jn[0], self.kappa_jn[0], self.nu_jn[0])
+
+        ei_term = self._combo_ei_term(factors, e, sin_i)
+        a = _solve_a_guess(self.gm, self.r2, first_jn, freq, factors, ei_term)
+
+        # Replace the guess with a table lookup where available
+        if warm_start and not np.shape(factors[0] + factors[1] + factors[2]):
+            table = self._inverse_table(factors)
+            if table is not None:
+                a_table = Gravity._inverse_lookup(freq, table)
+                a = np.where(np.isnan(a_table), a, a_table)
+
+        # Flatten everything so the unconverged subset can be selected by index
+        shape = np.broadcast(a, e, sin_i, *factors).shape
+        a = np.array(np.broadcast_to(a, shape), dtype='float').ravel()
+        freq = np.broadcast_to(freq, shape).ravel()
+        if np.shape(e):
+            e = np.broadcast_to(e, shape).ravel()
+        if np.shape(sin_i):
+            sin_i = np.broadcast_to(sin_i, shape).ravel()
+        factors = [np.broadcast_to(f, shape).ravel() if np.shape(f) else f
+                   for f in factors]
+
+        if diagnostics is not None:
+            diagnostics.size = a.size
+            diagnostics._mark('setup')
 
         # Iterate using Newton's method
-        da_prev_max = 1.e99
-        for iter in range(20):
-            # a step in Newton's method: x(i+1) = x(i) - f(xi) / fp(xi)
-            # our f(x) = self.combo() - freq
-            #     fp(x) = self.dcombo()
+        def evaluate(active, a, factors, e, sin_i):
+            return (self.combo(a, factors, e, sin_i),
+                    self.dcombo_da(a, factors, e, sin_i))
+
+        (counts, da_prev, active) = _solve_a_newton(a, freq, factors, e, sin_i,
+                                                    tol, evaluate)
+
+        # With tol=0, elements stop when they reach the limit of precision, so
+        # a small floor is allowed in the classification
+        if diagnostics is not None:
+            diagnostics._mark('iterate')
+            codes = np.where(da_prev <= max(tol, 1.e-12) * np.abs(a),
+                             STATUS_CONVERGED, STATUS_DIVERGED).astype('int8')
+            codes[active] = STATUS_MAX_ITERS
+            diagnostics._finish(counts.copy(), da_prev, codes)
+
+        a = a.reshape(shape)
+        counts = counts.reshape(shape)
+        if shape == ():
+            a = a[()]
+            counts = counts[()]
+
+        if iters:
+            return (a, counts)
 
-            da = ((self.combo(a, factors, e, sin_i) - freq) / \
-                   self.dcombo_da(a, factors, e, sin_i))
-            da_max = np.max(np.abs(da))
-            if da_max == 0.: break
+        return a
 
-            a -= da
+    def _inverse_table(self, factors):
+        """Internal method to return the cached inverse table of combo() for
+        the given scalar factors, building it on first use. The table is a
+        tuple (sign, log_freq, log_a), where log_freq is the log of sign times
+        the frequency, in increasing order. It covers the outermost range of
+        semimajor axes over which the frequency has a fixed sign and its
+        magnitude decreases strictly. None is returned if there is no such
+        range."""
+
+        factors = tuple(float(f) for f in factors)
+        return self._cached(('inverse_table', factors),
+                            lambda: self._build_inverse_table(factors))
+
+    def _build_inverse_table(self, factors):
+        log_a = np.linspace(np.log(self.rp),
+                            np.log(INVERSE_TABLE_RANGE * self.rp),
+                            INVERSE_TABLE_SIZE)
+
+        with np.errstate(all='ignore'):
+            freq = self.combo(np.exp(log_a), factors)
+            sign = np.sign(freq[-1])
+            if not sign:
+                return None
+
+            log_freq = np.log(sign * freq)
+            bad = ~(np.diff(log_freq) < 0.)
+
+        start = 0
+        if np.any(bad):
+            start = np.nonzero(bad)[0][-1] + 1
+        if start >= INVERSE_TABLE_SIZE - 1:
+            return None
+
+        return (sign, log_freq[start:][::-1].copy(), log_a[start:][::-1].copy())
 
-            # If Newton's method stops converging, return what we've got
-            if iter > 4 and da_max >= da_prev_max:
-                break
+    @staticmethod
+    def _inverse_lookup(freq, table):
+        """Internal method to interpolate an inverse table in log-log space.
+        Frequencies outside the table return NaN."""
 
-            da_prev_max = da_max
+        (sign, log_freq, log_a) = table
+        with np.errstate(all='ignore'):
+            x = np.log(sign * np.asfarray(freq))
 
-        return a
+        return np.exp(np.interp(x, log_freq, log_a, left=np.nan,
+                                                    right=np.nan))
 
     # Useful alternative names...
     def n(self, a, e=0., sin_i=0.):
@@ -451,6 +1736,7 @@ class Gravity():
 
         return self.dcombo_da(a, (1,0,-1), e, sin_i)
 
+    @_memoized
     def ilr_pattern(self, n, m, p=1):
         """Returns the pattern speed of the m:m-p inner Lindblad resonance,
         given the mean motion n of the perturber.
@@ -459,6 +1745,7 @@ class Gravity():
         a = self.solve_a(n, (1,0,0))
         return (n + self.kappa(a) * p/m)
 
+    @_memoized
     def olr_pattern(self, n, m, p=1):
         """Returns the pattern speed of the m:m+p outer Lindblad resonance,
         given the mean motion n of the perturber.
@@ -467,21 +1754,158 @@ class Gravity():
         a = self.solve_a(n, (1,0,0))
         return (n - self.kappa(a) * p/(m+p))
 
+    def resonance_catalog(self, n=None, m=1, p=1, kinds=RESONANCE_KINDS,
+                                a=None):
+        """Returns a catalog of resonances for one or more perturbers, as a
+        structured array with dtype RESONANCE_DTYPE.
+
+        Pattern speeds follow ilr_pattern() and olr_pattern(), with nu
+        replacing kappa for the vertical resonances. With n_p, kappa_p and
+        nu_p the frequencies of the perturber, the kinds are:
+            ILR     pattern = n_p + p kappa_p / m;        m (n - pattern) = kappa
+            OLR     pattern = n_p - p kappa_p / (m+p);  (m+p) (n - pattern) = -kappa
+            IVR     pattern = n_p + p nu_p / m;           m (n - pattern) = nu
+            OVR     pattern = n_p - p nu_p / (m+p);     (m+p) (n - pattern) = -nu
+            ICR     pattern = n_p + p kappa_p / m;        n = pattern
+            OCR     pattern = n_p - p kappa_p / (m+p);    n = pattern
+        where the condition on the right defines the resonant semimajor axis.
+        All radii are found together in a single call to solve_a(), using
+        array-valued factors.
+
+        Input:
+            n           mean motions of the perturbers, scalar or 1-D array.
+            m           value or 1-D array of values of m, all >= 1.
+            p           value or 1-D array of values of p, all >= 0.
+            kinds       the resonance kinds to include, from RESONANCE_KINDS.
+            a           semimajor axes of the perturbers, as an alternative to
+                        n.
+
+        Return:         a structured array with fields "kind", "perturber" (an
+                        index into n or a), "m", "p", "pattern" (radians/s) and
+                        "a" (km). Rows are ordered by kind, then perturber, then
+                        m, then p. The semimajor axis is NaN where a resonance
+                        does not exist.
+        """
+
+        if (n is None) == (a is None):
+            raise ValueError('exactly one of n and a must be given')
+
+        if a is None:
+            n = np.atleast_1d(np.asfarray(n))
+            a = self.solve_a(n, (1,0,0))
+        else:
+            a = np.atleast_1d(np.asfarray(a))
+            n = self.omega(a)
+
+        m = np.atleast_1d(m).astype('int')
+        p = np.atleast_1d(p).astype('int')
+        if np.any(m < 1) or np.any(p < 0):
+            raise ValueError('resonance_catalog requires m >= 1 and p >= 0')
+
+        for kind in kinds:
+            if kind not in RESONANCE_KINDS:
+                raise ValueError('unknown resonance kind: ' + repr(kind))
+
+        (n_p, kappa_p, nu_p) = self.frequencies(a, derivatives=False)
+
+        # Grid of perturber x m x p
+        n_p     = n_p[:,np.newaxis,np.newaxis]
+        kappa_p = kappa_p[:,np.newaxis,np.newaxis]
+        nu_p    = nu_p[:,np.newaxis,np.newaxis]
+        mm = m[np.newaxis,:,np.newaxis]
+        pp = p[np.newaxis,np.newaxis,:]
+        shape = np.broadcast(n_p, mm, pp).shape
+
+        # Pattern speeds and factors on (omega, kappa, nu) for each kind
+        ones = np.ones(shape, dtype='int')
+        pattern = []
+        (f0, f1, f2) = ([], [], [])
+        for kind in kinds:
+            if kind[0] == 'I':
+                arms = mm
+                sign = 1
+            else:
+                arms = mm + pp
+                sign = -1
+
+            if kind[1] == 'V':
+                pattern.append(n_p + sign * pp * nu_p / arms)
+                (f0_, f1_, f2_) = (arms, 0, -sign)
+            elif kind[1] == 'L':
+                pattern.append(n_p + sign * pp * kappa_p / arms)
+                (f0_, f1_, f2_) = (arms, -sign, 0)
+            else:
+                pattern.append(n_p + sign * pp * kappa_p / arms)
+                (f0_, f1_, f2_) = (1, 0, 0)
+
+            f0.append(f0_ * ones)
+            f1.append(f1_ * ones)
+            f2.append(f2_ * ones)
+
+        # Solve for all the radii together
+        pattern = np.array(pattern)
+        factors = (np.array(f0), np.array(f1), np.array(f2))
+        freq = factors[0] * pattern
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            radii = self.solve_a(freq, factors)
+
+            # Reject the cases where Newton's method found no root
+            error = np.abs(self.combo(radii, factors) - freq)
+            radii[~(error <= 1.e-10 * np.abs(freq))] = np.nan
+
+        catalog = np.empty(pattern.shape, dtype=RESONANCE_DTYPE)
+        catalog['kind'] = np.array(kinds)[:,np.newaxis,np.newaxis,np.newaxis]
+        catalog['perturber'] = np.arange(len(n))[:,np.newaxis,np.newaxis]
+        catalog['m'] = mm
+        catalog['p'] = pp
+        catalog['pattern'] = pattern
+        catalog['a'] = radii
+
+        return catalog.ravel()
+
 ################################################################################
 # Orbital elements
 ################################################################################
 
-    def state_from_osc(self, elements, body_gm=0.):
+    def state_from_osc(self, elements, body_gm=0., tol=1.e-12, max_iters=20,
+                             out=None, jacobian=False):
         """Return position and velocity based on osculating orbital elements:
         (a, e, i, mean longitude, longitude of pericenter,
          longitude of ascending node).
 
-        Routine adapted from SWIFT's orbel_el2xv.f by Rob French. Only works
-        well for e < 0.18.
+        Routine adapted from SWIFT's orbel_el2xv.f by Rob French. Kepler's
+        equation is solved by a fixed series and correction that are accurate
+        for e < 0.18. Any element left with a residual above tol, typically
+        one of higher eccentricity, is refined by further iterations, so any
+        0 <= e < 1 is supported.
+
+        Input:
+            elements    the six elements, scalars or arrays that broadcast to a
+                        common shape, or an OrbitArray of their kind.
+            body_gm     GM of the orbiting body, if not negligible.
+            tol         tolerance on the residual in Kepler's equation
+                        (radians).
+            max_iters   upper limit on the refinement iterations.
+            out         optional tuple (pos, vel) of preallocated arrays, each
+                        of shape (..., 3), to receive the result. With
+                        jacobian, a third array of shape (..., 6, 6) can be
+                        included to receive the Jacobian. Alternatively, an
+                        OrbitArray of states.
+            jacobian    True to also return the partial derivatives of the
+                        state with respect to the elements, evaluated
+                        analytically from the same intermediate values.
+
+        Return:         (pos, vel), or (pos, vel, jac) if jacobian is True,
+                        where jac[...,j,k] is the derivative of component j of
+                        (x, y, z, vx, vy, vz) with respect to element k. If
+                        the elements or out are an OrbitArray, an OrbitArray
+                        of states replaces (pos, vel).
         """
 
         gm = self.gm + body_gm
 
+        (elements, out, orbits) = OrbitArray._element_args(elements, out, 'osc')
+
         (a, e, inc, mean_lon, long_peri, long_node) = elements
         a = np.asfarray(a)
         e = np.asfarray(e)
@@ -490,30 +1914,40 @@ class Gravity():
         long_peri = np.asfarray(long_peri)
         long_node = np.asfarray(long_node)
 
-        mean_anomaly = mean_lon - long_peri
+        shape = np.broadcast(a, e, inc, mean_lon, long_peri, long_node).shape
+        (pos, vel) = Gravity._state_buffers(shape, out)
+        jac = Gravity._jacobian_buffer(shape, out, jacobian)
 
-        sp = np.sin(long_peri)
-        cp = np.cos(long_peri)
-        so = np.sin(long_node)
-        co = np.cos(long_node)
-        si = np.sin(inc)
-        ci = np.cos(inc)
-        d11 = cp*co - sp*so*ci
-        d12 = cp*so + sp*co*ci
-        d13 = sp*si
-        d21 = -sp*co - cp*so*ci
-        d22 = -sp*so + cp*co*ci
-        d23 = cp*si
+        result = Gravity._osc_to_state(gm, a, e, inc, mean_lon, long_peri,
+                                       long_node, tol, max_iters, pos, vel, jac)
+        return OrbitArray._state_result(result, orbits)
+
+    @staticmethod
+    def _osc_to_state(gm, a, e, inc, mean_lon, long_peri, long_node,
+                          tol, max_iters, pos, vel, jac=None):
+        """Internal method to fill pos and vel given the osculating elements,
+        and also jac with the partial derivatives if it is not None.
+
+        The arithmetic follows the dtype of the elements. The factors 1 - e^2
+        and 1 - e cos(E), which cancel for high eccentricity, are formed from
+        products evaluated in double precision.
+        """
+
+        # Temporaries are deleted or updated in place as soon as possible to
+        # limit the peak memory
+        mean_anomaly = (mean_lon - long_peri + np.pi) % TWOPI - np.pi
 
         sm = np.sin(mean_anomaly)
         cm = np.cos(mean_anomaly)
 
         x = mean_anomaly + e*sm*( 1. + e*( cm + e*( 1. - 1.5*sm*sm)))
+        del sm, cm
 
         sx = np.sin(x)
         cx = np.cos(x)
         es = e*sx
         ec = e*cx
+        del sx, cx
         f = x - es  - mean_anomaly
         fp = 1. - ec 
         fpp = es 
@@ -521,44 +1955,156 @@ class Gravity():
         dx = -f/fp
         dx = -f/(fp + dx*fpp/2.)
         dx = -f/(fp + dx*fpp/2. + dx*dx*fppp/6.)
+        del f, fp, es, ec
 
         cape = x + dx
+        del x, dx
 
         scap = np.sin(cape)
         ccap = np.cos(cape)
-        sqe = np.sqrt(1. -e*e)
+
+        # Refine only the elements that the fixed steps left unconverged
+        unconverged = ~(np.abs(cape - e*scap - mean_anomaly) <= tol)
+        if np.any(unconverged):
+            cape = np.array(cape)
+            scap = np.array(scap)
+            ccap = np.array(ccap)
+            shape = cape.shape
+            cape[unconverged] = Gravity._solve_kepler(
+                            np.broadcast_to(mean_anomaly, shape)[unconverged],
+                            np.broadcast_to(e, shape)[unconverged],
+                            tol, max_iters)
+            scap[unconverged] = np.sin(cape[unconverged])
+            ccap[unconverged] = np.cos(cape[unconverged])
+
+        del cape, mean_anomaly, unconverged
+
+        dtype = ccap.dtype
+        sqe = np.sqrt(Gravity._one_minus(e, e, dtype))
         sqgma = np.sqrt(gm*a)
-        xfac1 = a*(ccap - e)
-        xfac2 = a*sqe*scap
-        ri = 1./(a*(1. - e*ccap))
-        vfac1 = -ri * sqgma * scap
-        vfac2 = ri * sqgma * sqe * ccap
 
-        x =  d11*xfac1 + d21*xfac2
-        y =  d12*xfac1 + d22*xfac2
-        z =  d13*xfac1 + d23*xfac2
-        vx = d11*vfac1 + d21*vfac2
-        vy = d12*vfac1 + d22*vfac2
-        vz = d13*vfac1 + d23*vfac2
+        # The elements need not share a shape, so products are formed out of
+        # place
+        xfac1 = (ccap - e) * a
+        xfac2 = a*sqe*scap
 
-        # Broadcast to a common shape and create vectors
-        (x,y,z,vx,vy,vz) = np.broadcast_arrays(x,y,z,vx,vy,vz)
+        ri = sqgma/(a*Gravity._one_minus(e, ccap, dtype))  # includes sqgma
+        vfac1 = -ri * scap
+        vfac2 = ri * sqe * ccap
 
-        pos = np.stack([x, y, z], axis=-1)
-        vel = np.stack([vx, vy, vz], axis=-1)
+        if jac is not None:
+            plane = Gravity._osc_plane_partials(a, e, scap, ccap, sqe, ri,
+                                                (xfac1, xfac2, vfac1, vfac2))
 
-        return (pos,vel)
+        del ri, scap, ccap
 
-    ############################################################################
-    # Orbital elements
-    ############################################################################
+        # Rotate into the reference frame, one component at a time
+        sp = np.sin(long_peri)
+        cp = np.cos(long_peri)
+        so = np.sin(long_node)
+        co = np.cos(long_node)
+        si = np.sin(inc)
+        ci = np.cos(inc)
+        d11 = cp*co - sp*so*ci
+        d12 = cp*so + sp*co*ci
+        d13 = sp*si
+        d21 = -sp*co - cp*so*ci
+        d22 = -sp*so + cp*co*ci
+        d23 = cp*si
 
-    def osc_from_state(self, pos, vel, body_gm=0.):
+        for (k, d1, d2) in ((0, d11, d21), (1, d12, d22), (2, d13, d23)):
+            column = pos[...,k]
+            np.multiply(d1, xfac1, out=column)
+            column += d2*xfac2
+
+            column = vel[...,k]
+            np.multiply(d1, vfac1, out=column)
+            column += d2*vfac2
+
+        if jac is None:
+            return (pos,vel)
+
+        # Derivatives of the rotation with respect to i and the node. With
+        # respect to the pericenter, the derivative of (d11,d12,d13) is
+        # (d21,d22,d23) and that of (d21,d22,d23) is -(d11,d12,d13).
+        d1_di = (sp*so*si, -sp*co*si, sp*ci)
+        d2_di = (cp*so*si, -cp*co*si, cp*ci)
+        d1_do = (-cp*so - sp*co*ci,  cp*co - sp*so*ci, 0.)
+        d2_do = ( sp*so - cp*co*ci, -sp*co - cp*so*ci, 0.)
+
+        # Rows are (x,y,z,vx,vy,vz); columns are (a, e, i, mean longitude,
+        # longitude of pericenter, longitude of ascending node)
+        for (k, d1, d2) in ((0, d11, d21), (1, d12, d22), (2, d13, d23)):
+            for (row, x, y) in ((k, 0, 1), (k + 3, 2, 3)):
+                (fac1, fac2) = ((xfac1, xfac2), (vfac1, vfac2))[row // 3]
+                for column in (0, 1, 3):
+                    jac[...,row,column] = (d1 * plane[column][x] +
+                                           d2 * plane[column][y])
+
+                jac[...,row,2] = d1_di[k] * fac1 + d2_di[k] * fac2
+                jac[...,row,4] = d2 * fac1 - d1 * fac2 - jac[...,row,3]
+                jac[...,row,5] = d1_do[k] * fac1 + d2_do[k] * fac2
+
+        return (pos,vel,jac)
+
+    @staticmethod
+    def _osc_plane_partials(a, e, scap, ccap, sqe, ri, factors):
+        """Internal method to return the partial derivatives of the position
+        and velocity in the orbital plane, as a dictionary keyed by the column
+        of the element: 0 for a, 1 for e and 3 for the mean longitude. Each
+        value is a tuple of the derivatives of the four factors (xfac1, xfac2,
+        vfac1, vfac2) of _osc_to_state(), where ri = sqrt(GM/a) / (1 - e cos E).
+        """
+
+        (xfac1, xfac2, vfac1, vfac2) = factors
+
+        fp = Gravity._one_minus(e, ccap, ccap.dtype)
+        ri_fp = ri / fp
+
+        # Derivatives with respect to the eccentric anomaly E
+        dx1_de = -a*scap
+        dx2_de = a*sqe*ccap
+        dv1_de = -ri_fp * (ccap - e)
+        dv2_de = -ri_fp * sqe * scap
+
+        # E varies with the mean anomaly M and with e:
+        #   dE/dM = 1/(1 - e cos E);  dE/de = sin(E)/(1 - e cos E)
+        cape_m = 1. / fp
+        cape_e = scap / fp
+
+        return {0: (xfac1/a, xfac2/a, -vfac1/(2.*a), -vfac2/(2.*a)),
+                1: (dx1_de*cape_e - a,
+                    dx2_de*cape_e - a*e*scap/sqe,
+                    dv1_de*cape_e - ri_fp*scap*ccap,
+                    dv2_de*cape_e + ri*ccap*(sqe*ccap/fp - e/sqe)),
+                3: (dx1_de*cape_m, dx2_de*cape_m,
+                    dv1_de*cape_m, dv2_de*cape_m)}
+
+    ############################################################################
+    # Orbital elements
+    ############################################################################
+
+    def osc_from_state(self, pos, vel=None, body_gm=0., out=None):
         """Return osculating orbital elements based on position and velocity.
 
         Routine adapted from SWIFT's orbel_vx2el.f by Rob French.
+
+        Input:
+            pos, vel    position and velocity vectors, arrays of shape (..., 3);
+                        or an OrbitArray of states as pos, with vel omitted.
+            body_gm     GM of the orbiting body, if not negligible.
+            out         optional preallocated array of shape (..., 6) to
+                        receive the elements as columns, or an OrbitArray of
+                        osculating elements.
+
+        Return:         (a, e, i, mean longitude, longitude of pericenter,
+                         longitude of ascending node). If out is given, these
+                        are views of its columns. If pos or out is an
+                        OrbitArray, an OrbitArray of elements is returned.
         """
 
+        (pos, vel, out, orbits) = OrbitArray._state_args(pos, vel, out, 'osc')
+
         (pos, vel) = np.broadcast_arrays(pos, vel)
         pos = np.asfarray(pos)
         vel = np.asfarray(vel)
@@ -588,8 +2134,8 @@ class Gravity():
         # latitude u.
         fac = np.sqrt(hx**2 + hy**2)/h
 
-        long_node = np.where(fac < tiny, np.zeros(x.shape),
-                                         Gravity._pos_arctan2(hx,-hy))
+        long_node = np.where(fac < tiny, 0., Gravity._pos_arctan2(hx,-hy))
+        del hx, hy, hz
         tmp = np.arctan2(y, x)
         tmp = np.where(np.abs(inc - np.pi) < 10.*tiny, -tmp, tmp)
         tmp = tmp % TWOPI
@@ -603,14 +2149,15 @@ class Gravity():
         u = np.where(fac < tiny, tmp, Gravity._pos_arctan2(z/sin_inc, 
                                                            x*np.cos(long_node) + 
                                                            y*np.sin(long_node)))
+        del tmp, sin_inc
 
         #  Compute the radius R and velocity squared V2, and the dot
         #  product RDOTV, the energy per unit mass ENERGY.
         r = np.sqrt(x*x + y*y + z*z)
         v2 = vx*vx + vy*vy + vz*vz
-        v = np.sqrt(v2)
         vdotr = x*vx + y*vy + z*vz
         energy = 0.5*v2 - gmsum/r
+        del v2
 
         a = -0.5*gmsum/energy
 
@@ -622,37 +2169,61 @@ class Gravity():
         cape = np.arccos(face)
         cape = np.where(vdotr < 0., 2.*np.pi-cape, cape)
         cape = np.where(fac > tiny, cape, u)
-        cw = (np.cos(cape) - e)/(1. - e*np.cos(cape))
-        sw = np.sqrt(1. - e*e)*np.sin(cape)/(1. - e*np.cos(cape))
+        del face, vdotr, r
+
+        ccap = np.cos(cape)
+        scap = np.sin(cape)
+        denom = 1. - e*ccap
+        cw = (ccap - e)/denom
+        sw = np.sqrt(1. - e*e)*scap/denom
         w = np.where(fac > 0., Gravity._pos_arctan2(sw,cw), u)
+        del ccap, denom, cw, sw
 
-        mean_anomaly = (cape - e*np.sin(cape)) % TWOPI
+        mean_anomaly = (cape - e*scap) % TWOPI
         long_peri = (u - w) % TWOPI
+        del cape, scap, u, w
 
         mean_lon = (mean_anomaly + long_peri) % TWOPI
 
-        # Convert any shapeless arrays to scalars
-        elements = []
-        for element in (a, e, inc, mean_lon, long_peri, long_node):
-            if isinstance(element, np.ndarray) and element.shape == ():
-                elements.append(element[()])
-            else:
-                elements.append(element)
-
-        return tuple(elements)
+        elements = Gravity._store_elements((a, e, inc, mean_lon, long_peri,
+                                            long_node), pos.shape[:-1], out)
+        return elements if orbits is None else orbits
 
     # Take the geometric osculating elements and convert to X,Y,Z,VX,VY,VZ
     # Returns x, y, z, vx, vy, vz
     # From Renner & Sicardy (2006) EQ 2-13
 
-    def state_from_geom(self, elements, body_gm=0.):
+    def state_from_geom(self, elements, body_gm=0., out=None, jacobian=False):
         """Return position and velocity based on geometric orbital elements:
         (a, e, i, mean longitude, longitude of pericenter,
          longitude of ascending node).
 
         Adapted from Renner & Sicardy (2006) EQ 2-13 by Rob French.
+
+        Input:
+            elements    the six elements, scalars or arrays that broadcast to a
+                        common shape, or an OrbitArray of their kind.
+            body_gm     GM of the orbiting body, if not negligible.
+            out         optional tuple (pos, vel) of preallocated arrays, each
+                        of shape (..., 3), to receive the result. With
+                        jacobian, a third array of shape (..., 6, 6) can be
+                        included to receive the Jacobian. Alternatively, an
+                        OrbitArray of states.
+            jacobian    True to also return the partial derivatives of the
+                        state with respect to the elements. They are propagated
+                        in forward mode through the same expressions, including
+                        the dependence of the frequencies on a, e and i.
+
+        Return:         (pos, vel), or (pos, vel, jac) if jacobian is True,
+                        where jac[...,j,k] is the derivative of component j of
+                        (x, y, z, vx, vy, vz) with respect to element k. If
+                        the elements or out are an OrbitArray, an OrbitArray
+                        of states replaces (pos, vel).
         """
 
+        (elements, out, orbits) = OrbitArray._element_args(elements, out,
+                                                           'geom')
+
         (a, e, inc, mean_lon, long_peri, long_node) = elements
         a = np.asfarray(a)
         e = np.asfarray(e)
@@ -661,140 +2232,1076 @@ class Gravity():
         long_peri = np.asfarray(long_peri)
         long_node = np.asfarray(long_node)
 
-        mean_anomaly = lam - long_peri
+        shape = np.broadcast(a, e, inc, lam, long_peri, long_node).shape
+        (pos, vel) = Gravity._state_buffers(shape, out)
+        jac = Gravity._jacobian_buffer(shape, out, jacobian)
+
+        # For the Jacobian, each element is seeded with a unit derivative
+        if jacobian:
+            (a, e, inc, lam, long_peri, long_node) = [_Jet(x, {k: 1.})
+                for (k, x) in enumerate((a, e, inc, lam, long_peri, long_node))]
 
-        (n, kappa, nu, eta2, chi2,
-         alpha1, alpha2, alphasq) = self._geom_to_freq(a, e, inc, body_gm)
+        freqs = self._geom_to_freq(a, e, inc, body_gm)
+        result = Gravity._geom_to_state(a, e, inc, lam, long_peri, long_node,
+                                        freqs, pos, vel, jac)
+        return OrbitArray._state_result(result, orbits)
+
+    @staticmethod
+    def _geom_to_state(a, e, inc, lam, long_peri, long_node, freqs, pos, vel,
+                       jac=None):
+        """Internal method to fill pos and vel given the geometric elements and
+        the frequencies returned by _geom_to_freq(), which can be evaluated
+        once and reused for many longitudes.
+
+        If jac is not None, the elements and frequencies are _Jet objects and
+        jac receives the partial derivatives of the state.
+        """
+
+        (n, kappa, nu, eta2, chi2, alpha1, alpha2, alphasq) = freqs
         kappa2 = kappa**2
         n2 = n**2
         nu2 = nu**2
 
+        # Each trigonometric term is evaluated once; terms are grouped so they
+        # can be released early
+        peri_angle = lam - long_peri
+        node_angle = lam - long_node
+
         # Convert to cylindrical
-        r = a*(1. - e*np.cos(lam-long_peri) + 
+        cos_peri = np.cos(peri_angle)
+        cos_peri2 = np.cos(2.*peri_angle)
+        cos_node2 = np.cos(2.*node_angle)
+
+        r = a*(1. - e*cos_peri + 
                e**2*(3./2. * eta2/kappa2 - 1. -
-                      eta2/2./kappa2 * np.cos(2.*(lam-long_peri))) +
+                     eta2/2./kappa2 * cos_peri2) +
                inc**2*(3./4.*chi2/kappa2 - 1. +
-                        chi2/4./alphasq * np.cos(2.*(lam-long_node))))
-
-        L = (lam + 2.*e*n/kappa*np.sin(lam-long_peri) + 
-             e**2*(3./4. + nu2/2./kappa2)*n/kappa * np.sin(2.*(lam-long_peri)) -
-             inc**2*chi2/4./alphasq*n/nu*np.sin(2.*(lam-long_node)))
+                       chi2/4./alphasq * cos_node2))
 
-        z = a * inc * (np.sin(lam-long_node) + 
-                       e*chi2/2./kappa/alpha1*np.sin(2.*lam-long_peri-long_node) -
-                       e*3./2.*chi2/kappa/alpha2*np.sin(long_peri-long_node))
-
-        rdot = a * kappa * (e*np.sin(lam-long_peri) + 
-                            e**2*eta2/kappa2*np.sin(2.*(lam-long_peri)) -
-                            inc**2*chi2/2./alphasq*nu/kappa*
-                            np.sin(2.*(lam-long_node)))
-
-        Ldot = n*(1. + 2.*e*np.cos(lam-long_peri) +
+        Ldot = n*(1. + 2.*e*cos_peri +
                   e**2 * (7./2. - 3.*eta2/kappa2 - kappa2/2./n2 + 
-                           (3./2.+eta2/kappa2)*np.cos(2.*(lam-long_peri))) +
+                          (3./2.+eta2/kappa2)*cos_peri2) +
                   inc**2 * (2. - kappa2/2./n2 - 3./2.*chi2/kappa2 - 
-                             chi2/2./alphasq*np.cos(2.*(lam-long_node))))
-
-        vz = a*inc*nu*(np.cos(lam-long_node) + 
-                       e*chi2*(kappa+nu)/2./kappa/alpha1/nu *
-                       np.cos(2*lam-long_peri-long_node) +
-           e*3./2.*chi2*(kappa-nu)/kappa/alpha2/nu*np.cos(long_peri-long_node))
-
-        x = r*np.cos(L)
-        y = r*np.sin(L)
-        vx = rdot*np.cos(L) - r*Ldot*np.sin(L)
-        vy = rdot*np.sin(L) + r*Ldot*np.cos(L)
+                            chi2/2./alphasq*cos_node2))
+        del cos_peri, cos_peri2, cos_node2
+
+        sin_peri = np.sin(peri_angle)
+        sin_peri2 = np.sin(2.*peri_angle)
+        sin_node2 = np.sin(2.*node_angle)
+        del peri_angle
+
+        L = (lam + 2.*e*n/kappa*sin_peri + 
+             e**2*(3./4. + nu2/2./kappa2)*n/kappa * sin_peri2 -
+             inc**2*chi2/4./alphasq*n/nu*sin_node2)
+
+        rdot = a * kappa * (e*sin_peri + 
+                            e**2*eta2/kappa2*sin_peri2 -
+                            inc**2*chi2/2./alphasq*nu/kappa*sin_node2)
+        del sin_peri, sin_peri2, sin_node2
+
+        product = Gravity._product
+        z = product(a * inc,
+                    np.sin(node_angle) + 
+                    e*chi2/2./kappa/alpha1*np.sin(2.*lam-long_peri-long_node) -
+                    e*3./2.*chi2/kappa/alpha2*np.sin(long_peri-long_node),
+                    pos[...,2])
+
+        vz = product(a*inc*nu,
+                    np.cos(node_angle) + 
+                    e*chi2*(kappa+nu)/2./kappa/alpha1/nu *
+                    np.cos(2*lam-long_peri-long_node) +
+            e*3./2.*chi2*(kappa-nu)/kappa/alpha2/nu*np.cos(long_peri-long_node),
+                    vel[...,2])
+        del node_angle
+
+        cos_L = np.cos(L)
+        sin_L = np.sin(L)
+        del L
+
+        x = product(r, cos_L, pos[...,0])
+        y = product(r, sin_L, pos[...,1])
+
+        r_Ldot = r
+        r_Ldot *= Ldot
+        del r, Ldot
+
+        vx = product(rdot, cos_L, vel[...,0])
+        vx -= r_Ldot*sin_L
+
+        vy = product(rdot, sin_L, vel[...,1])
+        vy += r_Ldot*cos_L
+
+        if jac is None:
+            return (pos, vel)
+
+        # Copy the values and derivatives out of the jets
+        for (row, jet) in enumerate((x, y, z, vx, vy, vz)):
+            (pos, vel)[row // 3][...,row % 3] = jet.value
+            for column in range(6):
+                jac[...,row,column] = jet.deriv.get(column, 0.)
+
+        return (pos, vel, jac)
 
-        # Broadcast to a common shape and create vectors
-        (x,y,z,vx,vy,vz) = np.broadcast_arrays(x,y,z,vx,vy,vz)
+    @staticmethod
+    def _product(x, y, out):
+        """Internal method to return x*y, written into out unless either factor
+        is a _Jet."""
 
-        pos = np.stack([x, y, z], axis=-1)
-        vel = np.stack([vx, vy, vz], axis=-1)
+        if isinstance(x, _Jet) or isinstance(y, _Jet):
+            return x * y
 
-        return (pos, vel)
+        return np.multiply(x, y, out=out)
 
     # Given the state vector x,y,z,vx,vy,vz retrieve the geometric elements
     # Returns: a, e, inc, long_peri, long_node, mean_anomaly
     # From Renner and Sicardy (2006) EQ 22-47
 
-    def geom_from_state(self, pos, vel, body_gm=0., tol=1.e-6):
+    def geom_from_state(self, pos, vel=None, body_gm=0., tol=1.e-6,
+                              max_iters=100, status=False, out=None,
+                              diagnostics=None):
         """Return geometric orbital elements based on position and velocity.
 
         Routine adapted from SWIFT's orbel_vx2el.f by Rob French.
+
+        The elements are refined iteratively, and each iteration is only
+        applied to the elements that are not yet finished. An element has
+        converged when its semimajor axis changes by less than tol. After the
+        first few iterations, it is diverging if the change grows from one
+        iteration to the next, in which case the values from that iteration
+        are returned.
+
+        Input:
+            pos         position vector(s), shape (..., 3), or an OrbitArray
+                        of states.
+            vel         velocity vector(s), shape (..., 3); omitted if pos is
+                        an OrbitArray.
+            body_gm     GM of the orbiting body, if not negligible.
+            tol         convergence tolerance on the semimajor axis (km).
+            max_iters   upper limit on the number of iterations.
+            status      True to also return an integer array with one of
+                        STATUS_CONVERGED, STATUS_DIVERGED or STATUS_MAX_ITERS
+                        for each element. Otherwise, a single warning is issued
+                        if any element failed to converge.
+            out         optional preallocated array of shape (..., 6) to
+                        receive the elements as columns, or an OrbitArray of
+                        geometric elements.
+            diagnostics optional SolverDiagnostics object to be filled in with
+                        a record of this call.
+
+        Return:         (a, e, inc, mean_lon, long_peri, long_node), or the
+                        tuple (elements, status) if status is True. If out is
+                        given, the elements are views of its columns. If pos
+                        or out is an OrbitArray, the elements are returned as
+                        an OrbitArray.
         """
 
+        (pos, vel, out, orbits) = OrbitArray._state_args(pos, vel, out,
+                                                         'geom')
+
+        diagnostics = SolverDiagnostics._begin(diagnostics, 'geom_from_state',
+                                               np.broadcast(pos, vel).size // 3)
+
         (pos, vel) = np.broadcast_arrays(pos, vel)
         pos = np.asfarray(pos)
         vel = np.asfarray(vel)
+        shape = pos.shape[:-1]
 
-        x = pos[...,0]
-        y = pos[...,1]
-        z = pos[...,2]
+        x = pos[...,0].ravel()
+        y = pos[...,1].ravel()
+        z = pos[...,2].ravel()
 
-        vx = vel[...,0]
-        vy = vel[...,1]
-        vz = vel[...,2]
+        vx = vel[...,0].ravel()
+        vy = vel[...,1].ravel()
+        vz = vel[...,2].ravel()
 
         # EQ 22-25
         r = np.sqrt(x**2 + y**2)
         L = Gravity._pos_arctan2(y, x)
-        rdot = vx*np.cos(L) + vy*np.sin(L)
-        Ldot = (vy*np.cos(L)-vx*np.sin(L))/r
-
-        # Initial conditions
-        a = r
-        e = 0.
-        inc = 0.
-        rc = 0.
-        Lc = 0.
-        zc = 0.
-        rdotc = 0.
-        Ldotc = 0.
-        zdotc = 0.
-
-        old_diffmax = 1.e38
-        old_diff = None
-        idx_to_use = np.where(x!=-1e38,True,False) # All True
-        announced = False
-        while True:
-            (n, kappa, nu, eta2, chi2, 
-             alpha1, alpha2, alphasq) = self._geom_to_freq(a, e, inc, body_gm)
-            ret = Gravity._freq_to_geom(r, L, z, rdot, Ldot, vz, rc, Lc, zc, rdotc, 
-                                   Ldotc, zdotc, n, kappa, nu, eta2, chi2,
-                                   alpha1, alpha2, alphasq)
-            old_a = a
-            (a, e, inc, long_peri, long_node, lam, 
-             rc, Lc, zc, rdotc, Ldotc, zdotc) = ret
-            diff = np.abs(a-old_a)
-            diffmax = np.max(diff[idx_to_use])
-            if diffmax < tol:
-                break
-            if diffmax > old_diffmax:
-                idx_to_use = np.where(diff > old_diff,False,True) & idx_to_use
-                if not idx_to_use.any(): break
-                if not announced:
-                    warnings.warn('geom_from_state() started diverging! ' +
-                                  'Tolerance met = %e' % diffmax)
-                    announced = True
-
-                diff_of_diff = diff - old_diff
-                bad_idx = diff_of_diff.argmax()
-                warnings.warn('Bad index ' + str(bad_idx) +
-                              '; X = ' + str(x[bad_idx]) +
-                              '; Y = ' + str(y[bad_idx]) +
-                              '; Z =' + str(z[bad_idx]) +
-                              '; VX = ' + str(vx[bad_idx]) +
-                              '; VY = ' + str(vy[bad_idx]) +
-                              '; VZ = ' + str(vz[bad_idx]))
-            old_diffmax = diffmax
+        cos_L = np.cos(L)
+        sin_L = np.sin(L)
+        rdot = vx*cos_L + vy*sin_L
+        Ldot = (vy*cos_L - vx*sin_L)/r
+        del cos_L, sin_L
+
+        if diagnostics is not None:
+            diagnostics._mark('setup')
+
+        if shape == ():
+            # A single state is iterated on scalars, without the overhead of
+            # one-element arrays and of the active set
+            (values, codes, counts,
+             old_diff) = self._geom_iterate_scalar(r[0], L[0], z[0], rdot[0],
+                                                   Ldot[0], vz[0], body_gm,
+                                                   tol, max_iters)
+        else:
+            # Initial conditions. The iterated quantities are, in order: a, e,
+            # inc, long_peri, long_node, lam, rc, Lc, zc, rdotc, Ldotc, zdotc
+            values = [r.copy()] + [np.zeros(r.size) for k in range(11)]
+
+            old_diff = np.empty(r.size)
+            old_diff.fill(np.inf)
+            codes = np.empty(r.size, dtype='int8')
+            codes.fill(STATUS_MAX_ITERS)
+            counts = np.zeros(r.size, dtype='int')
+            active = np.arange(r.size)
+
+            for iter in range(max_iters):
+                # Avoid the gather and scatter while every element is active
+                sel = slice(None) if active.size == r.size else active
+
+                (a, e, inc) = [v[sel] for v in values[:3]]
+                freqs = self._geom_to_freq(a, e, inc, body_gm)
+                ret = Gravity._freq_to_geom(r[sel], L[sel], z[sel],
+                                            rdot[sel], Ldot[sel], vz[sel],
+                                            *([v[sel] for v in values[6:]] +
+                                              list(freqs)))
+
+                diff = np.abs(ret[0] - a)
+                for (v, new_v) in zip(values, ret):
+                    v[sel] = new_v
+
+                # Allow a few iterations for the initial transient to die out
+                # before checking for divergence
+                converged = diff < tol
+                if iter > 4:
+                    diverged = ~converged & ~(diff <= old_diff[active])
+                else:
+                    diverged = np.isnan(diff)
+
+                old_diff[active] = diff
+                counts[active] += 1
+                codes[active[converged]] = STATUS_CONVERGED
+                codes[active[diverged]] = STATUS_DIVERGED
+
+                active = active[~(converged | diverged)]
+                if active.size == 0: break
+
+        if diagnostics is not None:
+            diagnostics._mark('iterate')
+            diagnostics._finish(counts, old_diff, codes.copy())
+
+        if not status:
+            failures = np.sum(codes != STATUS_CONVERGED)
+            if failures:
+                warnings.warn('geom_from_state() did not converge for ' +
+                              '%d of %d elements' % (failures, codes.size))
+
+        (a, e, inc, long_peri, long_node, lam) = [v.reshape(shape)
+                                                  for v in values[:6]]
+        elements = Gravity._store_elements((a, e, inc, lam, long_peri,
+                                            long_node), shape, out)
+        elements = tuple(elements) if orbits is None else orbits
+
+        if status:
+            codes = codes.reshape(shape)
+            if shape == ():
+                codes = codes[()]
+            return (elements, codes)
+
+        return elements
+
+    def _geom_iterate_scalar(self, r, L, z, rdot, Ldot, zdot, body_gm, tol,
+                                   max_iters):
+        """Internal method for geom_from_state() to iterate the elements of a
+        single state, with the same convergence tests as the array version.
+        It returns the iterated quantities as one-element arrays, followed by
+        one-element arrays of the status code, iteration count and final
+        change in a."""
+
+        values = [r] + [0.] * 11
+        code = STATUS_MAX_ITERS
+        count = 0
+        old_diff = np.inf
+        for iter in range(max_iters):
+            freqs = self._geom_to_freq(values[0], values[1], values[2],
+                                       body_gm)
+            ret = Gravity._freq_to_geom(r, L, z, rdot, Ldot, zdot,
+                                        *(values[6:] + list(freqs)))
+
+            diff = abs(ret[0] - values[0])
+            values = list(ret)
+            count += 1
+
+            if diff < tol:
+                code = STATUS_CONVERGED
+            elif (not diff <= old_diff) if iter > 4 else np.isnan(diff):
+                code = STATUS_DIVERGED
+
             old_diff = diff
+            if code != STATUS_MAX_ITERS: break
+
+        return ([np.array([v], dtype='float') for v in values],
+                np.array([code], dtype='int8'), np.array([count]),
+                np.array([old_diff]))
+
+    ############################################################################
+    # Chunked conversion
+    ############################################################################
+
+    def convert_chunks(self, conversion, array, chunk_size=CHUNK_SIZE,
+                             out=None, status=False, **options):
+        """Generator that applies a state or element conversion to an array of
+        six columns one chunk at a time.
+
+        A state array has columns (x, y, z, vx, vy, vz); an element array has
+        columns (a, e, i, mean longitude, longitude of pericenter, longitude of
+        ascending node). Only one chunk of the input is read at a time, so the
+        input can be a memory-mapped array of any size.
+
+        Input:
+            conversion  name of the conversion method, one of CONVERSIONS.
+            array       input array of shape (..., 6) or an OrbitArray.
+            chunk_size  number of rows to convert at a time.
+            out         optional array of shape (N, 6), where N is the number
+                        of rows in the input, to receive the results.
+            status      True to also yield an integer array with the status
+                        code of each row, as returned by geom_from_state().
+                        The other conversions always give STATUS_CONVERGED.
+                        Otherwise, a single warning is issued after the last
+                        chunk if any row failed to converge.
+            options     additional keyword arguments to the conversion method.
+
+        Return:         a generator of tuples (start, result), where result is
+                        the converted array of shape (rows, 6) starting at row
+                        index start, or (start, result, codes) if status is
+                        True.
+        """
+
+        if conversion not in CONVERSIONS:
+            raise ValueError('unknown conversion: ' + repr(conversion))
+
+        if isinstance(array, OrbitArray):
+            array = array.array
+
+        if array.shape[-1] != 6:
+            raise ValueError('input array must have six columns')
+
+        method = getattr(self, conversion)
+        array = array.reshape(-1, 6)
+        rows = array.shape[0]
+
+        if out is not None and out.shape != (rows, 6):
+            raise ValueError('output array shape %s does not match %s' %
+                             (str(out.shape), str((rows, 6))))
+
+        failures = 0
+        for start in range(0, rows, chunk_size):
+            stop = min(start + chunk_size, rows)
+            block = np.asfarray(array[start:stop])
+
+            if out is None:
+                result = np.empty((stop - start, 6))
+            else:
+                result = out[start:stop]
+
+            # Collect the status codes of geom_from_state() so that there is
+            # one warning for the whole conversion rather than one per chunk
+            codes = np.full(stop - start, STATUS_CONVERGED, dtype='int8')
+            if conversion.startswith('state_'):
+                elements = tuple(block[:,k] for k in range(6))
+                method(elements, out=(result[:,:3], result[:,3:]), **options)
+            elif conversion == 'geom_from_state':
+                (_, codes) = method(block[:,:3], block[:,3:], out=result,
+                                    status=True, **options)
+                failures += np.sum(codes != STATUS_CONVERGED)
+            else:
+                method(block[:,:3], block[:,3:], out=result, **options)
+
+            if status:
+                yield (start, result, codes)
+            else:
+                yield (start, result)
+
+        if failures and not status:
+            warnings.warn('geom_from_state() did not converge for ' +
+                          '%d of %d elements' % (failures, rows))
+
+    def convert_npy(self, conversion, input_file, output_file,
+                          chunk_size=CHUNK_SIZE, status=False, **options):
+        """Apply a state or element conversion to an array in a .npy file,
+        writing the result to a new .npy file.
 
-        return (a, e, inc, lam, long_peri, long_node)
+        Both files are memory-mapped and converted in chunks, so memory use is
+        bounded regardless of the file size.
+
+        Input:
+            conversion  name of the conversion method, one of CONVERSIONS.
+            input_file  path to a .npy file holding an array of shape (..., 6).
+            output_file path to the .npy file to create. It receives a float64
+                        array of the same shape as the input.
+            chunk_size  number of rows to convert at a time.
+            status      True to also return an integer array with the status
+                        code of each row, as in convert_chunks(). Otherwise, a
+                        single warning is issued if any row failed to
+                        converge.
+            options     additional keyword arguments to the conversion method.
+
+        Return:         the shape of the converted array, or the tuple (shape,
+                        codes) if status is True.
+        """
+
+        array = np.load(input_file, mmap_mode='r')
+        if array.shape[-1:] != (6,):
+            raise ValueError('input array must have six columns')
+
+        codes = np.empty(array.shape[:-1], dtype='int8')
+        output = np.lib.format.open_memmap(output_file, mode='w+',
+                                           dtype='float64', shape=array.shape)
+        for chunk in self.convert_chunks(conversion, array, chunk_size,
+                                         out=output.reshape(-1, 6),
+                                         status=status, **options):
+            if status:
+                (start, result, chunk_codes) = chunk
+                codes.reshape(-1)[start:start + len(result)] = chunk_codes
+
+        output.flush()
+        del output
+
+        if status:
+            return (array.shape, codes)
+
+        return array.shape
+
+    def convert_parallel(self, conversion, array, workers=None,
+                               chunk_size=CHUNK_SIZE, status=False, out=None,
+                               **options):
+        """Apply a state or element conversion to an array of six columns,
+        dividing the work among a pool of processes.
+
+        The input and output are exchanged through shared memory blocks, so
+        the arrays themselves are never pickled. The input is copied into its
+        block one chunk at a time, so a memory-mapped input is never loaded
+        whole. The chunks are converted in parallel and the results are
+        assembled in their original order.
+
+        Without an output array, the result is returned as a view of its
+        shared memory block, which is released along with the last array
+        that uses it. If the output array is memory-mapped from a file, the
+        workers write straight into the file and no result block is needed;
+        any other output array is filled from the block one chunk at a time.
+
+        Input:
+            conversion  name of the conversion method, one of CONVERSIONS.
+            array       input array of shape (..., 6).
+            workers     number of worker processes; None for one per CPU.
+            chunk_size  number of rows to convert per task.
+            status      True to also return an integer array with the status
+                        code of each row, as in convert_chunks(). Otherwise, a
+                        single warning is issued if any row failed to
+                        converge.
+            out         optional C-contiguous float64 array with the same
+                        shape as the input, to receive the result.
+            options     additional keyword arguments to the conversion method.
+
+        Return:         the converted array, with the same shape as the input,
+                        or the tuple (result, codes) if status is True.
+        """
+
+        from multiprocessing import Pool, shared_memory
+
+        if conversion not in CONVERSIONS:
+            raise ValueError('unknown conversion: ' + repr(conversion))
+
+        array = np.asanyarray(array)
+        if array.shape[-1:] != (6,):
+            raise ValueError('input array must have six columns')
+
+        if out is not None:
+            if out.shape != array.shape:
+                raise ValueError('output array shape %s does not match %s' %
+                                 (str(out.shape), str(array.shape)))
+            if out.dtype != np.float64 or not out.flags.c_contiguous:
+                raise ValueError('output array must be C-contiguous float64')
+
+        rows = array.size // 6
+        flat = array.reshape(-1, 6)
+        if workers == 1 or rows <= chunk_size:
+            result = np.empty(array.shape) if out is None else out
+            codes = np.empty(rows, dtype='int8')
+            chunks = self.convert_chunks(conversion, flat, chunk_size,
+                                         out=result.reshape(-1, 6),
+                                         status=True, **options)
+            for (start, chunk, chunk_codes) in chunks:
+                codes[start:start + len(chunk)] = chunk_codes
+
+            return Gravity._conversion_status(result, codes, status)
+
+        nbytes = rows * 6 * 8
+        location = None if out is None else _memmap_location(out)
+        source_memory = shared_memory.SharedMemory(create=True, size=nbytes)
+        result_memory = None
+        shared = False
+        try:
+            source = np.ndarray((rows, 6), buffer=source_memory.buf)
+            for start in range(0, rows, chunk_size):
+                source[start:start + chunk_size] = flat[start:start +
+                                                                 chunk_size]
+            del source
+
+            if location is None:
+                result_memory = shared_memory.SharedMemory(create=True,
+                                                           size=nbytes)
+                target = ('memory', result_memory.name)
+            else:
+                target = ('file',) + location
+
+            tasks = [(self, conversion, source_memory.name, target, rows,
+                      start, min(start + chunk_size, rows), options)
+                     for start in range(0, rows, chunk_size)]
+
+            pool = Pool(workers)
+            try:
+                codes = np.concatenate(pool.map(_convert_shared, tasks,
+                                                chunksize=1))
+            finally:
+                pool.close()
+                pool.join()
+
+            if result_memory is None:
+                result = out
+            elif out is None:
+                result = np.asarray(_SharedBlock(result_memory, (rows, 6)))
+                result = result.reshape(array.shape)
+                shared = True
+            else:
+                block = np.ndarray((rows, 6), buffer=result_memory.buf)
+                result = out.reshape(-1, 6)
+                for start in range(0, rows, chunk_size):
+                    result[start:start + chunk_size] = block[start:start +
+                                                                 chunk_size]
+                del block
+                result = out
+
+        finally:
+            source_memory.close()
+            source_memory.unlink()
+            if result_memory is not None:
+                result_memory.unlink()
+                if not shared:
+                    result_memory.close()
+
+        return Gravity._conversion_status(result, codes, status)
+
+    @staticmethod
+    def _conversion_status(result, codes, status):
+        """Internal method for convert_parallel() to return the result with the
+        status codes reshaped to match it, or else to issue a single warning if
+        any row failed to converge."""
+
+        if status:
+            return (result, codes.reshape(result.shape[:-1]))
+
+        failures = np.sum(codes != STATUS_CONVERGED)
+        if failures:
+            warnings.warn('geom_from_state() did not converge for ' +
+                          '%d of %d elements' % (failures, codes.size))
+
+        return result
+
+    def ephemeris(self, elements, times, kind='geom', epoch=0., body_gm=0.,
+                        chunk_size=CHUNK_SIZE, out=None):
+        """Generator of state vectors for a set of particles at an array of
+        times, one chunk of times at a time.
+
+        The mean longitude, longitude of pericenter and longitude of ascending
+        node advance at the rates n(), dperi_dt() and dnode_dt() of GM +
+        body_gm, which are evaluated once per particle along with any other
+        frequencies needed by the conversion. For osculating elements, these
+        are the secular rates, so short-period terms are neglected.
+
+        Input:
+            elements    the six elements (a, e, i, mean longitude, longitude of
+                        pericenter, longitude of ascending node) at the epoch;
+                        scalars or arrays that broadcast to the particle shape.
+            times       1-D array of times (seconds).
+            kind        "geom" for geometric elements or "osc" for osculating
+                        elements.
+            epoch       time of the elements (seconds).
+            body_gm     GM of the orbiting body, if not negligible.
+            chunk_size  approximate number of states to evaluate at a time.
+            out         optional tuple (pos, vel) of preallocated arrays, each
+                        of shape (times,) + particle shape + (3,), to receive
+                        the full grid.
+
+        Return:         a generator of tuples (start, pos, vel), where pos and
+                        vel have shape (rows,) + particle shape + (3,) and
+                        contain the states at times[start:start+rows].
+        """
+
+        if kind not in ('geom', 'osc'):
+            raise ValueError('unrecognized element kind: ' + repr(kind))
+
+        elements = [np.asfarray(x) for x in elements]
+        particles = np.broadcast(*elements).shape
+        (a, e, inc, mean_lon, long_peri, long_node) = [
+                            np.broadcast_to(x, particles) for x in elements]
+
+        times = np.asfarray(times)
+        if times.ndim != 1:
+            raise ValueError('times must be a 1-D array')
+
+        shape = times.shape + particles + (3,)
+        if out is not None and (out[0].shape != shape or
+                                out[1].shape != shape):
+            raise ValueError('output array shape does not match %s' %
+                             str(shape))
+
+        # Rates and frequencies are evaluated once per particle. As in the
+        # conversions, the rates are those of GM + body_gm.
+        gravity = self.with_gm(self.gm + body_gm) if body_gm else self
+        sin_i = np.sin(inc)
+        dmean_dt = gravity.n(a, e, sin_i)
+        dperi_dt = gravity.dperi_dt(a, e, sin_i)
+        dnode_dt = gravity.dnode_dt(a, e, sin_i)
+        if kind == 'geom':
+            freqs = self._geom_to_freq(a, e, inc, body_gm)
+
+        rows = max(1, chunk_size // max(1, int(np.prod(particles))))
+        for start in range(0, times.size, rows):
+            stop = min(start + rows, times.size)
+            dt = times[start:stop] - epoch
+            dt = dt.reshape(dt.shape + (1,) * len(particles))
+
+            if out is None:
+                pos = np.empty((stop - start,) + shape[1:])
+                vel = np.empty((stop - start,) + shape[1:])
+            else:
+                pos = out[0][start:stop]
+                vel = out[1][start:stop]
+
+            lam = mean_lon + dmean_dt * dt
+            peri = long_peri + dperi_dt * dt
+            node = long_node + dnode_dt * dt
+
+            if kind == 'geom':
+                Gravity._geom_to_state(a, e, inc, lam, peri, node, freqs,
+                                       pos, vel)
+            else:
+                self.state_from_osc((a, e, inc, lam, peri, node), body_gm,
+                                    out=(pos, vel))
+
+            del lam, peri, node
+            yield (start, pos, vel)
+
+    ############################################################################
+    # Orbit fitting
+    ############################################################################
+
+    def fit_geom(self, times, pos=None, radii=None, longitudes=None,
+                       weights=None, guess=None, free=None, epoch=0.,
+                       body_gm=0., tol=1.e-10, max_iters=50, status=False,
+                       diagnostics=None):
+        """Fit geometric elements to the observations of many targets at once,
+        such as ringlets or particles, by Levenberg-Marquardt iteration.
+
+        The model advances the mean longitude, pericenter and node of each
+        target from the epoch at the rates n(), dperi_dt() and dnode_dt(), and
+        evaluates state_from_geom() with its Jacobian. Every target takes its
+        own damped Gauss-Newton step in one batched solve, and targets are
+        dropped from the iteration as they finish.
+
+        The observations are either positions, or radii in the equatorial
+        plane at given inertial longitudes. For radii, the mean longitude of the
+        point at each observed longitude is solved for, so the mean longitude
+        element is irrelevant and, by default, only a, e and the pericenter are
+        fitted.
+
+        Input:
+            times       times of the observations (seconds), an array of shape
+                        (T,K) for T targets with K observations each, or (K,)
+                        if the times are shared.
+            pos         observed positions, shape (T,K,3).
+            radii       observed radii (km), shape (T,K), as an alternative to
+                        pos.
+            longitudes  inertial longitudes of the radii (radians), shape
+                        (T,K).
+            weights     optional weights of the observations, shape (T,K).
+                        Missing observations can be given zero weight.
+            guess       initial elements, shape (T,6). By default, they are
+                        estimated from the observations, starting from the
+                        mean motion at the mean radius. This suffices when the
+                        eccentricity is small; otherwise, a guess is needed.
+            free        optional sequence of six booleans selecting the elements
+                        to fit; the others are held at their initial values.
+            epoch       time of the fitted elements (seconds).
+            body_gm     GM of the orbiting bodies, if not negligible.
+            tol         convergence tolerance on the step of each element,
+                        relative to the semimajor axis and absolute for the
+                        others, and on the relative reduction of the sum of
+                        squared residuals.
+            max_iters   upper limit on the number of iterations.
+            status      True to also return an integer array with one of
+                        STATUS_CONVERGED, STATUS_DIVERGED or STATUS_MAX_ITERS
+                        for each target. Otherwise, a single warning is issued
+                        if any target failed to converge.
+            diagnostics optional SolverDiagnostics object to be filled in with
+                        the iteration counts, the final step in a, the status
+                        and the timing of this call.
+
+        Return:         an array of shape (T,6) containing (a, e, i, mean
+                        longitude, longitude of pericenter, longitude of
+                        ascending node) at the epoch for each target, with e
+                        and i non-negative; or the tuple (elements, status) if
+                        status is True.
+        """
+
+        if (pos is None) == (radii is None):
+            raise ValueError('fit_geom() requires either pos or radii')
+        if radii is not None and longitudes is None:
+            raise ValueError('radii require longitudes')
+
+        observed = np.asfarray(pos if radii is None else radii)
+        targets = observed.shape[0]
+        shape = observed.shape[:2]
+        if (observed.ndim != (3 if radii is None else 2) or
+            (radii is None and observed.shape[2] != 3)):
+                raise ValueError('invalid shape for observations: ' +
+                                 str(observed.shape))
+
+        dt = np.broadcast_to(np.asfarray(times) - epoch, shape)
+        if radii is not None:
+            longitudes = np.broadcast_to(np.asfarray(longitudes), shape)
+
+        if weights is None:
+            weights = np.ones(shape)
+        weights = np.broadcast_to(np.asfarray(weights), shape)
+
+        # Missing observations must not propagate NaNs
+        missing = (weights == 0.)
+        if radii is None:
+            observed = np.where(missing[...,np.newaxis], 0., observed)
+        else:
+            observed = np.where(missing, 0., observed)
+            longitudes = np.where(missing, 0., longitudes)
+
+        if free is None:
+            free = (True,) * 6 if radii is None else \
+                   (True, True, False, False, True, False)
+        fixed = ~np.array(free, dtype='bool')
+
+        if guess is None:
+            params = self._fit_guess(dt, observed, longitudes, weights)
+        else:
+            params = np.array(guess, dtype='float')
+            if params.shape != (targets, 6):
+                raise ValueError('guess must have shape (%d,6)' % targets)
+
+        diagnostics = SolverDiagnostics._begin(diagnostics, 'fit_geom',
+                                               targets)
+
+        def evaluate(index, params):
+            lons = None if radii is None else longitudes[index]
+            (model, jac) = self._fit_model(params, dt[index], body_gm, lons)
+            sqrt_w = np.sqrt(weights[index])
+            if radii is None:
+                sqrt_w = sqrt_w[...,np.newaxis]
+
+            residuals = ((observed[index] - model) * sqrt_w).reshape(
+                                                            len(index), -1)
+            jac = (jac * sqrt_w[...,np.newaxis]).reshape(len(index), -1, 6)
+            jac[...,fixed] = 0.
+            return (residuals, jac)
+
+        everything = np.arange(targets)
+        (residuals, jac) = evaluate(everything, params)
+        cost = np.sum(residuals**2, axis=-1)
+        damping = np.full(targets, 1.e-3)
+
+        counts = np.zeros(targets, dtype='int')
+        steps = np.full(targets, np.nan)
+        codes = np.empty(targets, dtype='int8')
+        codes.fill(STATUS_MAX_ITERS)
+
+        if diagnostics is not None:
+            diagnostics._mark('setup')
+
+        # Current residuals, Jacobians and costs are kept for the active targets
+        active = everything
+        diagonal = np.arange(6)
+        for iter in range(max_iters):
+            normal = np.einsum('nmi,nmj->nij', jac, jac)
+            gradient = np.einsum('nmi,nm->ni', jac, residuals)
+
+            # Marquardt scaling by the diagonal, with a floor for elements that
+            # are momentarily undetermined, such as the pericenter when e = 0
+            scale = normal[:,diagonal,diagonal]
+            scale = np.maximum(scale, 1.e-12 * scale.max(axis=-1)[:,np.newaxis]
+                                      + 1.e-300)
+            scale[:,fixed] = 1.
+            normal[:,diagonal,diagonal] += damping[active,np.newaxis] * scale
+            normal[:,fixed,fixed] = 1.
+
+            step = np.linalg.solve(normal, gradient[...,np.newaxis])[...,0]
+            trial = params[active] + step
+
+            (trial_residuals, trial_jac) = evaluate(active, trial)
+            trial_cost = np.sum(trial_residuals**2, axis=-1)
+            counts[active] += 1
+
+            # Accept the steps that reduce the cost; damp the others
+            old_cost = cost[active]
+            accept = trial_cost <= old_cost
+            params[active[accept]] = trial[accept]
+            residuals[accept] = trial_residuals[accept]
+            jac[accept] = trial_jac[accept]
+            cost[active[accept]] = trial_cost[accept]
+            damping[active] = np.where(accept, damping[active] / 10.,
+                                               damping[active] * 10.)
+            damping[active] = np.maximum(damping[active], 1.e-12)
+            steps[active] = np.abs(step[:,0])
+
+            # A target has converged when its step is negligible, even if the
+            # step was rejected because of rounding error, or when an accepted
+            # step no longer reduces the cost appreciably
+            limit = tol * np.maximum(np.abs(params[active]), 1.)
+            converged = (np.all(np.abs(step) <= limit, axis=-1) |
+                         (accept & (old_cost - trial_cost <= tol * old_cost)))
+            diverged = ~converged & (damping[active] > 1.e16)
+            codes[active[converged]] = STATUS_CONVERGED
+            codes[active[diverged]] = STATUS_DIVERGED
+
+            keep = ~(converged | diverged)
+            active = active[keep]
+            residuals = residuals[keep]
+            jac = jac[keep]
+            if active.size == 0: break
+
+        if diagnostics is not None:
+            diagnostics._mark('iterate')
+            diagnostics._finish(counts, steps, codes.copy())
+
+        if not status:
+            failures = np.sum(codes != STATUS_CONVERGED)
+            if failures:
+                warnings.warn('fit_geom() did not converge for ' +
+                              str(failures) + ' of ' + str(targets) +
+                              ' targets', RuntimeWarning)
+
+        # Remove the sign ambiguities of e and i
+        flip = params[:,1] < 0.
+        params[flip,1] *= -1.
+        params[flip,4] += np.pi
+        flip = params[:,2] < 0.
+        params[flip,2] *= -1.
+        params[flip,5] += np.pi
+        params[:,3:] %= TWOPI
+
+        if status:
+            return (params, codes)
+
+        return params
 
     ####################################
     # Internal methods
     ####################################
 
+    def _fit_rates(self, a, e, inc, body_gm=0.):
+        """Internal method for fit_geom() to return the rates of the mean
+        longitude, pericenter and node, and the partial derivatives of each
+        with respect to a, e and i. As in state_from_geom(), the rates are
+        those of GM + body_gm."""
+
+        gravity = self.with_gm(self.gm + body_gm) if body_gm else self
+        j2 = gravity.jn[0] if len(gravity.jn) else 0.
+        scale = np.sqrt(gravity.gm / a**3) * gravity.r2 / a**2
+
+        sin_i = np.sin(inc)
+        result = []
+        for factors in ((1,0,0), (1,-1,0), (1,0,-1)):
+            rate = gravity.combo(a, factors, e, sin_i)
+            drate_da = gravity.dcombo_da(a, factors, e, sin_i)
+            (dterm_de, dterm_dsin_i) = _ei_partials(j2, factors, e, sin_i)
+            drate_de = scale * dterm_de
+            drate_di = scale * dterm_dsin_i * np.cos(inc)
+            result.append((rate, (drate_da, drate_de, drate_di)))
+
+        return result
+
+    def _fit_model(self, params, dt, body_gm, longitudes=None):
+        """Internal method for fit_geom() to return the modeled observations
+        and their partial derivatives with respect to the elements at the
+        epoch.
+
+        Input:
+            params      elements at the epoch, shape (N,6).
+            dt          times since the epoch, shape (N,K).
+            body_gm     GM of the orbiting bodies.
+            longitudes  inertial longitudes of observed radii, shape (N,K); if
+                        None, positions are modeled.
+
+        Return:         (model, jac), where model has shape (N,K,3) for
+                        positions or (N,K) for radii and jac has an additional
+                        trailing axis of six.
+        """
+
+        (a, e, inc, lam, peri, node) = [params[:,k,np.newaxis]
+                                        for k in range(6)]
+        rates = self._fit_rates(a, e, inc, body_gm)
+        elements = [np.broadcast_to(x, dt.shape) for x in (a, e, inc)]
+        elements += [x + rate[0] * dt
+                     for (x, rate) in zip((lam, peri, node), rates)]
+
+        if longitudes is None:
+            (pos, vel, jac) = self.state_from_geom(elements, body_gm,
+                                                   jacobian=True)
+            model = pos
+            jac = jac[...,:3,:]
+
+        else:
+            # Solve for the mean longitude that lies at each observed longitude,
+            # using the first-order slope dL/dlambda = 1 + 2e cos(lambda - peri)
+            target = longitudes
+            elements[3] = target.copy()
+            for iter in range(20):
+                (pos, vel) = self.state_from_geom(elements, body_gm)
+                error = (np.arctan2(pos[...,1], pos[...,0]) - target
+                         + np.pi) % TWOPI - np.pi
+                elements[3] -= error / (1. + 2. * elements[1] *
+                                        np.cos(elements[3] - elements[4]))
+                if np.all(np.abs(error) < 1.e-14): break
+
+            (pos, vel, jac) = self.state_from_geom(elements, body_gm,
+                                                   jacobian=True)
+            (x, y) = (pos[...,0,np.newaxis], pos[...,1,np.newaxis])
+            (jx, jy) = (jac[...,0,:], jac[...,1,:])
+            rho2 = x**2 + y**2
+            rho = np.sqrt(rho2)
+
+            # Derivatives of the radius at fixed longitude
+            drho = (x * jx + y * jy) / rho
+            dlong = (x * jy - y * jx) / rho2
+            jac = drho - drho[...,3:4] * dlong / dlong[...,3:4]
+            jac[...,3] = 0.
+            model = rho[...,0]
+            rates[0] = (0., (0., 0., 0.))
+
+        # Chain rule from the elements at each time back to the epoch
+        expand = (lambda x: x) if longitudes is not None else \
+                 (lambda x: x[...,np.newaxis])
+        jac = jac.copy()
+        for (k, (rate, partials)) in enumerate(rates):
+            for (column, partial) in enumerate(partials):
+                if np.any(partial):
+                    jac[...,column] += jac[...,3+k] * expand(partial * dt)
+
+        return (model, jac)
+
+    def _fit_guess(self, dt, observed, longitudes, weights):
+        """Internal method for fit_geom() to estimate the initial elements of
+        every target from its observations."""
+
+        targets = dt.shape[0]
+        valid = weights > 0.
+        guess = np.zeros((targets, 6))
+
+        if longitudes is None:
+            radii = np.hypot(observed[...,0], observed[...,1])
+            theta = np.arctan2(observed[...,1], observed[...,0])
+        else:
+            radii = observed
+            theta = longitudes
+
+        total = np.sum(weights, axis=1)
+        mean_radius = np.sum(weights * radii, axis=1) / total
+        guess[:,0] = mean_radius
+
+        if longitudes is None:
+            # The mean radius gives a first mean motion. The longitudes relative
+            # to it then drift slowly, so they can be unwrapped in time order
+            # and fitted by a line to refine the mean motion. Missing
+            # observations are moved to the end.
+            n0 = self.omega(mean_radius)[:,np.newaxis]
+            order = np.argsort(np.where(valid, dt, np.inf), axis=1)
+            t = np.take_along_axis(dt, order, axis=1)
+            w = np.take_along_axis(weights, order, axis=1)
+            phase = np.take_along_axis(theta - n0 * dt, order, axis=1)
+            phase = np.unwrap(np.where(w > 0., phase, 0.), axis=1)
+            t = np.where(w > 0., t, 0.)
+
+            s_t = np.sum(w * t, axis=1)
+            s_p = np.sum(w * phase, axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dn = ((total * np.sum(w * t * phase, axis=1) - s_t * s_p) /
+                      (total * np.sum(w * t * t, axis=1) - s_t**2))
+            dn = np.where(np.isfinite(dn), dn, 0.)
+
+            a = self.solve_a(n0[:,0] + dn)
+            a = np.where(np.isfinite(a), a, mean_radius)
+            guess[:,0] = a
+            guess[:,3] = (s_p - dn * s_t) / total
+
+            # Inclination and node from the largest height
+            z = np.where(valid, observed[...,2], 0.)
+            top = np.argmax(np.abs(z), axis=1)
+            z_top = z[np.arange(targets), top]
+            guess[:,2] = np.arcsin(np.clip(np.abs(z_top) / a, 0., 1.))
+            guess[:,5] = theta[np.arange(targets), top] - \
+                         np.where(z_top >= 0., np.pi/2., -np.pi/2.)
+
+        # Eccentricity and pericenter from the range of radii
+        low = np.argmin(np.where(valid, radii, np.inf), axis=1)
+        high = np.max(np.where(valid, radii, -np.inf), axis=1)
+        r_low = radii[np.arange(targets), low]
+        guess[:,1] = (high - r_low) / (high + r_low)
+        guess[:,4] = theta[np.arange(targets), low]
+
+        return guess
+
+    @staticmethod
+    def _state_buffers(shape, out, dtype='float64'):
+        """Internal method to return the (pos, vel) arrays of shape
+        shape + (3,) that will receive a state vector."""
+
+        if out is None:
+            return (np.empty(shape + (3,), dtype=dtype),
+                    np.empty(shape + (3,), dtype=dtype))
+
+        (pos, vel) = out[:2]
+        for array in (pos, vel):
+            if array.shape != shape + (3,):
+                raise ValueError('output array shape %s does not match %s' %
+                                 (str(array.shape), str(shape + (3,))))
+
+        return (pos, vel)
+
+    @staticmethod
+    def _jacobian_buffer(shape, out, jacobian):
+        """Internal method to return the array of shape shape + (6,6) that will
+        receive a Jacobian, or None if jacobian is False."""
+
+        if not jacobian:
+            return None
+
+        if out is None or len(out) < 3:
+            return np.empty(shape + (6,6))
+
+        if out[2].shape != shape + (6,6):
+            raise ValueError('output array shape %s does not match %s' %
+                             (str(out[2].shape), str(shape + (6,6))))
+
+        return out[2]
+
+    @staticmethod
+    def _store_elements(elements, shape, out):
+        """Internal method to return a tuple of six orbital elements, copying
+        them into the columns of out if it is provided. Otherwise, shapeless
+        arrays are converted to scalars."""
+
+        if out is None:
+            return tuple(element[()] if isinstance(element, np.ndarray) and
+                                        element.shape == () else element
+                         for element in elements)
+
+        if out.shape != shape + (6,):
+            raise ValueError('output array shape %s does not match %s' %
+                             (str(out.shape), str(shape + (6,))))
+
+        columns = tuple(out[...,k] for k in range(6))
+        for (column, element) in zip(columns, elements):
+            column[...] = element
+
+        return columns
+
     # Take the geometric osculating elements and create frequencies
     # Returns n, kappa, nu, eta2, chi2, alpha1, alpha2, alphasq
     # From Renner & Sicardy (2006)  EQ 14-21
@@ -900,10 +3407,1459 @@ class Gravity():
         return (a, e, inc, long_peri, long_node, lam,
                 rc, Lc, zc, rdotc, Ldotc, zdotc)
 
+    @staticmethod
+    def _solve_kepler(mean_anomaly, e, tol, max_iters):
+        """Internal method to solve Kepler's equation for the eccentric anomaly,
+        given 1-D arrays of mean anomaly in [-pi,pi) and eccentricity in [0,1).
+
+        Each iteration is the same fourth-order correction used in
+        state_from_osc(), applied only to the elements not yet converged. The
+        starting value is from Danby (1987), which converges for all e < 1.
+        """
+
+        cape = mean_anomaly + 0.85 * e * np.sign(np.sin(mean_anomaly))
+
+        active = np.arange(cape.size)
+        for iter in range(max_iters):
+            x = cape[active]
+            ea = e[active]
+            es = ea*np.sin(x)
+            ec = ea*np.cos(x)
+            f = x - es - mean_anomaly[active]
+            fp = 1. - ec
+            dx = -f/fp
+            dx = -f/(fp + dx*es/2.)
+            dx = -f/(fp + dx*es/2. + dx*dx*ec/6.)
+            cape[active] = x + dx
+
+            # NaNs compare False and are dropped too
+            active = active[np.abs(dx) > tol]
+            if active.size == 0: break
+
+        return cape
+
+    @staticmethod
+    def _one_minus(x, y, dtype):
+        """Internal method to return 1 - x*y in the given dtype. The product of
+        two single-precision values is exact in double precision, so the
+        difference stays accurate where it cancels."""
+
+        return (1. - np.multiply(x, y, dtype='float64')).astype(dtype,
+                                                                copy=False)
+
     # A nicer version of arctan2
     @staticmethod
     def _pos_arctan2(y, x):
-        return np.arctan2(y, x) % TWOPI 
+        return np.arctan2(y, x) % TWOPI
+
+def _convert_shared(task):
+    """Worker for Gravity.convert_parallel(). It converts one range of rows
+    from the shared source block, writing them into either the shared result
+    block or the memory-mapped output file, and returns their status codes."""
+
+    from multiprocessing import shared_memory
+
+    (gravity, conversion, source_name, target, rows, start, stop,
+     options) = task
+
+    source_memory = shared_memory.SharedMemory(name=source_name)
+    result_memory = None
+    try:
+        source = np.ndarray((rows, 6), buffer=source_memory.buf)
+        if target[0] == 'memory':
+            result_memory = shared_memory.SharedMemory(name=target[1])
+            result = np.ndarray((rows, 6),
+                                buffer=result_memory.buf)[start:stop]
+        else:
+            result = np.memmap(target[1], dtype='float64', mode='r+',
+                               offset=target[2] + start * 48,
+                               shape=(stop - start, 6))
+
+        chunks = gravity.convert_chunks(conversion, source[start:stop],
+                                        chunk_size=stop - start, out=result,
+                                        status=True, **options)
+        for (_, chunk, codes) in chunks:
+            pass
+
+        if target[0] == 'file':
+            result.flush()
+        del source, result, chunk, chunks
+    finally:
+        source_memory.close()
+        if result_memory is not None:
+            result_memory.close()
+
+    return codes
+
+class _SharedBlock(object):
+    """Owner of the shared memory block behind the array returned by
+    Gravity.convert_parallel(). The array refers to this object through the
+    array interface, so the block stays open until the last array that uses
+    it is released."""
+
+    def __init__(self, memory, shape):
+        self._memory = memory
+        self._array = np.ndarray(shape, buffer=memory.buf)
+
+    @property
+    def __array_interface__(self):
+        return self._array.__array_interface__
+
+    def __del__(self):
+        self._array = None
+        self._memory.close()
+
+def _memmap_location(array):
+    """Return the tuple (filename, offset) locating the data of a C-contiguous
+    array memory-mapped for writing to its file, or None if the array is not
+    one. Copy-on-write maps do not qualify, as they never reach the file."""
+
+    if not (isinstance(array, np.memmap) and array.filename
+            and array.mode in ('r+', 'w+') and array.flags.c_contiguous):
+        return None
+
+    # Views keep the offset of the original map, which starts on a multiple
+    # of the allocation granularity; find where this view begins inside it
+    base = array
+    while base is not None and not isinstance(base, mmap.mmap):
+        base = base.base
+    if base is None:
+        return None
+
+    begin = np.frombuffer(base, dtype='uint8').ctypes.data
+    start = array.offset - array.offset % mmap.ALLOCATIONGRANULARITY
+    return (array.filename, start + array.ctypes.data - begin)
+
+################################################################################
+# Forward-mode derivatives
+################################################################################
+
+class _Jet(object):
+    """A value together with its partial derivatives with respect to a set of
+    independent variables, which are propagated by the arithmetic operators
+    and by np.sin, np.cos and np.sqrt. The derivatives are a dictionary keyed
+    by the index of the variable, so variables that do not affect a quantity
+    cost nothing. Used by Gravity.state_from_geom() to obtain its Jacobian in
+    the same pass as the state."""
+
+    __slots__ = ('value', 'deriv')
+
+    def __init__(self, value, deriv):
+        self.value = value
+        self.deriv = deriv
+
+    @staticmethod
+    def _parts(x):
+        if isinstance(x, _Jet):
+            return (x.value, x.deriv)
+        return (x, {})
+
+    @staticmethod
+    def _add(x, y, sign=1.):
+        (xv, xd) = _Jet._parts(x)
+        (yv, yd) = _Jet._parts(y)
+
+        deriv = dict(xd)
+        for (k, d) in yd.items():
+            d = d if sign > 0 else -d
+            deriv[k] = deriv[k] + d if k in deriv else d
+
+        return _Jet(xv + sign * yv, deriv)
+
+    @staticmethod
+    def _multiply(x, y):
+        (xv, xd) = _Jet._parts(x)
+        (yv, yd) = _Jet._parts(y)
+
+        deriv = dict((k, d * yv) for (k, d) in xd.items())
+        for (k, d) in yd.items():
+            deriv[k] = deriv[k] + d * xv if k in deriv else d * xv
+
+        return _Jet(xv * yv, deriv)
+
+    @staticmethod
+    def _divide(x, y):
+        (xv, xd) = _Jet._parts(x)
+        (yv, yd) = _Jet._parts(y)
+
+        value = xv / yv
+        deriv = dict((k, d / yv) for (k, d) in xd.items())
+        for (k, d) in yd.items():
+            d = -d * value / yv
+            deriv[k] = deriv[k] + d if k in deriv else d
+
+        return _Jet(value, deriv)
+
+    def _chain(self, value, slope):
+        return _Jet(value, dict((k, d * slope)
+                                for (k, d) in self.deriv.items()))
+
+    def __add__(self, other):      return _Jet._add(self, other)
+    def __radd__(self, other):     return _Jet._add(other, self)
+    def __sub__(self, other):      return _Jet._add(self, other, -1.)
+    def __rsub__(self, other):     return _Jet._add(other, self, -1.)
+    def __mul__(self, other):      return _Jet._multiply(self, other)
+    def __rmul__(self, other):     return _Jet._multiply(other, self)
+    def __truediv__(self, other):  return _Jet._divide(self, other)
+    def __rtruediv__(self, other): return _Jet._divide(other, self)
+    def __neg__(self):             return self._chain(-self.value, -1.)
+
+    def __pow__(self, power):
+        return self._chain(self.value**power,
+                           power * self.value**(power - 1))
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != '__call__' or kwargs:
+            return NotImplemented
+
+        if ufunc is np.add:
+            return _Jet._add(*inputs)
+        if ufunc is np.subtract:
+            return _Jet._add(inputs[0], inputs[1], -1.)
+        if ufunc is np.multiply:
+            return _Jet._multiply(*inputs)
+        if ufunc is np.true_divide:
+            return _Jet._divide(*inputs)
+
+        (x,) = inputs
+        if ufunc is np.sin:
+            return x._chain(np.sin(x.value), np.cos(x.value))
+        if ufunc is np.cos:
+            return x._chain(np.cos(x.value), -np.sin(x.value))
+        if ufunc is np.sqrt:
+            value = np.sqrt(x.value)
+            return x._chain(value, 0.5 / value)
+        if ufunc is np.negative:
+            return -x
+
+        return NotImplemented
+
+################################################################################
+# Frequency tables
+################################################################################
+
+class FrequencyTable():
+    """An interpolation table for the frequencies of a Gravity object over a
+    fixed range of semimajor axes.
+
+    The table stores four dimensionless functions of u = log(a) on a uniform
+    grid. With s = sqrt(GM/a^3) and x = (Rp/a)^2, they are
+        W = (omega - s) / (s x)
+        K = (kappa - s) / (s x)
+        V = (nu    - s) / (s x)
+        Q = (2 omega - kappa - nu) / (s x^2)
+    Each one is nearly constant, and each is evaluated from the same
+    cancellation-free expressions as Gravity.combo(). Lookups use four-point
+    Lagrange interpolation, so their cost does not depend on the number of
+    J-terms. Because the cancelled differences are tabulated directly, combo()
+    retains full relative precision for factors such as (1,-1,0) and (2,-1,-1).
+    """
+
+    MAX_INTERVALS = 2**22
+
+    def __init__(self, gravity, a_min, a_max, rel_error=1.e-12):
+        """The constructor for a FrequencyTable object.
+
+        Input:
+            gravity     the Gravity object to tabulate.
+            a_min       lower limit on semimajor axis.
+            a_max       upper limit on semimajor axis.
+            rel_error   upper limit on the relative error of each tabulated
+                        function. The grid is refined until this limit is met
+                        at the midpoints of every interval.
+        """
+
+        if not (0. < a_min < a_max):
+            raise ValueError('invalid semimajor axis range for FrequencyTable')
+
+        self.gravity = gravity
+        self.a_min = float(a_min)
+        self.a_max = float(a_max)
+        self.rel_error = rel_error
+
+        self.j2 = gravity.jn[0] if len(gravity.jn) else 0.
+        self.u0 = np.log(self.a_min)
+        span = np.log(self.a_max) - self.u0
+
+        intervals = 16
+        while True:
+            self.intervals = intervals
+            self.du = span / intervals
+            values = self._exact(self.u0 + self.du * np.arange(intervals + 1))
+            if not np.all(np.isfinite(values)):
+                raise ValueError('frequencies are undefined inside the ' +
+                                 'FrequencyTable range')
+
+            self.coeffs = self._coefficients(values)
+
+            u_mid = self.u0 + self.du * (np.arange(intervals) + 0.5)
+            exact = self._exact(u_mid)
+            approx = np.array([self._interpolate(u_mid, c)[0]
+                               for c in self.coeffs])
+            if np.all(np.abs(approx - exact) <= rel_error * np.abs(exact)):
+                break
+
+            intervals *= 2
+            if intervals > FrequencyTable.MAX_INTERVALS:
+                raise ValueError('FrequencyTable could not meet relative ' +
+                                 'error %e' % rel_error)
+
+    def _exact(self, u):
+        """Internal method to evaluate the tabulated functions W, K, V and Q
+        at the given values of log(a). Returns an array of shape (4,) + u.shape.
+        """
+
+        x = self.gravity.r2 * np.exp(-2. * u)
+
+        # (omega - s)/s = sqrt(1 + x w) - 1 = x w / (sqrt(1 + x w) + 1), where
+        # x w is the series of Gravity._jseries(). A frequency is undefined
+        # where its series falls below -1; the constructor rejects the NaN.
+        series = [Gravity._jseries(coefficients, x) for coefficients in
+                  (self.gravity.omega_jn, self.gravity.kappa_jn,
+                   self.gravity.nu_jn)]
+        with np.errstate(invalid='ignore'):
+            (w, k, v) = [xw / (x * (np.sqrt(1. + xw) + 1.)) for xw in series]
+
+        # See Gravity.combo() for this second-order reformulation
+        q = (v - w) * (v - k) / (2. + x * (w + k))
+
+        return np.array([w, k, v, q])
+
+    def _coefficients(self, values):
+        """Internal method to convert tabulated values into the coefficients
+        of a cubic polynomial for each interval. Each cubic passes through the
+        four nearest nodes. Returns an array of shape (rows, 4, intervals),
+        with coefficients in order of increasing power."""
+
+        j = np.arange(self.intervals)
+        start = np.clip(j - 1, 0, self.intervals - 3)
+        d = j - start               # offset of the interval inside its stencil
+
+        (y0, y1, y2, y3) = [values[:, start + k] for k in range(4)]
+
+        # Forward differences define the cubic in the stencil's coordinate;
+        # expand it about the beginning of the interval instead.
+        d1 = y1 - y0
+        d2 = y2 - 2. * y1 + y0
+        d3 = y3 - 3. * y2 + 3. * y1 - y0
+
+        c0 = y0 + d * (d1 + (d - 1.) * (d2 / 2. + (d - 2.) * d3 / 6.))
+        c1 = d1 + d2 * (2.*d - 1.) / 2. + d3 * (3.*d*d - 6.*d + 2.) / 6.
+        c2 = d2 / 2. + d3 * (d - 1.) / 2.
+        c3 = d3 / 6.
+
+        return np.stack([c0, c1, c2, c3], axis=1)
+
+    def _interpolate(self, u, coeffs, derivs=False):
+        """Internal method to interpolate a tabulated function at the given
+        values of log(a).
+
+        Input:
+            u           log(a).
+            coeffs      polynomial coefficients, shape (4, intervals). Because
+                        interpolation is linear, this can be any linear
+                        combination of the rows of self.coeffs.
+            derivs      True to return the derivative with respect to log(a) as
+                        well.
+
+        Return:         (value, derivative); derivative is None if derivs is
+                        False.
+        """
+
+        # u >= u0 apart from roundoff, so truncation is the same as floor
+        t = (u - self.u0) / self.du
+        j = np.minimum(np.asarray(t).astype(np.intp), self.intervals - 1)
+        t = t - j
+
+        (c0, c1, c2, c3) = [np.take(c, j) for c in coeffs]
+
+        if derivs:
+            dvalue = ((3. * c3 * t + 2. * c2) * t + c1) / self.du
+        else:
+            dvalue = None
+
+        value = c3 * t
+        value += c2
+        value *= t
+        value += c1
+        value *= t
+        value += c0
+
+        return (value, dvalue)
+
+    def _prepare(self, a):
+        """Internal method to check the range of a and to return a, log(a),
+        sqrt(GM/a^3) and (Rp/a)^2."""
+
+        a = np.asfarray(a)
+        if np.any(a < self.a_min * (1. - 1.e-12)) or \
+           np.any(a > self.a_max * (1. + 1.e-12)):
+                raise ValueError('semimajor axis is outside the ' +
+                                 'FrequencyTable range')
+
+        a2 = a * a
+        return (a, np.log(a), np.sqrt(self.gravity.gm / (a * a2)),
+                self.gravity.r2 / a2)
+
+    def _lookup(self, a, row, name, e, sin_i):
+        """Internal method for omega(), kappa() and nu()."""
+
+        (coefft_e, coefft_i) = _EI_CORRECTIONS[name]
+        (a, u, s, x) = self._prepare(a)
+        value = self._interpolate(u, self.coeffs[row])[0]
+        result = s * (1. + x * value)
+
+        if self.j2 and (np.any(e) or np.any(sin_i)):
+            result += s * x * self.j2 * (coefft_e * e**2 + coefft_i * sin_i**2)
+
+        return result
+
+    def omega(self, a, e=0., sin_i=0.):
+        """Returns the mean motion (radians/s) at semimajor axis a."""
+
+        return self._lookup(a, 0, 'omega', e, sin_i)
+
+    def kappa(self, a, e=0., sin_i=0.):
+        """Returns the radial oscillation frequency (radians/s) at semimajor
+        axis a."""
+
+        return self._lookup(a, 1, 'kappa', e, sin_i)
+
+    def nu(self, a, e=0., sin_i=0.):
+        """Returns the vertical oscillation frequency (radians/s) at semimajor
+        axis a."""
+
+        return self._lookup(a, 2, 'nu', e, sin_i)
+
+    def _combo(self, a, factors, e, sin_i, derivs):
+        """Internal method for combo() and dcombo_da()."""
+
+        (a, u, s, x) = self._prepare(a)
+        (f0, f1, f2) = factors
+        sum_factors = f0 + f1 + f2
+
+        # Work with C = combo / sqrt(GM/a^3) and dC/du, u = log(a)
+        if sum_factors == 0 and f1 == f2:
+            (q, dq) = self._interpolate(u, -f1 * self.coeffs[3], derivs)
+            x2 = x * x
+            c = x2 * q
+            if derivs:
+                dc = x2 * (dq - 4. * q)
+        else:
+            coeffs = (f0 * self.coeffs[0] + f1 * self.coeffs[1] +
+                      f2 * self.coeffs[2])
+            (g, dg) = self._interpolate(u, coeffs, derivs)
+            c = sum_factors + x * g
+            if derivs:
+                dc = x * (dg - 2. * g)
+
+        # Second-order corrections for e and sin(i), combined before evaluation
+        # so that cancelling factors cancel exactly.
+        if self.j2 and (np.any(e) or np.any(sin_i)):
+            (coefft_e, coefft_i) = _ei_coefficients(factors)
+            corr = x * self.j2 * (coefft_e * e**2 + coefft_i * sin_i**2)
+            c = c + corr
+            if derivs:
+                dc = dc - 2. * corr
+
+        if not derivs:
+            return s * c
+
+        # d(s C)/da = s (dC/du - 1.5 C) / a
+        return s * (dc - 1.5 * c) / a
+
+    def combo(self, a, factors, e=0., sin_i=0.):
+        """Returns a frequency combination, based on given coefficients for
+        omega, kappa and nu. As with Gravity.combo(), full numeric precision is
+        preserved in the limit of first- or second-order cancellation of the
+        coefficients."""
+
+        return self._combo(a, factors, e, sin_i, derivs=False)
+
+    def dcombo_da(self, a, factors, e=0., sin_i=0.):
+        """Returns the radial derivative of a frequency combination, based on
+        given coefficients for omega, kappa and nu.
+
+        This is the derivative of the interpolant, so its relative error is
+        somewhat larger than the table's rel_error. It is still far more
+        accurate than Newton's method requires.
+        """
+
+        return self._combo(a, factors, e, sin_i, derivs=True)
+
+################################################################################
+# Single precision
+################################################################################
+
+# Unit roundoff of single precision
+_FLOAT32_ROUNDOFF = float(np.finfo('float32').eps) / 2.
+
+class SinglePrecision(object):
+    """A view of a Gravity object that evaluates the frequency methods and the
+    state vectors in single precision, for uses such as visualization where
+    memory bandwidth matters more than the last digits.
+
+    Results are float32 arrays. Where single precision would lose accuracy to
+    cancellation, the work is rearranged or done in double precision: combo()
+    sums differences from sqrt(GM/a^3) as Gravity.combo() does, angles are
+    reduced to [0, 2 pi) before conversion, and the factors 1 - e cos(E) and
+    1 - e^2 in state_from_osc() are formed in double precision. The inverse
+    conversions osc_from_state() and geom_from_state() cancel at nearly every
+    step, so they run in double precision and return float32 results.
+
+    Every method accepts error=True to also return an absolute bound on the
+    rounding error of each result. The bounds are derived from the number of
+    rounding operations and the magnitudes of the intermediate terms, and
+    include the rounding of the inputs to single precision. They describe the
+    arithmetic only, not the truncation of the series expansions themselves.
+    """
+
+    def __init__(self, gravity):
+        """The constructor for a SinglePrecision object.
+
+        Input:
+            gravity     the Gravity object to evaluate.
+        """
+
+        self.gravity = gravity
+        self.gm = np.float32(gravity.gm)
+        self.r2 = np.float32(gravity.r2)
+        self.j2 = np.float32(gravity.jn[0] if gravity.jn else 0.)
+        for name in ('omega_jn', 'kappa_jn', 'nu_jn',
+                     'domega_jn', 'dkappa_jn', 'dnu_jn'):
+            setattr(self, name, getattr(gravity, name).astype('float32'))
+
+        # Relative rounding error of one frequency, in units of the roundoff
+        self._rounds = 2 * len(gravity.jn) + 12
+
+    def __repr__(self):
+        return 'SinglePrecision(%r)' % (self.gravity,)
+
+    ####################################
+    # Internal methods
+    ####################################
+
+    def _powers(self, a):
+        """Internal method to return a, a^2, GM/a^3 and (Rp/a)^2 in single
+        precision."""
+
+        a = np.asarray(a, dtype='float32')
+        a2 = a * a
+        return (a, a2, self.gm / (a * a2), self.r2 / a2)
+
+    def _jsums(self, name, ratio2):
+        """Internal method to return the series of the named coefficients, and
+        the same series with the absolute values of the coefficients. The
+        latter bounds the terms that can cancel within the former."""
+
+        coefficients = getattr(self, name)
+        return (Gravity._jseries(coefficients, ratio2),
+                Gravity._jseries(np.abs(coefficients), ratio2))
+
+    def _corrections(self, e, sin_i):
+        """Internal method to return e^2 and sin(i)^2 in single precision, or
+        None if there are no corrections."""
+
+        if not len(self.gravity.jn) or not (np.any(e) or np.any(sin_i)):
+            return None
+
+        e = np.asarray(e, dtype='float32')
+        sin_i = np.asarray(sin_i, dtype='float32')
+        return (e * e, sin_i * sin_i)
+
+    def _frequency(self, name, a, e, sin_i, error):
+        """Internal method to return omega, kappa or nu, with its error bound
+        if requested."""
+
+        (a, a2, gm_a3, ratio2) = self._powers(a)
+        (jsum, jsize) = self._jsums(name + '_jn', ratio2)
+        value = np.sqrt(gm_a3 * (1. + jsum))
+
+        # The square is the sum of terms that can cancel, so its error scales
+        # with their absolute values and the square root halves it. The
+        # rounding of a and of the root itself scale with the value.
+        magnitude = value + gm_a3 * (1. + jsize) / (2. * value)
+
+        squares = self._corrections(e, sin_i)
+        if squares is not None:
+            (ce, ci) = _EI_CORRECTIONS[name]
+            scale = np.sqrt(gm_a3) * ratio2 * self.j2
+            value = value + scale * (ce * squares[0] + ci * squares[1])
+            magnitude = magnitude + np.abs(scale) * (abs(ce) * squares[0] +
+                                                     abs(ci) * squares[1])
+
+        if not error:
+            return value
+
+        return (value, np.float32(self._rounds * _FLOAT32_ROUNDOFF) * magnitude)
+
+    def _derivative(self, name, a, squares):
+        """Internal method to return the radial derivative of omega, kappa or
+        nu and the magnitude of its terms."""
+
+        (a, a2, gm_a3, ratio2) = self._powers(a)
+        (jsum, jsize) = self._jsums(name + '_jn', ratio2)
+        (dsum, dsize) = self._jsums('d' + name + '_jn', ratio2)
+        freq = np.sqrt(gm_a3 * (1. + jsum))
+        freq_size = gm_a3 * (1. + jsize) / (2. * freq)
+
+        value = gm_a3 / a * (-3. + dsum) / (2. * freq)
+
+        # Terms of the derivative of the square, plus the error of the
+        # frequency in the denominator
+        magnitude = (gm_a3 / a * (3. + dsize) / (2. * freq) +
+                     np.abs(value) * freq_size / freq)
+
+        if squares is not None:
+            (ce, ci) = _EI_CORRECTIONS[name]
+            scale = -3.5 / a * np.sqrt(gm_a3) * ratio2 * self.j2
+            value = value + scale * (ce * squares[0] + ci * squares[1])
+            magnitude = magnitude + np.abs(scale) * (abs(ce) * squares[0] +
+                                                     abs(ci) * squares[1])
+
+        return (value, magnitude)
+
+    @staticmethod
+    def _angle(angle):
+        """Internal method to reduce an angle to [0, 2 pi) in double precision
+        and return it in single precision."""
+
+        return (np.asfarray(angle) % TWOPI).astype('float32')
+
+    ####################################
+    # Frequencies
+    ####################################
+
+    def omega(self, a, e=0., sin_i=0., error=False):
+        """Returns the mean motion (radians/s) at semimajor axis a, followed by
+        its error bound if error is True."""
+
+        return self._frequency('omega', a, e, sin_i, error)
+
+    def kappa(self, a, e=0., sin_i=0., error=False):
+        """Returns the radial oscillation frequency (radians/s) at semimajor
+        axis a, followed by its error bound if error is True."""
+
+        return self._frequency('kappa', a, e, sin_i, error)
+
+    def nu(self, a, e=0., sin_i=0., error=False):
+        """Returns the vertical oscillation frequency (radians/s) at semimajor
+        axis a, followed by its error bound if error is True."""
+
+        return self._frequency('nu', a, e, sin_i, error)
+
+    def combo(self, a, factors, e=0., sin_i=0., error=False):
+        """Returns a frequency combination, based on given coefficients for
+        omega, kappa and nu, followed by its error bound if error is True.
+
+        As in Gravity.combo(), the values are summed as differences from
+        sqrt(GM/a^3), with a second-order reformulation where the factors
+        cancel to second order, so the error bound stays proportional to the
+        result rather than to the individual frequencies.
+        """
+
+        (f0, f1, f2) = [np.asarray(f, dtype='float32') for f in factors]
+        (a, a2, gm_a3, ratio2) = self._powers(a)
+        sqrt_gm_a3 = np.sqrt(gm_a3)
+
+        # Each difference from sqrt(GM/a^3) has the magnitude of the absolute
+        # series terms, plus the error of the frequency in its denominator
+        diffs = []
+        sizes = []
+        freqs = []
+        freq_sizes = []
+        for name in ('omega', 'kappa', 'nu'):
+            (jsum, jsize) = self._jsums(name + '_jn', ratio2)
+            freq = np.sqrt(gm_a3 * (1. + jsum))
+            freq_size = gm_a3 * (1. + jsize) / (2. * freq)
+            diff = gm_a3 * jsum / (freq + sqrt_gm_a3)
+            diffs.append(diff)
+            sizes.append((gm_a3 * jsize + np.abs(diff) * freq_size) /
+                         (freq + sqrt_gm_a3))
+            freqs.append(freq)
+            freq_sizes.append(freq_size)
+
+        (omega_diff, kappa_diff, nu_diff) = diffs
+        (omega_size, kappa_size, nu_size) = sizes
+        sum_factors = f0 + f1 + f2
+        value = (sum_factors * sqrt_gm_a3 + f0 * omega_diff +
+                 f1 * kappa_diff + f2 * nu_diff)
+        magnitude = (np.abs(sum_factors) * sqrt_gm_a3 +
+                     np.abs(f0) * omega_size +
+                     np.abs(f1) * kappa_size +
+                     np.abs(f2) * nu_size)
+
+        second_order = (sum_factors == 0) & (f1 == f2)
+        if np.any(second_order):
+            denom = freqs[0] + freqs[1]
+            second = -f1 * ((nu_diff - omega_diff) *
+                            (nu_diff - kappa_diff) / denom)
+            value = np.where(second_order, second, value)
+            magnitude = np.where(second_order,
+                                 (np.abs(f1) * (nu_size + omega_size) *
+                                               (nu_size + kappa_size) +
+                                  np.abs(second) * (freq_sizes[0] +
+                                                    freq_sizes[1])) / denom,
+                                 magnitude)
+
+        squares = self._corrections(e, sin_i)
+        if squares is not None:
+            scale = sqrt_gm_a3 * ratio2 * self.j2
+            (ce, ci) = _ei_coefficients((f0, f1, f2))
+            value = value + scale * (ce * squares[0] + ci * squares[1])
+            magnitude = magnitude + np.abs(scale) * (np.abs(ce) * squares[0] +
+                                                     np.abs(ci) * squares[1])
+
+        if not error:
+            return value
+
+        return (value, np.float32((self._rounds + 4) * _FLOAT32_ROUNDOFF) *
+                       magnitude)
+
+    def dcombo_da(self, a, factors, e=0., sin_i=0., error=False):
+        """Returns the radial derivative of a frequency combination, followed
+        by its error bound if error is True. As in Gravity.dcombo_da(), full
+        precision is not guaranteed if the coefficients cancel."""
+
+        squares = self._corrections(e, sin_i)
+
+        value = np.float32(0.)
+        magnitude = np.float32(0.)
+        for (factor, name) in zip(factors, ('omega', 'kappa', 'nu')):
+            if np.any(factor):
+                factor = np.asarray(factor, dtype='float32')
+                (deriv, size) = self._derivative(name, a, squares)
+                value = value + factor * deriv
+                magnitude = magnitude + np.abs(factor) * size
+
+        if not error:
+            return value
+
+        return (value, np.float32((self._rounds + 6) * _FLOAT32_ROUNDOFF) *
+                       magnitude)
+
+    ####################################
+    # State vectors
+    ####################################
+
+    def state_from_osc(self, elements, body_gm=0., tol=1.e-6, max_iters=20,
+                             error=False, out=None):
+        """Returns the position and velocity based on osculating orbital
+        elements, as in Gravity.state_from_osc().
+
+        Input:
+            elements    the six elements, scalars or arrays that broadcast to a
+                        common shape.
+            body_gm     GM of the orbiting body, if not negligible.
+            tol         tolerance on the residual in Kepler's equation
+                        (radians). Values much below 1.e-6 are not attainable
+                        in single precision.
+            max_iters   upper limit on the refinement iterations.
+            error       True to also return the error bounds.
+            out         optional tuple (pos, vel) of preallocated arrays, each
+                        of shape (..., 3), to receive the result.
+
+        Return:         (pos, vel), or (pos, vel, pos_error, vel_error) if error
+                        is True, where the errors bound every component of the
+                        position and velocity at each element.
+        """
+
+        (a, e, inc) = [np.asarray(x, dtype='float32') for x in elements[:3]]
+        (mean_lon, long_peri, long_node) = [SinglePrecision._angle(x)
+                                            for x in elements[3:]]
+
+        shape = np.broadcast(a, e, inc, mean_lon, long_peri, long_node).shape
+        (pos, vel) = Gravity._state_buffers(shape, out, 'float32')
+
+        gm = np.float32(self.gravity.gm + body_gm)
+        Gravity._osc_to_state(gm, a, e, inc, mean_lon, long_peri, long_node,
+                              tol, max_iters, pos, vel)
+        if not error:
+            return (pos, vel)
+
+        # The error in the eccentric anomaly is magnified by 1/(1 - e cos E),
+        # up to 1/(1 - e) at pericenter
+        u = _FLOAT32_ROUNDOFF
+        one_minus_e = Gravity._one_minus(e, 1., 'float64')
+        anomaly_error = (8. * np.pi * u + tol) / one_minus_e
+        speed = np.sqrt(gm / a * (2. - one_minus_e) / one_minus_e)
+
+        pos_error = a * (anomaly_error + 16. * u * (2. - one_minus_e))
+        vel_error = speed * (anomaly_error / one_minus_e + 16. * u)
+        return (pos, vel,
+                np.broadcast_to(pos_error, shape).astype('float32'),
+                np.broadcast_to(vel_error, shape).astype('float32'))
+
+    def state_from_geom(self, elements, body_gm=0., error=False, out=None):
+        """Returns the position and velocity based on geometric orbital
+        elements, as in Gravity.state_from_geom().
+
+        Input:
+            elements    the six elements, scalars or arrays that broadcast to a
+                        common shape.
+            body_gm     GM of the orbiting body, if not negligible.
+            error       True to also return the error bounds.
+            out         optional tuple (pos, vel) of preallocated arrays, each
+                        of shape (..., 3), to receive the result.
+
+        Return:         (pos, vel), or (pos, vel, pos_error, vel_error) if error
+                        is True, where the errors bound every component of the
+                        position and velocity at each element.
+        """
+
+        (a, e, inc) = [np.asarray(x, dtype='float32') for x in elements[:3]]
+        (lam, long_peri, long_node) = [SinglePrecision._angle(x)
+                                       for x in elements[3:]]
+
+        shape = np.broadcast(a, e, inc, lam, long_peri, long_node).shape
+        (pos, vel) = Gravity._state_buffers(shape, out, 'float32')
+
+        freqs = self.gravity._geom_to_freq(a, e, inc, body_gm)
+        freqs = tuple(np.asarray(f, dtype='float32') for f in freqs)
+        Gravity._geom_to_state(a, e, inc, lam, long_peri, long_node, freqs,
+                               pos, vel)
+        if not error:
+            return (pos, vel)
+
+        # Rounding of the angles contributes 2 pi u; the remaining terms are
+        # close to one
+        rounds = (32. + 8. * np.pi) * _FLOAT32_ROUNDOFF
+        pos_error = a * rounds
+        vel_error = a * freqs[0] * rounds
+        return (pos, vel,
+                np.broadcast_to(pos_error, shape).astype('float32'),
+                np.broadcast_to(vel_error, shape).astype('float32'))
+
+    def osc_from_state(self, pos, vel, body_gm=0., error=False):
+        """Returns osculating orbital elements based on position and velocity,
+        as in Gravity.osc_from_state().
+
+        Nearly every step of the inversion cancels: the energy, 1 - h^2/(GM a)
+        for the eccentricity, and the angles measured from a pericenter that
+        is poorly defined at small e. The conversion is therefore done in
+        double precision and only the results are stored in single precision.
+
+        Input:
+            pos, vel    position and velocity vectors, arrays of shape (..., 3)
+                        in single or double precision.
+            body_gm     GM of the orbiting body, if not negligible.
+            error       True to also return the error bounds.
+
+        Return:         (a, e, i, mean longitude, longitude of pericenter,
+                         longitude of ascending node), or the tuple (elements,
+                        errors) if error is True. The errors bound the rounding
+                        of each element to single precision, with the states
+                        taken as exact.
+        """
+
+        elements = self.gravity.osc_from_state(np.asfarray(pos),
+                                               np.asfarray(vel), body_gm)
+        return SinglePrecision._rounded_elements(elements, error)
+
+    def geom_from_state(self, pos, vel, body_gm=0., tol=1.e-6, max_iters=100,
+                              error=False):
+        """Returns geometric orbital elements based on position and velocity,
+        as in Gravity.geom_from_state().
+
+        The iteration converges to a tolerance in km that single precision
+        cannot reach at planetary distances, and it subtracts the forced
+        motion from the state, which cancels. The conversion is therefore done
+        in double precision and only the results are stored in single
+        precision.
+
+        Input:
+            pos, vel    position and velocity vectors, arrays of shape (..., 3)
+                        in single or double precision.
+            body_gm     GM of the orbiting body, if not negligible.
+            tol         convergence tolerance on the semimajor axis (km).
+            max_iters   upper limit on the number of iterations.
+            error       True to also return the error bounds.
+
+        Return:         (a, e, i, mean longitude, longitude of pericenter,
+                         longitude of ascending node), or the tuple (elements,
+                        errors) if error is True. The errors bound the rounding
+                        of each element to single precision, with the states
+                        taken as exact.
+        """
+
+        elements = self.gravity.geom_from_state(np.asfarray(pos),
+                                                np.asfarray(vel), body_gm,
+                                                tol=tol, max_iters=max_iters)
+        return SinglePrecision._rounded_elements(elements, error)
+
+    @staticmethod
+    def _rounded_elements(elements, error):
+        """Internal method to return double-precision elements in single
+        precision, with the bounds on their rounding if requested."""
+
+        elements = tuple(np.asarray(x).astype('float32') for x in elements)
+        if not error:
+            return elements
+
+        u = np.float32(_FLOAT32_ROUNDOFF)
+        return (elements, tuple(u * np.abs(x) for x in elements))
+
+################################################################################
+# Gravity ensembles
+################################################################################
+
+class GravityEnsemble(object):
+    """A set of gravity fields, such as samples of the J-values drawn from
+    their covariance, that are evaluated together in single array operations.
+
+    The parameters of the M models are stored with shape (M,1), and the
+    arguments of every method are broadcast against that shape. For example,
+    an array of N semimajor axes yields results of shape (M,N), while an array
+    of shape (M,N) gives each model its own radii.
+    """
+
+    def __init__(self, gm, jn=(), radius=1.):
+        """The constructor for a GravityEnsemble object.
+
+        Input:
+            gm          GM of each model in units of km^3/s^2, a scalar or an
+                        array of shape (M,).
+            jn          J-values [J2, J4, ...] of each model, an array of shape
+                        (M,K), or a single list shared by every model.
+            radius      body radius for associated J-values, a scalar or an
+                        array of shape (M,).
+        """
+
+        gm = np.atleast_1d(np.asfarray(gm))
+        radius = np.atleast_1d(np.asfarray(radius))
+        jn = np.asfarray(jn)
+        if jn.ndim == 1:
+            jn = jn[np.newaxis]
+
+        if gm.ndim != 1 or radius.ndim != 1 or jn.ndim != 2:
+            raise ValueError('invalid shape for gm, jn or radius')
+
+        models = max(gm.size, radius.size, jn.shape[0])
+        self.gm = np.broadcast_to(gm, (models,)).copy()
+        self.rp = np.broadcast_to(radius, (models,)).copy()
+        self.jn = np.broadcast_to(jn, (models, jn.shape[1])).copy()
+        self.r2 = self.rp**2
+
+        # Coefficients for frequencies, as in Gravity.__init__(), with one row
+        # per J-value and one column per model
+        n = 0
+        pn_zero = 1.
+        self.omega_jn = np.empty(self.jn.T.shape)
+        self.kappa_jn = np.empty(self.jn.T.shape)
+        self.nu_jn    = np.empty(self.jn.T.shape)
+        for i in range(self.jn.shape[1]):
+            n += 2
+            pn_zero = -(n-1.)/n * pn_zero
+
+            self.omega_jn[i] =       -(n+1) * pn_zero * self.jn[:,i]
+            self.kappa_jn[i] =  (n-1)*(n+1) * pn_zero * self.jn[:,i]
+            self.nu_jn[i]    = -(n+1)*(n+1) * pn_zero * self.jn[:,i]
+
+        powers = 2 * np.arange(1, self.jn.shape[1] + 1)[:,np.newaxis]
+        self.domega_jn = -(powers + 3) * self.omega_jn
+        self.dkappa_jn = -(powers + 3) * self.kappa_jn
+        self.dnu_jn    = -(powers + 3) * self.nu_jn
+
+    @staticmethod
+    def from_bodies(bodies):
+        """Returns a GravityEnsemble containing the given Gravity objects, with
+        missing higher J-values set to zero."""
+
+        bodies = list(bodies)
+        terms = max(len(body.jn) for body in bodies)
+        jn = np.zeros((len(bodies), terms))
+        for (k, body) in enumerate(bodies):
+            jn[k,:len(body.jn)] = body.jn
+
+        return GravityEnsemble([body.gm for body in bodies], jn,
+                               [body.rp for body in bodies])
+
+    def __len__(self):
+        return self.gm.size
+
+    def __getitem__(self, k):
+        """Returns model k as a Gravity object."""
+
+        return Gravity(self.gm[k], self.jn[k], self.rp[k])
+
+    ####################################
+    # Internal methods
+    ####################################
+
+    def _params(self, index=None):
+        """Internal method to return a dictionary of the model parameters,
+        either with shape (M,1) or gathered along one axis by an index
+        array."""
+
+        names = ('gm', 'r2')
+        coefficients = ('omega_jn', 'kappa_jn', 'nu_jn',
+                        'domega_jn', 'dkappa_jn', 'dnu_jn')
+
+        if index is None:
+            params = dict((name, getattr(self, name)[:,np.newaxis])
+                          for name in names)
+            params.update((name, getattr(self, name)[:,:,np.newaxis])
+                          for name in coefficients)
+            j2 = self.jn[:,:1] if self.jn.shape[1] else np.zeros((len(self),1))
+        else:
+            params = dict((name, getattr(self, name)[index])
+                          for name in names)
+            params.update((name, getattr(self, name)[:,index])
+                          for name in coefficients)
+            j2 = self.jn[index,0] if self.jn.shape[1] else 0.
+
+        params['j2'] = j2
+        return params
+
+    @staticmethod
+    def _frequency(params, a, name, e, sin_i, derivative=False):
+        """Internal method to return one of omega, kappa or nu, or its radial
+        derivative."""
+
+        a2 = a * a
+        gm_a3 = params['gm'] / (a * a2)
+        ratio2 = params['r2'] / a2
+
+        value = np.sqrt(gm_a3 * (1. + _jseries(params[name + '_jn'], ratio2)))
+        correction = 0.
+        if np.any(e) or np.any(sin_i):
+            (ce, ci) = _EI_CORRECTIONS[name]
+            correction = (np.sqrt(gm_a3) * ratio2 * params['j2'] *
+                          (ce * e**2 + ci * sin_i**2))
+
+        if not derivative:
+            return value + correction
+
+        gm_a4 = gm_a3 / a
+        return (gm_a4 * (-3. + _jseries(params['d' + name + '_jn'], ratio2))
+                / (2. * value) - 3.5 / a * correction)
+
+    @staticmethod
+    def _combo(params, a, factors, e, sin_i):
+        """Internal method to evaluate a frequency combination, using the same
+        cancellation-safe form as Gravity.combo()."""
+
+        (sum_values, sqrt_gm_over_a3, ratio2) = _combo_safe(params['gm'],
+                        params['r2'], (params['omega_jn'], params['kappa_jn'],
+                                       params['nu_jn']), a, factors)
+
+        if np.any(e) or np.any(sin_i):
+            sum_values = sum_values + (sqrt_gm_over_a3 * ratio2 *
+                                       _ei_term(params['j2'], factors, e,
+                                                sin_i))
+
+        return sum_values
+
+    @staticmethod
+    def _dcombo_da(params, a, factors, e, sin_i):
+        """Internal method to evaluate the radial derivative of a frequency
+        combination."""
+
+        sum_values = 0.
+        for (factor, name) in zip(factors, ('omega', 'kappa', 'nu')):
+            if np.any(factor):
+                sum_values = sum_values + factor * GravityEnsemble._frequency(
+                                    params, a, name, e, sin_i, derivative=True)
+
+        return sum_values
+
+    ####################################
+    # Public methods
+    ####################################
+
+    def omega(self, a, e=0., sin_i=0.):
+        """Returns the mean motion (radians/s) of every model at semimajor axis
+        a."""
+
+        return GravityEnsemble._frequency(self._params(), np.asfarray(a),
+                                          'omega', e, sin_i)
+
+    def kappa(self, a, e=0., sin_i=0.):
+        """Returns the radial oscillation frequency (radians/s) of every model
+        at semimajor axis a."""
+
+        return GravityEnsemble._frequency(self._params(), np.asfarray(a),
+                                          'kappa', e, sin_i)
+
+    def nu(self, a, e=0., sin_i=0.):
+        """Returns the vertical oscillation frequency (radians/s) of every
+        model at semimajor axis a."""
+
+        return GravityEnsemble._frequency(self._params(), np.asfarray(a),
+                                          'nu', e, sin_i)
+
+    def combo(self, a, factors, e=0., sin_i=0.):
+        """Returns a frequency combination for every model, based on given
+        coefficients for omega, kappa and nu. As in Gravity.combo(), full
+        precision is preserved if the coefficients cancel to first or second
+        order. The factors can also be arrays."""
+
+        return GravityEnsemble._combo(self._params(), np.asfarray(a), factors,
+                                      e, sin_i)
+
+    def dcombo_da(self, a, factors, e=0., sin_i=0.):
+        """Returns the radial derivative of a frequency combination for every
+        model."""
+
+        return GravityEnsemble._dcombo_da(self._params(), np.asfarray(a),
+                                          factors, e, sin_i)
+
+    def solve_a(self, freq, factors=(1,0,0), e=0., sin_i=0., tol=0.,
+                      iters=False):
+        """Solves for the semimajor axis at which the frequency is equal to the
+        given combination of factors on omega, kappa and nu, for every model.
+
+        The method follows Gravity.solve_a(), with every model and frequency
+        solved together by Newton's method.
+
+        Input:
+            freq        frequency or array of frequencies (radians/s), which is
+                        broadcast against the models.
+            factors     coefficients on omega, kappa and nu; scalars or arrays.
+            e           eccentricity, for second-order corrections.
+            sin_i       sine of the inclination, for second-order corrections.
+            tol         relative tolerance on a. The default of zero iterates
+                        until the solution is accurate to full precision.
+            iters       True to also return the number of Newton iterations
+                        applied to each element.
+
+        Return:         a, or the tuple (a, iterations) if iters is True.
+        """
+
+        shape = np.broadcast(np.empty((len(self),1)), freq, e, sin_i,
+                             *factors).shape
+
+        # Flatten everything, with the index of the model for each element
+        models = np.broadcast_to(np.arange(len(self))[:,np.newaxis],
+                                 shape).ravel()
+        freq = np.broadcast_to(freq, shape).ravel()
+        if np.shape(e):
+            e = np.broadcast_to(e, shape).ravel()
+        if np.shape(sin_i):
+            sin_i = np.broadcast_to(sin_i, shape).ravel()
+        factors = [np.broadcast_to(f, shape).ravel() if np.shape(f) else f
+                   for f in factors]
+
+        all_params = self._params(models)
+
+        def first(coefficients):
+            return coefficients[0] if len(coefficients) else 0.
+
+        first_jn = [first(all_params[name])
+                    for name in ('omega_jn', 'kappa_jn', 'nu_jn')]
+        ei_term = _ei_term(all_params['j2'], factors, e, sin_i)
+        a = _solve_a_guess(all_params['gm'], all_params['r2'], first_jn, freq,
+                           factors, ei_term) * np.ones(freq.shape)
+
+        def evaluate(active, a, factors, e, sin_i):
+            if active.size == freq.size:
+                params = all_params
+            else:
+                params = self._params(models[active])
+
+            return (GravityEnsemble._combo(params, a, factors, e, sin_i),
+                    GravityEnsemble._dcombo_da(params, a, factors, e, sin_i))
+
+        (counts, da, active) = _solve_a_newton(a, freq, factors, e, sin_i, tol,
+                                               evaluate)
+
+        a = a.reshape(shape)
+        if iters:
+            return (a, counts.reshape(shape))
+
+        return a
+
+################################################################################
+# Uncertainty propagation
+################################################################################
+
+# Bases of the Halton sequence, one per parameter
+_HALTON_PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47)
+
+# Smallest number of samples in the first batch of uncertainty_bands(), which
+# sets the histogram ranges
+_BANDS_PILOT = 256
+
+def _halton(start, count, dims):
+    """Internal function to return points start...start+count-1 of the Halton
+    sequence in the unit cube, as an array of shape (count, dims)."""
+
+    if dims > len(_HALTON_PRIMES):
+        raise ValueError('Halton sampling supports at most %d parameters'
+                         % len(_HALTON_PRIMES))
+
+    points = np.empty((count, dims))
+    for (k, base) in enumerate(_HALTON_PRIMES[:dims]):
+        index = np.arange(start, start + count)
+        result = np.zeros(count)
+        scale = 1. / base
+        while np.any(index):
+            result += scale * (index % base)
+            index //= base
+            scale /= base
+
+        points[:,k] = result
+
+    return points
+
+# Coefficients of the rational approximations in _inverse_normal()
+_ACKLAM_A = (-3.969683028665376e+01,  2.209460984245205e+02,
+             -2.759285104469687e+02,  1.383577518672690e+02,
+             -3.066479806614716e+01,  2.506628277459239e+00)
+_ACKLAM_B = (-5.447609879822406e+01,  1.615858368580409e+02,
+             -1.556989798598866e+02,  6.680131188771972e+01,
+             -1.328068155288572e+01)
+_ACKLAM_C = (-7.784894002430293e-03, -3.223964580411365e-01,
+             -2.400758277161838e+00, -2.549732539343734e+00,
+              4.374664141464968e+00,  2.938163982698783e+00)
+_ACKLAM_D = ( 7.784695709041462e-03,  3.224671290700398e-01,
+              2.445134137142996e+00,  3.754408661907416e+00)
+
+def _inverse_normal(p):
+    """Internal function to return the quantiles of the standard normal
+    distribution at probabilities 0 < p < 1, using the rational approximation
+    of P. J. Acklam, with a relative error below 1.2e-9."""
+
+    def poly(coefficients, x):
+        result = coefficients[0]
+        for c in coefficients[1:]:
+            result = result * x + c
+        return result
+
+    p = np.asfarray(p)
+    q = np.minimum(p, 1. - p)
+    result = np.empty(p.shape)
+
+    # Central region
+    central = q >= 0.02425
+    r = p[central] - 0.5
+    s = r * r
+    result[central] = (poly(_ACKLAM_A, s) * r /
+                       (poly(_ACKLAM_B, s) * s + 1.))
+
+    # Tails
+    tail = ~central
+    s = np.sqrt(-2. * np.log(q[tail]))
+    x = poly(_ACKLAM_C, s) / (poly(_ACKLAM_D, s) * s + 1.)
+    result[tail] = np.where(p[tail] < 0.5, x, -x)
+
+    return result
+
+class UncertaintyBands(object):
+    """The percentiles, mean and standard deviation of a quantity evaluated
+    over samples of a gravity field, as returned by uncertainty_bands().
+
+    Attributes:
+        percentiles     the percentiles requested, in the range 0-100.
+        bands           array of shape (P,) + shape of x, one band per
+                        percentile.
+        mean            mean value of the quantity at each x.
+        std             standard deviation of the quantity at each x.
+        samples         number of gravity fields sampled.
+        valid           number of samples giving a finite value at each x.
+    """
+
+    def __init__(self, percentiles, bands, mean, std, samples, valid):
+        self.percentiles = percentiles
+        self.bands = bands
+        self.mean = mean
+        self.std = std
+        self.samples = samples
+        self.valid = valid
+
+    def __repr__(self):
+        return ('UncertaintyBands(samples=%d, percentiles=%s, shape=%s)'
+                % (self.samples, list(self.percentiles), self.mean.shape))
+
+def uncertainty_bands(mean, covariance, method, x, args=(), radius=1.,
+                      samples=10000, percentiles=(2.5, 50., 97.5), bins=512,
+                      batch=None, sampling='halton', seed=None):
+    """Propagates a normal distribution of gm and J-values into percentile
+    bands for a method of GravityEnsemble, such as combo() or solve_a().
+
+    The gravity fields are sampled in batches. Each batch is evaluated as a
+    single GravityEnsemble, over x in chunks if x is large, and then folded
+    into a histogram per element of x, so memory is bounded by the batch size
+    and the number of bins rather than by the number of samples. The histogram
+    ranges are set by the first batch, which has at least 256 samples, with a
+    margin; values beyond the range are counted in the outermost bins, whose
+    percentiles are interpolated toward the extreme values seen. Samples that
+    give NaN, such as radii with no resonance, are excluded.
+
+    Input:
+        mean        the mean parameters [gm, J2, J4, ...], or a Gravity object
+                    whose gm, jn and rp are used.
+        covariance  covariance matrix of the parameters; a 1-D array is
+                    interpreted as variances. It need not be positive definite,
+                    so parameters with zero variance are held fixed.
+        method      name of the GravityEnsemble method to evaluate, e.g.,
+                    "combo", "dcombo_da" or "solve_a".
+        x           scalar or array of radii or frequencies as the first
+                    argument of the method.
+        args        tuple of additional arguments to the method, e.g.,
+                    ((1,-1,0),) for the apsidal precession rate.
+        radius      body radius for the J-values; ignored if mean is a Gravity
+                    object.
+        samples     number of gravity fields to sample.
+        percentiles sequence of percentiles to return, in the range 0-100.
+        bins        number of histogram bins per element of x.
+        batch       number of samples per batch; by default, enough to evaluate
+                    about 16 * CHUNK_SIZE elements at a time. The first batch
+                    has at least 256 samples regardless.
+        sampling    "halton" for a quasi-random Halton sequence, which
+                    converges faster for smooth quantities; "random" for
+                    pseudo-random normal deviates.
+        seed        seed of the random generator. For Halton sampling, a seed
+                    applies a random shift to the sequence.
+
+    Return:         an UncertaintyBands object.
+    """
+
+    if isinstance(mean, Gravity):
+        radius = mean.rp
+        mean = (mean.gm,) + mean.jn
+
+    mean = np.asfarray(mean)
+    covariance = np.asfarray(covariance)
+    if covariance.ndim == 1:
+        covariance = np.diag(covariance)
+
+    dims = mean.size
+    if mean.ndim != 1 or covariance.shape != (dims, dims):
+        raise ValueError('covariance must have shape (%d,%d)' % (dims, dims))
+
+    if sampling not in ('halton', 'random'):
+        raise ValueError('unrecognized sampling method: ' + repr(sampling))
+
+    # Factor the covariance; eigenvalues allow a singular matrix
+    (values, vectors) = np.linalg.eigh(covariance)
+    factor = vectors * np.sqrt(np.maximum(values, 0.))
+
+    rng = np.random.default_rng(seed)
+    shift = rng.random(dims) if (sampling == 'halton' and seed is not None) \
+                             else 0.
+
+    x = np.asfarray(x)
+    shape = x.shape
+    x = x.ravel()
+
+    # The batch does not shrink below the pilot as x grows; instead, x is
+    # divided into chunks so that each evaluation stays near 16 * CHUNK_SIZE
+    if batch is None:
+        batch = max(_BANDS_PILOT, (16 * CHUNK_SIZE) // x.size)
+    x_chunk = max(1, (16 * CHUNK_SIZE) // batch)
+
+    counts = np.zeros(x.size * bins, dtype='int')
+    valid = np.zeros(x.size, dtype='int')
+    sums = np.zeros(x.size)
+    sums2 = np.zeros(x.size)
+    lowest = np.full(x.size, np.inf)
+    highest = np.full(x.size, -np.inf)
+    center = np.zeros(x.size)
+    lo = np.zeros(x.size)
+    width = np.ones(x.size)
+
+    start = 0
+    while start < samples:
+        count = min(max(batch, _BANDS_PILOT) if start == 0 else batch,
+                    samples - start)
+
+        # Draw the standard normal deviates
+        if sampling == 'halton':
+            points = (_halton(start + 1, count, dims) + shift) % 1.
+            deviates = _inverse_normal(np.clip(points, 1.e-16, 1. - 1.e-16))
+        else:
+            deviates = rng.standard_normal((count, dims))
+
+        params = mean + deviates.dot(factor.T)
+        ensemble = GravityEnsemble(params[:,0], params[:,1:], radius)
+
+        for x_start in range(0, x.size, x_chunk):
+            x_stop = min(x_start + x_chunk, x.size)
+            part = slice(x_start, x_stop)
+            local = np.arange(x_stop - x_start)
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values = getattr(ensemble, method)(x[part], *args)
+
+            values = np.broadcast_to(values, (count, local.size))
+            finite = np.isfinite(values)
+
+            # The first batch defines the histogram ranges and the offsets
+            # that keep the sums of squares accurate
+            if start == 0:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    mid = np.nanmean(np.where(finite, values, np.nan), axis=0)
+                    low = np.nanmin(np.where(finite, values, np.nan), axis=0)
+                    high = np.nanmax(np.where(finite, values, np.nan), axis=0)
+
+                mid = np.where(np.isfinite(mid), mid, 0.)
+                margin = 0.5 * (high - low)
+                margin = np.where(margin > 0., margin,
+                                  np.maximum(np.abs(mid) * 1.e-12, 1.e-300))
+                margin = np.where(np.isfinite(margin), margin, 1.)
+                low = np.where(np.isfinite(low), low - margin, mid - 1.)
+                high = np.where(np.isfinite(high), high + margin, mid + 1.)
+                center[part] = mid
+                lo[part] = low
+                width[part] = (high - low) / bins
+
+            offsets = np.where(finite, values - center[part], 0.)
+            sums[part] += offsets.sum(axis=0)
+            sums2[part] += (offsets * offsets).sum(axis=0)
+            valid[part] += finite.sum(axis=0)
+            lowest[part] = np.minimum(lowest[part],
+                                np.where(finite, values, np.inf).min(axis=0))
+            highest[part] = np.maximum(highest[part],
+                                np.where(finite, values, -np.inf).max(axis=0))
+
+            cols = np.broadcast_to(local, values.shape)[finite]
+            index = ((values[finite] - lo[part][cols]) /
+                     width[part][cols]).astype('int')
+            index = np.clip(index, 0, bins - 1) + bins * cols
+            counts[bins * x_start : bins * x_stop] += np.bincount(index,
+                                                    minlength=bins*local.size)
+
+            del values, finite, offsets, cols, index
+
+        start += count
+
+    # Mean and standard deviation
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset_mean = sums / valid
+        mean_values = center + offset_mean
+        std = np.sqrt(np.maximum(sums2 / valid - offset_mean**2, 0.))
+
+    # Interpolate the percentiles within the cumulative histograms. The edges
+    # of the outermost bins are replaced by the extreme values seen.
+    counts = counts.reshape(x.size, bins)
+    cumulative = np.zeros((x.size, bins + 1))
+    cumulative[:,1:] = np.cumsum(counts, axis=1)
+    edges = lo[:,np.newaxis] + width[:,np.newaxis] * np.arange(bins + 1)
+    edges[:,0] = np.minimum(edges[:,0], lowest)
+    edges[:,-1] = np.maximum(edges[:,-1], highest)
+
+    columns = np.arange(x.size)
+    bands = np.empty((len(percentiles), x.size))
+    for (k, percentile) in enumerate(percentiles):
+        target = percentile / 100. * valid
+        upper = np.clip((cumulative < target[:,np.newaxis]).sum(axis=1),
+                        1, bins)
+        c0 = cumulative[columns, upper - 1]
+        c1 = cumulative[columns, upper]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(c1 > c0, (target - c0) / (c1 - c0), 0.)
+
+        bands[k] = np.clip(edges[columns, upper - 1] + frac *
+                           (edges[columns, upper] - edges[columns, upper - 1]),
+                           lowest, highest)
+        bands[k, valid == 0] = np.nan
+
+    return UncertaintyBands(tuple(percentiles),
+                            bands.reshape((len(percentiles),) + shape),
+                            mean_values.reshape(shape), std.reshape(shape),
+                            samples, valid.reshape(shape))
 
 ################################################################################
 # Planetary gravity fields defined...
@@ -916,71 +4872,93 @@ G_CGS = 6.67428e-08     # cm^3 g^-1 s^-2
 G_PER_KG = G_MKS / 1.e9
 G_PER_G  = G_CGS / 1.e15
 
-# From http://ssd.jpl.nasa.gov/?planet_phys_par
-SUN = Gravity(132712440018., [], 695500.)
+################################################################################
+# Bodies are defined lazily. Each is built on first access, either as a module
+# attribute or through LOOKUP, and is then cached as a module global.
+################################################################################
 
-# From http://ssd.jpl.nasa.gov/?planet_phys_par
-MERCURY = Gravity(0.330104e24 * G_PER_KG, [], 2439.7 )
-VENUS   = Gravity( 4.86732e24 * G_PER_KG, [], 6051.8 )
-EARTH   = Gravity( 5.97219e24 * G_PER_KG, [], 6378.14)
-MARS    = Gravity(0.641693e24 * G_PER_KG, [], 3396.19)
-
-# Earlier values from http://ssd.jpl.nasa.gov/?gravity_fields_op
-JUPITER_V1 = Gravity(126686535., [14696.43e-06, -587.14e-06, 34.25e-06], 71492.)
-#SATURN  = Gravity( 37931208.,  [16290.71e-06, -935.83e-06, 86.14e-06], 60330.)
-SATURN_V1  = Gravity( 37931207.7, [16290.71e-06, -936.83e-06, 86.14e-06, -10.e-06], 60330.)
-URANUS_V1  = Gravity(  5793964., [ 3341.29e-06,  -30.44e-06           ], 26200.)
-NEPTUNE_V1 = Gravity(  6835100., [ 3408.43e-06,  -33.40e-06           ], 25225.)
-
-# Updated September 15, 2015 from http://ssd.jpl.nasa.gov/?gravity_fields_op
-JUPITER = Gravity(126686536.1, [14695.62e-06, -591.31e-06, 20.78e-06], 71492.)
-SATURN  = Gravity( 37931208. , [16290.71e-06, -935.83e-06, 86.14e-06,
-                                                            -10.e-06], 60330.)
-URANUS  = Gravity(  5793951.3, [ 3510.68e-06,  -34.17e-06           ], 25559.)
-NEPTUNE = Gravity(  6835100. , [ 3408.43e-06,  -33.40e-06           ], 25225.)
-
-# From http://arxiv.org/abs/0712.1261
-PLUTO_ONLY = Gravity(869.6, [], 1151.)
-PLUTO = PLUTO_ONLY
-
-# From http://ssd.jpl.nasa.gov/?sat_phys_par
-MOON      = Gravity(4902.801, [], 1737.5)
-
-IO        = Gravity(5959.916, [], 1821.6)
-EUROPA    = Gravity(3202.739, [], 1560.8)
-GANYMEDE  = Gravity(9887.834, [], 2631.2)
-CALLISTO  = Gravity(7179.289, [], 2410.3)
-
-MIMAS     = Gravity(   2.5026, [],  198.20)
-ENCELADUS = Gravity(   7.2027, [],  252.10)
-TETHYS    = Gravity(  41.2067, [],  533.00)
-DIONE     = Gravity(  73.1146, [],  561.70)
-RHEA      = Gravity( 153.9426, [],  764.30)
-TITAN     = Gravity(8978.1382, [], 2574.73)
-HYPERION  = Gravity(   0.3727, [],  135.00)
-IAPETUS   = Gravity( 120.5038, [],  735.60)
-PHOEBE    = Gravity(   0.5532, [],  106.50)
-
-MIRANDA   = Gravity(   4.4, [], 235.8)
-ARIEL     = Gravity(  86.4, [], 578.9)
-UMBRIEL   = Gravity(  81.5, [], 584.7)
-TITANIA   = Gravity( 228.2, [], 788.9)
-OBERON    = Gravity( 192.4, [], 761.4)
-
-TRITON    = Gravity(1427.6, [], 1353.4)
-NEREID    = Gravity(  2.06, [],  170.)
-
-CHARON    = Gravity(105.9, [], 603.6)
+_BODIES = {
+    # From http://ssd.jpl.nasa.gov/?planet_phys_par
+    'SUN': (132712440018., [], 695500.),
+
+    # From http://ssd.jpl.nasa.gov/?planet_phys_par
+    'MERCURY': (0.330104e24 * G_PER_KG, [], 2439.7 ),
+    'VENUS'  : ( 4.86732e24 * G_PER_KG, [], 6051.8 ),
+    'EARTH'  : ( 5.97219e24 * G_PER_KG, [], 6378.14),
+    'MARS'   : (0.641693e24 * G_PER_KG, [], 3396.19),
+
+    # Earlier values from http://ssd.jpl.nasa.gov/?gravity_fields_op
+    'JUPITER_V1': (126686535., [14696.43e-06, -587.14e-06, 34.25e-06], 71492.),
+#   'SATURN'    : ( 37931208.,  [16290.71e-06, -935.83e-06, 86.14e-06], 60330.),
+    'SATURN_V1' : ( 37931207.7, [16290.71e-06, -936.83e-06, 86.14e-06, -10.e-06], 60330.),
+    'URANUS_V1' : (  5793964., [ 3341.29e-06,  -30.44e-06           ], 26200.),
+    'NEPTUNE_V1': (  6835100., [ 3408.43e-06,  -33.40e-06           ], 25225.),
+
+    # Updated September 15, 2015 from http://ssd.jpl.nasa.gov/?gravity_fields_op
+    'JUPITER': (126686536.1, [14695.62e-06, -591.31e-06, 20.78e-06], 71492.),
+    'SATURN' : ( 37931208. , [16290.71e-06, -935.83e-06, 86.14e-06,
+                                                         -10.e-06], 60330.),
+    'URANUS' : (  5793951.3, [ 3510.68e-06,  -34.17e-06           ], 25559.),
+    'NEPTUNE': (  6835100. , [ 3408.43e-06,  -33.40e-06           ], 25225.),
+
+    # From http://arxiv.org/abs/0712.1261
+    'PLUTO_ONLY': (869.6, [], 1151.),
+
+    # From http://ssd.jpl.nasa.gov/?sat_phys_par
+    'MOON'     : (4902.801, [], 1737.5),
+
+    'IO'       : (5959.916, [], 1821.6),
+    'EUROPA'   : (3202.739, [], 1560.8),
+    'GANYMEDE' : (9887.834, [], 2631.2),
+    'CALLISTO' : (7179.289, [], 2410.3),
+
+    'MIMAS'    : (   2.5026, [],  198.20),
+    'ENCELADUS': (   7.2027, [],  252.10),
+    'TETHYS'   : (  41.2067, [],  533.00),
+    'DIONE'    : (  73.1146, [],  561.70),
+    'RHEA'     : ( 153.9426, [],  764.30),
+    'TITAN'    : (8978.1382, [], 2574.73),
+    'HYPERION' : (   0.3727, [],  135.00),
+    'IAPETUS'  : ( 120.5038, [],  735.60),
+    'PHOEBE'   : (   0.5532, [],  106.50),
+
+    'MIRANDA'  : (   4.4, [], 235.8),
+    'ARIEL'    : (  86.4, [], 578.9),
+    'UMBRIEL'  : (  81.5, [], 584.7),
+    'TITANIA'  : ( 228.2, [], 788.9),
+    'OBERON'   : ( 192.4, [], 761.4),
+
+    'TRITON'   : (1427.6, [], 1353.4),
+    'NEREID'   : (  2.06, [],  170.),
+
+    'CHARON'   : (105.9, [], 603.6),
+}
+
+# Alternative names for the same Gravity object
+_ALIASES = {
+    'PLUTO': 'PLUTO_ONLY',
+    'PLUTO_CHARON': 'PLUTO_CHARON_AS_RINGS',
+}
 
 # Sets with relatively large mass ratios
-SUN_JUPITER = Gravity(SUN.gm + JUPITER.gm, [], SUN.rp)
 
-JUPITER_GALS = Gravity(JUPITER.gm + IO.gm + EUROPA.gm + GANYMEDE.gm +
-                       CALLISTO.gm, JUPITER.jn, JUPITER.rp)
+def _sun_jupiter():
+    return Gravity(_body('SUN').gm + _body('JUPITER').gm, [], _body('SUN').rp)
+
+def _jupiter_gals():
+    jupiter = _body('JUPITER')
+    gm = jupiter.gm
+    for name in ('IO', 'EUROPA', 'GANYMEDE', 'CALLISTO'):
+        gm += _body(name).gm
+    return Gravity(gm, jupiter.jn, jupiter.rp)
 
-SATURN_TITAN = Gravity(SATURN.gm + TITAN.gm, SATURN.jn, SATURN.rp)
+def _saturn_titan():
+    saturn = _body('SATURN')
+    return Gravity(saturn.gm + _body('TITAN').gm, saturn.jn, saturn.rp)
 
-PLUTO_CHARON_OLD = Gravity(PLUTO_ONLY.gm + CHARON.gm, [], PLUTO_ONLY.rp)
+def _pluto_charon_old():
+    pluto = _body('PLUTO_ONLY')
+    return Gravity(pluto.gm + _body('CHARON').gm, [], pluto.rp)
 
 ################################################################################
 # Revised Pluto-Charon gravity
@@ -1005,151 +4983,428 @@ PLUTO_CHARON_OLD = Gravity(PLUTO_ONLY.gm + CHARON.gm, [], PLUTO_ONLY.rp)
 #   J4' = J4 (GM1 (R1/R2)^4 + GM2) / (GM1 + GM2)
 # etc.
 
-PLUTO_A  = 19596. * CHARON.gm / (PLUTO.gm + CHARON.gm)
-CHARON_A = 19596. - PLUTO_A
-ratio2 = (PLUTO_A / CHARON_A)**2
-gm1 = PLUTO_ONLY.gm
-gm2 = CHARON.gm
-PLUTO_CHARON_AS_RINGS = Gravity(gm1 + gm2,
+def _pluto_a():
+    gm1 = _body('PLUTO_ONLY').gm
+    gm2 = _body('CHARON').gm
+    return 19596. * gm2 / (gm1 + gm2)
+
+def _charon_a():
+    return 19596. - _body('PLUTO_A')
+
+def _pluto_charon_as_rings():
+    ratio2 = (_body('PLUTO_A') / _body('CHARON_A'))**2
+    gm1 = _body('PLUTO_ONLY').gm
+    gm2 = _body('CHARON').gm
+    return Gravity(gm1 + gm2,
         [ 1/2.    * (gm1 * ratio2    + gm2) / (gm1 + gm2),
          -3/8.    * (gm1 * ratio2**2 + gm2) / (gm1 + gm2),
           5/16.   * (gm1 * ratio2**3 + gm2) / (gm1 + gm2),
          -35/128. * (gm1 * ratio2**4 + gm2) / (gm1 + gm2),
-          63/256. * (gm1 * ratio2**5 + gm2) / (gm1 + gm2)], CHARON_A)
-PLUTO_CHARON = PLUTO_CHARON_AS_RINGS
-################################################################################
-
-LOOKUP = {
-    "SUN": SUN,
-    "MERCURY": MERCURY,
-    "VENUS": VENUS,
-    "EARTH": EARTH,
-    "MARS": MARS,
-    "JUPITER": JUPITER,
-    "SATURN": SATURN,
-    "URANUS": URANUS,
-    "NEPTUNE": NEPTUNE,
-    "PLUTO_ONLY": PLUTO_ONLY,
-    "PLUTO": PLUTO_ONLY,
-    "MOON": MOON,
-    "IO": IO,
-    "EUROPA": EUROPA,
-    "GANYMEDE": GANYMEDE,
-    "CALLISTO": CALLISTO,
-    "MIMAS": MIMAS,
-    "ENCELADUS": ENCELADUS,
-    "TETHYS": TETHYS,
-    "DIONE": DIONE,
-    "RHEA": RHEA,
-    "TITAN": TITAN,
-    "HYPERION": HYPERION,
-    "IAPETUS": IAPETUS,
-    "PHOEBE": PHOEBE,
-    "MIRANDA": MIRANDA,
-    "ARIEL": ARIEL,
-    "UMBRIEL": UMBRIEL,
-    "TITANIA": TITANIA,
-    "OBERON": OBERON,
-    "TRITON": TRITON,
-    "NEREID": NEREID,
-    "CHARON": CHARON,
-    "SUN_JUPITER": SUN_JUPITER,
-    "JUPITER_GALS": JUPITER_GALS,
-    "SATURN_TITAN": SATURN_TITAN,
-    "PLUTO_CHARON": PLUTO_CHARON,
-    "SOLAR SYSTEM BARYCENTER": SUN_JUPITER,
-    "SSB": SUN_JUPITER,
-    "JUPITER BARYCENTER": JUPITER_GALS,
-    "SATURN BARYCENTER": SATURN_TITAN,
-    "URANUS BARYCENTER": URANUS,
-    "NEPTUNE BARYCENTER": NEPTUNE,
-    "PLUTO BARYCENTER": PLUTO_CHARON
+          63/256. * (gm1 * ratio2**5 + gm2) / (gm1 + gm2)], _body('CHARON_A'))
+
+_DERIVED = {
+    'SUN_JUPITER': _sun_jupiter,
+    'JUPITER_GALS': _jupiter_gals,
+    'SATURN_TITAN': _saturn_titan,
+    'PLUTO_CHARON_OLD': _pluto_charon_old,
+    'PLUTO_A': _pluto_a,
+    'CHARON_A': _charon_a,
+    'PLUTO_CHARON_AS_RINGS': _pluto_charon_as_rings,
 }
 
-########################################
-# UNIT TESTS
-########################################
-
-import unittest
-
-ERROR_TOLERANCE = 1.e-15
-
-class Test_Gravity(unittest.TestCase):
-
-    def test_uncombo(self):
-
-        # Testing scalars in a loop...
-        tests = 100
-        planets = [JUPITER, SATURN, URANUS, NEPTUNE]
-        factors = [(1, 0, 0), (0, 1, 0), (0, 0, 1)]
-
-        for test in range(tests):
-          for obj in planets:
-            for e in (0., 0.1):
-              for i in (0., 0.1):
-                a = obj.rp * 10. ** (np.random.rand() * 2.)
-                for f in factors:
-                    b = obj.solve_a(obj.combo(a,f,e,i), f, e, i)
-                    c = abs((b - a) / a)
-                    self.assertTrue(c < ERROR_TOLERANCE)
-
-        # PLUTO_CHARON with factors (1,0,0) and (0,0,1)
-        for test in range(tests):
-          for obj in [PLUTO_CHARON]:
-            for e in (0., 0.1):
-              for i in (0., 0.1):
-                a = obj.rp * 10. ** (np.random.rand() * 2.)
-                for f in [(1,0,0),(0,0,1)]:
-                    b = obj.solve_a(obj.combo(a,f,e,i), f, e, i)
-                    c = abs((b - a) / a)
-                    self.assertTrue(c < ERROR_TOLERANCE)
-
-        # PLUTO_CHARON with factors (0,1,0) can have duplicated values...
-        for test in range(tests):
-          for obj in [PLUTO_CHARON]:
-            a = obj.rp * 10. ** (np.random.rand() * 2.)
-            if obj.kappa2(a) < 0.: continue     # this would raise RuntimeError
-
-            for f in [(0,1,0)]:
-                combo1 = obj.combo(a,f)
-                b = obj.solve_a(combo1, f)
-                combo2 = obj.combo(b,f)
-                c = abs((combo2 - combo1) / combo1)
-                self.assertTrue(c < ERROR_TOLERANCE)
-
-        # Testing a 100x100 array
-        for obj in planets:
-          a = obj.rp * 10. ** (np.random.rand(100,100) * 2.)
-          for e in (0., 0.1):
-            for i in (0., 0.1):
-              for f in factors:
-                b = obj.solve_a(obj.combo(a,f,e,i), f, e, i)
-                c = abs((b - a) / a)
-                self.assertTrue(np.all(c < ERROR_TOLERANCE))
-
-        # Testing with first-order cancellation
-        factors = [(1, -1, 0), (1, 0, -1), (0, 1, -1)]
-        planets = [JUPITER, SATURN, URANUS, NEPTUNE]
-
-        for obj in planets:
-            a = obj.rp * 10. ** (np.random.rand(100,100) * 2.)
-            for f in factors:
-                b = obj.solve_a(obj.combo(a, f), f)
-                c = abs((b - a) / a)
-                self.assertTrue(np.all(c < ERROR_TOLERANCE))
-
-        # Testing with second-order cancellation
-        factors = [(2, -1, -1)]
-        planets = [JUPITER, SATURN, URANUS, NEPTUNE]
-
-        for obj in planets:
-            a = obj.rp * 10. ** (np.random.rand(100,100) * 2.)
-            for f in factors:
-                b = obj.solve_a(obj.combo(a, f), f)
-                c = abs((b - a) / a)
-                self.assertTrue(np.all(c < ERROR_TOLERANCE))
+_LAZY_NAMES = (list(_BODIES.keys()) + list(_ALIASES.keys()) +
+               list(_DERIVED.keys()))
+
+def _body(name):
+    """Return the object for a lazily defined name, building and caching it on
+    first use."""
+
+    module = globals()
+    if name in module:
+        return module[name]
+
+    if name in _BODIES:
+        value = Gravity(*_BODIES[name])
+    elif name in _ALIASES:
+        value = _body(_ALIASES[name])
+    else:
+        value = _DERIVED[name]()
+
+    module[name] = value
+    return value
+
+def __getattr__(name):
+    if name in _LAZY_NAMES:
+        return _body(name)
+
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(_LAZY_NAMES))
+
+class _BodyLookup(MutableMapping):
+    """Dictionary of Gravity objects keyed by body name. Values given as the
+    name of a lazily defined body are built on first access."""
+
+    def __init__(self, names):
+        self._items = dict(names)
+
+    def __getitem__(self, key):
+        value = self._items[key]
+        if isinstance(value, str):
+            value = _body(value)
+            self._items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._items[key] = value
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+LOOKUP = _BodyLookup({
+    "SUN": "SUN",
+    "MERCURY": "MERCURY",
+    "VENUS": "VENUS",
+    "EARTH": "EARTH",
+    "MARS": "MARS",
+    "JUPITER": "JUPITER",
+    "SATURN": "SATURN",
+    "URANUS": "URANUS",
+    "NEPTUNE": "NEPTUNE",
+    "PLUTO_ONLY": "PLUTO_ONLY",
+    "PLUTO": "PLUTO_ONLY",
+    "MOON": "MOON",
+    "IO": "IO",
+    "EUROPA": "EUROPA",
+    "GANYMEDE": "GANYMEDE",
+    "CALLISTO": "CALLISTO",
+    "MIMAS": "MIMAS",
+    "ENCELADUS": "ENCELADUS",
+    "TETHYS": "TETHYS",
+    "DIONE": "DIONE",
+    "RHEA": "RHEA",
+    "TITAN": "TITAN",
+    "HYPERION": "HYPERION",
+    "IAPETUS": "IAPETUS",
+    "PHOEBE": "PHOEBE",
+    "MIRANDA": "MIRANDA",
+    "ARIEL": "ARIEL",
+    "UMBRIEL": "UMBRIEL",
+    "TITANIA": "TITANIA",
+    "OBERON": "OBERON",
+    "TRITON": "TRITON",
+    "NEREID": "NEREID",
+    "CHARON": "CHARON",
+    "SUN_JUPITER": "SUN_JUPITER",
+    "JUPITER_GALS": "JUPITER_GALS",
+    "SATURN_TITAN": "SATURN_TITAN",
+    "PLUTO_CHARON": "PLUTO_CHARON",
+    "SOLAR SYSTEM BARYCENTER": "SUN_JUPITER",
+    "SSB": "SUN_JUPITER",
+    "JUPITER BARYCENTER": "JUPITER_GALS",
+    "SATURN BARYCENTER": "SATURN_TITAN",
+    "URANUS BARYCENTER": "URANUS",
+    "NEPTUNE BARYCENTER": "NEPTUNE",
+    "PLUTO BARYCENTER": "PLUTO_CHARON"
+})
+
+__all__ = (['DPR', 'DPD', 'TWOPI', 'EPSILON',
+            'RESONANCE_KINDS', 'RESONANCE_DTYPE', 'STATUS_CONVERGED',
+            'STATUS_DIVERGED', 'STATUS_MAX_ITERS',
+            'CONVERSIONS', 'ORBIT_KINDS', 'CHUNK_SIZE', 'THREAD_MIN_SIZE',
+            'CACHE_SIZE',
+            'INVERSE_TABLE_RANGE', 'INVERSE_TABLE_SIZE',
+            'Gravity', 'GravityEnsemble', 'FrequencyTable', 'SolverDiagnostics',
+            'SinglePrecision', 'UncertaintyBands', 'uncertainty_bands',
+            'OrbitArray',
+            'set_threads', 'FrequencyCache', 'set_cache',
+            'add_diagnostics_hook', 'remove_diagnostics_hook',
+            'G_MKS', 'G_CGS', 'G_PER_KG', 'G_PER_G', 'LOOKUP'] + _LAZY_NAMES)
+
+################################################################################
+# Command-line interface
+#
+# Usage:
+#   python -m gravity convert BODY SOURCE TARGET INPUT OUTPUT [--body-gm GM]
+#                             [--chunk-size N] [--workers N]
+#                             [--format {npy,csv}]
+#   python -m gravity solve BODY [FREQ ...] [--input FILE] [--factors J K L]
+#                           [--e E] [--sin-i S] [--deg-per-day]
+#                           [--output FILE] [--format {npy,csv}]
+#   python -m gravity catalog BODY (--n N ... | --a A ...) [--m M ...]
+#                             [--m-max M] [--p P ...] [--kinds KIND ...]
+#                             [--deg-per-day] [--output FILE]
+#                             [--format {npy,csv}]
+#
+# SOURCE and TARGET are kinds from ORBIT_KINDS. Files ending in .npy are
+# memory-mapped; any other file is CSV with six values per line.
+################################################################################
+
+# Conversion methods applied in turn to convert between each pair of kinds
+_CLI_STEPS = {('osc',   'state'): ('state_from_osc',),
+              ('geom',  'state'): ('state_from_geom',),
+              ('state', 'osc'):   ('osc_from_state',),
+              ('state', 'geom'):  ('geom_from_state',),
+              ('osc',   'geom'):  ('state_from_osc', 'geom_from_state'),
+              ('geom',  'osc'):   ('state_from_geom', 'osc_from_state')}
+
+# Number of chunks per worker read from a file at a time
+_CLI_CHUNKS_PER_WORKER = 4
+
+def _cli_format(filename, format):
+    """The format of a file, npy or csv, from the option or the extension."""
+
+    if format:
+        return format
+
+    return 'npy' if filename.endswith('.npy') else 'csv'
+
+def _cli_read_blocks(filename, rows):
+    """Generator of (shape, blocks) for a file of six columns: the shape of the
+    whole array, then arrays of up to the given number of rows."""
+
+    if _cli_format(filename, None) == 'npy':
+        array = np.load(filename, mmap_mode='r')
+        if array.shape[-1:] != (6,):
+            raise ValueError('input array must have six columns')
+
+        yield array.shape
+        array = array.reshape(-1, 6)
+        for start in range(0, array.shape[0], rows):
+            yield np.asfarray(array[start:start + rows])
+        return
+
+    # A first pass counts the rows; the second reads them a block at a time
+    with open(filename) as f:
+        count = sum(1 for line in f if line.strip()
+                                    and not line.lstrip().startswith('#'))
+    yield (count, 6)
+
+    with open(filename) as f:
+        lines = (line for line in f if line.strip()
+                                    and not line.lstrip().startswith('#'))
+        while True:
+            block = list(itertools.islice(lines, rows))
+            if not block:
+                break
+            block = np.loadtxt(block, delimiter=',', ndmin=2)
+            if block.shape[1] != 6:
+                raise ValueError('input rows must have six values')
+            yield block
+
+def _cli_convert(args):
+
+    steps = _CLI_STEPS.get((args.source, args.target))
+    if steps is None:
+        raise ValueError('no conversion from %s to %s' % (args.source,
+                                                          args.target))
+
+    gravity = LOOKUP[args.body]
+    rows = args.chunk_size * args.workers * _CLI_CHUNKS_PER_WORKER
+    blocks = _cli_read_blocks(args.input, rows)
+    shape = next(blocks)
+
+    if _cli_format(args.output, args.format) == 'npy':
+        output = np.lib.format.open_memmap(args.output, mode='w+',
+                                           dtype='float64', shape=shape)
+        f = None
+    else:
+        output = None
+        f = open(args.output, 'w')
+
+    try:
+        start = 0
+        failures = 0
+        for block in blocks:
+            for (k, conversion) in enumerate(steps):
+                # The workers write the last step straight into a .npy file
+                out = None
+                if f is None and k == len(steps) - 1:
+                    out = output.reshape(-1, 6)[start:start + len(block)]
+
+                (block, codes) = gravity.convert_parallel(conversion, block,
+                                        workers=args.workers,
+                                        chunk_size=args.chunk_size,
+                                        body_gm=args.body_gm, status=True,
+                                        out=out)
+                failures += np.sum(codes != STATUS_CONVERGED)
+            if f is not None:
+                np.savetxt(f, block, fmt='%.17g', delimiter=',')
+            start += len(block)
+    finally:
+        if f is None:
+            output.flush()
+            del output
+        else:
+            f.close()
+
+    # One warning for the whole file rather than one per block
+    if failures:
+        warnings.warn('geom_from_state() did not converge for ' +
+                      '%d of %d elements' % (failures, start))
+
+def _cli_write(args, array, header):
+    """Write a result to the output file in the chosen format, or as CSV to
+    standard output if there is no output file."""
+
+    if args.output is None:
+        if args.format == 'npy':
+            raise ValueError('npy output requires --output')
+        f = sys.stdout
+    elif _cli_format(args.output, args.format) == 'npy':
+        np.save(args.output, array)
+        return
+    else:
+        f = open(args.output, 'w')
+
+    try:
+        print(header, file=f)
+        if array.dtype.names:
+            for row in array:
+                print(','.join(str(value) if isinstance(value, str) else
+                               '%.17g' % value for value in row.tolist()),
+                      file=f)
+        else:
+            np.savetxt(f, array, fmt='%.17g', delimiter=',')
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+def _cli_solve(args):
+
+    gravity = LOOKUP[args.body]
+    freqs = list(args.freq)
+    if args.input:
+        if _cli_format(args.input, None) == 'npy':
+            freqs += list(np.load(args.input).ravel())
+        else:
+            freqs += list(np.loadtxt(args.input, delimiter=',', ndmin=1))
+
+    freqs = np.array(freqs, dtype='float')
+    scale = DPD if args.deg_per_day else 1.
+    a = gravity.solve_a(freqs / scale, tuple(args.factors), args.e,
+                        args.sin_i)
+    _cli_write(args, np.stack([freqs, a], axis=-1), '# freq,a')
+
+def _cli_catalog(args):
+
+    if (args.n is None) == (args.a is None):
+        raise ValueError('exactly one of --n and --a must be given')
+
+    gravity = LOOKUP[args.body]
+    scale = DPD if args.deg_per_day else 1.
+    m = np.arange(1, args.m_max + 1) if args.m_max else args.m
+
+    if args.n is None:
+        catalog = gravity.resonance_catalog(a=args.a, m=m, p=args.p,
+                                            kinds=args.kinds)
+    else:
+        catalog = gravity.resonance_catalog(np.array(args.n) / scale, m=m,
+                                            p=args.p, kinds=args.kinds)
+
+    catalog['pattern'] *= scale
+    _cli_write(args, catalog, '# ' + ','.join(RESONANCE_DTYPE.names))
+
+def main(argv=None):
+    """Entry point for python -m gravity. Converts files of states or elements,
+    solves for the semimajor axes of frequencies, or writes resonance catalogs
+    for any body in LOOKUP."""
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m gravity',
+                                     description='Gravity field tools')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    convert = commands.add_parser('convert',
+                                  help='convert a file of states or elements')
+    convert.add_argument('body', help='name of the body in LOOKUP')
+    convert.add_argument('source', choices=ORBIT_KINDS,
+                         help='kind of the input rows')
+    convert.add_argument('target', choices=ORBIT_KINDS,
+                         help='kind of the output rows')
+    convert.add_argument('input', help='.npy or CSV file of six columns')
+    convert.add_argument('output', help='.npy or CSV file to create')
+    convert.add_argument('--body-gm', type=float, default=0.,
+                         help='GM of the orbiting bodies')
+    convert.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                         help='rows converted per task')
+    convert.add_argument('--workers', type=int, default=1,
+                         help='number of worker processes')
+    convert.add_argument('--format', choices=('npy', 'csv'), default=None,
+                         help='output format; default from the extension')
+    convert.set_defaults(function=_cli_convert)
+
+    solve = commands.add_parser('solve',
+                                help='solve for the semimajor axes of '
+                                     'frequencies')
+    solve.add_argument('body', help='name of the body in LOOKUP')
+    solve.add_argument('freq', type=float, nargs='*',
+                       help='frequencies (radians/s)')
+    solve.add_argument('--input', default=None,
+                       help='.npy or CSV file of further frequencies')
+    solve.add_argument('--factors', type=int, nargs=3, default=[1,0,0],
+                       help='coefficients on omega, kappa and nu')
+    solve.add_argument('--e', type=float, default=0.,
+                       help='eccentricity')
+    solve.add_argument('--sin-i', type=float, default=0.,
+                       help='sine of the inclination')
+    solve.add_argument('--deg-per-day', action='store_true',
+                       help='frequencies in degrees per day')
+    solve.add_argument('--output', default=None,
+                       help='output file; default is standard output')
+    solve.add_argument('--format', choices=('npy', 'csv'), default=None,
+                       help='output format; default from the extension')
+    solve.set_defaults(function=_cli_solve)
+
+    catalog = commands.add_parser('catalog', help='write a resonance catalog')
+    catalog.add_argument('body', help='name of the body in LOOKUP')
+    catalog.add_argument('--n', type=float, nargs='+', default=None,
+                         help='mean motions of the perturbers (radians/s)')
+    catalog.add_argument('--a', type=float, nargs='+', default=None,
+                         help='semimajor axes of the perturbers (km)')
+    catalog.add_argument('--m', type=int, nargs='+', default=[1],
+                         help='values of m')
+    catalog.add_argument('--m-max', type=int, default=None,
+                         help='use every m from 1 to this value')
+    catalog.add_argument('--p', type=int, nargs='+', default=[1],
+                         help='values of p')
+    catalog.add_argument('--kinds', nargs='+', default=list(RESONANCE_KINDS),
+                         choices=RESONANCE_KINDS,
+                         help='resonance kinds to include')
+    catalog.add_argument('--deg-per-day', action='store_true',
+                         help='mean motions and pattern speeds in degrees '
+                              'per day')
+    catalog.add_argument('--output', default=None,
+                         help='output file; default is standard output')
+    catalog.add_argument('--format', choices=('npy', 'csv'), default=None,
+                         help='output format; default from the extension')
+    catalog.set_defaults(function=_cli_catalog)
+
+    args = parser.parse_args(argv)
+
+    body = args.body
+    args.body = body.upper()
+    if args.body not in LOOKUP:
+        parser.error('unknown body: ' + body)
+
+    if getattr(args, 'workers', 1) < 1 or getattr(args, 'chunk_size', 1) < 1:
+        parser.error('--workers and --chunk-size must be positive')
+
+    try:
+        args.function(args)
+    except (ValueError, IOError) as e:
+        parser.error(str(e))
 
 if __name__ == '__main__':
-    unittest.main()
+    main()
 
 ################################################################################
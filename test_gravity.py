@@ -0,0 +1,1304 @@
+################################################################################
+# test_gravity.py
+#
+# Unit tests for gravity.py.
+################################################################################
+
+from __future__ import print_function
+
+import numpy as np
+import unittest
+import warnings
+
+from gravity import *
+
+ERROR_TOLERANCE = 1.e-15
+
+class Test_Gravity(unittest.TestCase):
+
+    def test_uncombo(self):
+
+        # Testing scalars in a loop...
+        tests = 100
+        planets = [JUPITER, SATURN, URANUS, NEPTUNE]
+        factors = [(1, 0, 0), (0, 1, 0), (0, 0, 1)]
+
+        for test in range(tests):
+          for obj in planets:
+            for e in (0., 0.1):
+              for i in (0., 0.1):
+                a = obj.rp * 10. ** (np.random.rand() * 2.)
+                for f in factors:
+                    b = obj.solve_a(obj.combo(a,f,e,i), f, e, i)
+                    c = abs((b - a) / a)
+                    self.assertTrue(c < ERROR_TOLERANCE)
+
+        # PLUTO_CHARON with factors (1,0,0) and (0,0,1)
+        for test in range(tests):
+          for obj in [PLUTO_CHARON]:
+            for e in (0., 0.1):
+              for i in (0., 0.1):
+                a = obj.rp * 10. ** (np.random.rand() * 2.)
+                for f in [(1,0,0),(0,0,1)]:
+                    b = obj.solve_a(obj.combo(a,f,e,i), f, e, i)
+                    c = abs((b - a) / a)
+                    self.assertTrue(c < ERROR_TOLERANCE)
+
+        # PLUTO_CHARON with factors (0,1,0) can have duplicated values...
+        for test in range(tests):
+          for obj in [PLUTO_CHARON]:
+            a = obj.rp * 10. ** (np.random.rand() * 2.)
+            if obj.kappa2(a) < 0.: continue     # this would raise RuntimeError
+
+            for f in [(0,1,0)]:
+                combo1 = obj.combo(a,f)
+                b = obj.solve_a(combo1, f)
+                combo2 = obj.combo(b,f)
+                c = abs((combo2 - combo1) / combo1)
+                self.assertTrue(c < ERROR_TOLERANCE)
+
+        # Testing a 100x100 array
+        for obj in planets:
+          a = obj.rp * 10. ** (np.random.rand(100,100) * 2.)
+          for e in (0., 0.1):
+            for i in (0., 0.1):
+              for f in factors:
+                b = obj.solve_a(obj.combo(a,f,e,i), f, e, i)
+                c = abs((b - a) / a)
+                self.assertTrue(np.all(c < ERROR_TOLERANCE))
+
+        # Testing with first-order cancellation
+        factors = [(1, -1, 0), (1, 0, -1), (0, 1, -1)]
+        planets = [JUPITER, SATURN, URANUS, NEPTUNE]
+
+        for obj in planets:
+            a = obj.rp * 10. ** (np.random.rand(100,100) * 2.)
+            for f in factors:
+                b = obj.solve_a(obj.combo(a, f), f)
+                c = abs((b - a) / a)
+                self.assertTrue(np.all(c < ERROR_TOLERANCE))
+
+        # Testing with second-order cancellation
+        factors = [(2, -1, -1)]
+        planets = [JUPITER, SATURN, URANUS, NEPTUNE]
+
+        for obj in planets:
+            a = obj.rp * 10. ** (np.random.rand(100,100) * 2.)
+            for f in factors:
+                b = obj.solve_a(obj.combo(a, f), f)
+                c = abs((b - a) / a)
+                self.assertTrue(np.all(c < ERROR_TOLERANCE))
+
+    def test_solve_a_options(self):
+
+        a = SATURN.rp * 10. ** (np.random.rand(1000) * 2.)
+        for f in [(1,0,0), (1,-1,0), (2,-1,-1)]:
+            freq = SATURN.combo(a, f)
+            (b, counts) = SATURN.solve_a(freq, f, iters=True)
+            self.assertEqual(b.shape, a.shape)
+            self.assertEqual(counts.shape, a.shape)
+            self.assertTrue(np.all(counts >= 1))
+            self.assertTrue(np.all(counts <= 20))
+            self.assertTrue(np.all(np.abs((b - a) / a) < ERROR_TOLERANCE))
+
+            (c, counts2) = SATURN.solve_a(freq, f, tol=1.e-8, iters=True)
+            self.assertTrue(np.all(counts2 <= counts))
+            self.assertTrue(np.all(np.abs((c - a) / a) < 1.e-8))
+
+        # Scalar in, scalar out
+        (b, count) = SATURN.solve_a(SATURN.omega(100000.), iters=True)
+        self.assertEqual(np.shape(b), ())
+        self.assertEqual(np.shape(count), ())
+
+        # Array-valued e and sin(i). With second-order cancellation, the e and
+        # sin(i) terms dominate far from the planet, where the root is not
+        # unique; test that case within the rings.
+        e = np.random.rand(1000) * 0.01
+        sin_i = np.random.rand(1000) * 0.01
+        rings = SATURN.rp * (1.2 + 2. * np.random.rand(1000))
+        for (f, a) in [((1,0,0), a), ((1,-1,0), a), ((2,-1,-1), rings)]:
+            freq = SATURN.combo(a, f, e, sin_i)
+            b = SATURN.solve_a(freq, f, e, sin_i)
+            self.assertTrue(np.all(np.abs((b - a) / a) < 1.e-13))
+
+    def test_combo_e_sin_i(self):
+
+        a = SATURN.rp * (1.2 + np.random.rand(100))
+        e = np.random.rand(100) * 0.01
+        sin_i = np.random.rand(100) * 0.01
+
+        for f in [(1,0,0), (0,1,0), (0,0,1), (1,-1,0), (1,0,-1), (2,-1,-1)]:
+            values = SATURN.combo(a, f, e, sin_i)
+
+            # Same values element by element and with array factors
+            for k in range(0, 100, 10):
+                self.assertEqual(values[k],
+                                 SATURN.combo(a[k], f, e[k], sin_i[k]))
+
+            array_f = [np.broadcast_to(x, a.shape) for x in f]
+            self.assertTrue(np.allclose(SATURN.combo(a, array_f, e, sin_i),
+                                        values, rtol=1.e-13, atol=0.))
+
+            # Corrections match those of the individual frequencies
+            expected = (SATURN.combo(a, f) +
+                        f[0] * (SATURN.omega(a, e, sin_i) - SATURN.omega(a)) +
+                        f[1] * (SATURN.kappa(a, e, sin_i) - SATURN.kappa(a)) +
+                        f[2] * (SATURN.nu(a, e, sin_i) - SATURN.nu(a)))
+            self.assertTrue(np.allclose(values, expected, rtol=1.e-6,
+                                        atol=0.))
+
+    def test_array_factors(self):
+
+        a = SATURN.rp * 10. ** (np.random.rand(3,1000) * 2.)
+        factors = (np.array([[1],[1],[2]]), np.array([[-1],[0],[-1]]),
+                   np.array([[0],[-1],[-1]]))
+        combo = SATURN.combo(a, factors)
+        for k in range(3):
+            f = [int(x[k,0]) for x in factors]
+            c = np.abs(combo[k] / SATURN.combo(a[k], f) - 1.)
+            self.assertTrue(np.all(c < 1.e-13))
+
+        b = SATURN.solve_a(combo, factors)
+        self.assertTrue(np.all(np.abs((b - a) / a) < ERROR_TOLERANCE))
+
+    def test_resonance_catalog(self):
+
+        moons = np.array([185539., 238042., 294672.])
+        n = SATURN.omega(moons)
+        catalog = SATURN.resonance_catalog(n, m=np.arange(1,11), p=[0,1,2])
+        self.assertEqual(len(catalog), 6 * 3 * 10 * 3)
+
+        catalog2 = SATURN.resonance_catalog(a=moons, m=np.arange(1,11),
+                                            p=[0,1,2])
+        self.assertTrue(np.allclose(catalog['pattern'], catalog2['pattern'],
+                                    rtol=1.e-14, atol=0.))
+
+        for row in catalog:
+            (kind, k, m, p, pattern, a) = row
+            if kind == 'ILR':
+                self.assertEqual(pattern, SATURN.ilr_pattern(n[k], m, p))
+            if kind == 'OLR':
+                self.assertEqual(pattern, SATURN.olr_pattern(n[k], m, p))
+
+            if np.isnan(a): continue
+
+            (omega, kappa, nu) = SATURN.frequencies(a, derivatives=False)
+            arms = m if kind[0] == 'I' else m + p
+            sign = 1 if kind[0] == 'I' else -1
+            if kind[1] == 'L':
+                residual = arms * (omega - pattern) - sign * kappa
+            elif kind[1] == 'V':
+                residual = arms * (omega - pattern) - sign * nu
+            else:
+                residual = omega - pattern
+
+            self.assertTrue(abs(residual) < 1.e-12 * omega)
+
+        self.assertRaises(ValueError, SATURN.resonance_catalog)
+        self.assertRaises(ValueError, SATURN.resonance_catalog, n, m=0)
+        self.assertRaises(ValueError, SATURN.resonance_catalog, n,
+                          kinds=('XLR',))
+
+    def test_geom_from_state(self):
+
+        N = 1000
+        a = SATURN.rp * (1.2 + np.random.rand(N))
+        e = np.random.rand(N) * 0.01
+        inc = np.random.rand(N) * 0.01
+        mean_lon = np.random.rand(N) * TWOPI
+        long_peri = np.random.rand(N) * TWOPI
+        long_node = np.random.rand(N) * TWOPI
+
+        (pos, vel) = SATURN.state_from_geom((a, e, inc, mean_lon, long_peri,
+                                             long_node))
+        (elements, status) = SATURN.geom_from_state(pos, vel, status=True)
+        self.assertEqual(status.shape, (N,))
+        self.assertTrue(np.all(status == STATUS_CONVERGED))
+        self.assertTrue(np.all(np.abs(elements[0] - a) < 1.e-4))
+        self.assertTrue(np.all(np.abs(elements[1] - e) < 1.e-8))
+
+        dlon = (elements[3] - mean_lon + np.pi) % TWOPI - np.pi
+        self.assertTrue(np.all(np.abs(dlon) < 1.e-5))
+
+        # Scalar
+        (elements, status) = SATURN.geom_from_state(pos[0], vel[0],
+                                                    status=True)
+        self.assertEqual(np.shape(elements[0]), ())
+        self.assertEqual(np.shape(status), ())
+        self.assertTrue(abs(elements[0] - a[0]) < 1.e-4)
+
+        # Large e does not converge; one warning, or a status array
+        e = 0.1 + np.random.rand(N) * 0.2
+        (pos, vel) = SATURN.state_from_geom((a, e, inc, mean_lon, long_peri,
+                                             long_node))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            SATURN.geom_from_state(pos, vel, max_iters=20)
+        self.assertEqual(len(caught), 1)
+
+        (elements, status) = SATURN.geom_from_state(pos, vel, max_iters=20,
+                                                    status=True)
+        self.assertTrue(np.any(status != STATUS_CONVERGED))
+
+        # Single states are iterated on scalars, with the same outcome
+        for k in range(0, N, 50):
+            (test, code) = SATURN.geom_from_state(pos[k], vel[k], max_iters=20,
+                                                  status=True)
+            self.assertEqual(code, status[k])
+            for (value, expected) in zip(test, elements):
+                self.assertTrue(abs(value - expected[k]) <=
+                                1.e-12 * max(abs(expected[k]), 1.))
+
+    def test_output_buffers(self):
+
+        N = 100
+        a = SATURN.rp * (1.2 + np.random.rand(N))
+        e = np.random.rand(N) * 0.01
+        inc = np.random.rand(N) * 0.01
+        mean_lon = np.random.rand(N) * TWOPI
+        long_peri = np.random.rand(N) * TWOPI
+        long_node = np.random.rand(N) * TWOPI
+        elements = (a, e, inc, mean_lon, long_peri, long_node)
+
+        for method in (SATURN.state_from_osc, SATURN.state_from_geom):
+            (pos, vel) = method(elements)
+
+            buffer = np.zeros((N,6))
+            result = method(elements, out=(buffer[:,:3], buffer[:,3:]))
+            self.assertTrue(np.all(buffer[:,:3] == pos))
+            self.assertTrue(np.all(buffer[:,3:] == vel))
+            self.assertTrue(np.shares_memory(result[0], buffer))
+
+            self.assertRaises(ValueError, method, elements,
+                              out=(buffer[1:,:3], buffer[1:,3:]))
+
+        (pos, vel) = SATURN.state_from_geom(elements)
+        for method in (SATURN.osc_from_state, SATURN.geom_from_state):
+            expected = method(pos, vel)
+
+            buffer = np.zeros((N,6))
+            result = method(pos, vel, out=buffer)
+            for k in range(6):
+                self.assertTrue(np.all(buffer[:,k] == expected[k]))
+                self.assertTrue(np.shares_memory(result[k], buffer))
+
+            self.assertRaises(ValueError, method, pos, vel, out=buffer[:,:5])
+
+    def test_state_from_osc_high_e(self):
+
+        N = 1000
+        a = SATURN.rp * (1.2 + np.random.rand(N))
+        e = np.random.rand(N) * 0.99
+        inc = 0.01 + np.random.rand(N) * 0.04
+        mean_lon = np.random.rand(N) * TWOPI
+        long_peri = np.random.rand(N) * TWOPI
+        long_node = np.random.rand(N) * TWOPI
+
+        (pos, vel) = SATURN.state_from_osc((a, e, inc, mean_lon, long_peri,
+                                            long_node))
+        elements = SATURN.osc_from_state(pos, vel)
+        self.assertTrue(np.all(np.abs(elements[0] - a) < 1.e-6 * a))
+        self.assertTrue(np.all(np.abs(elements[1] - e) < 1.e-8))
+
+        dlon = (elements[3] - mean_lon + np.pi) % TWOPI - np.pi
+        self.assertTrue(np.all(np.abs(dlon) < 1.e-6))
+
+        # Kepler solver alone, up to e very close to 1
+        mean_anomaly = (np.random.rand(N) - 0.5) * TWOPI
+        e = 1. - 10.**(-8. * np.random.rand(N))
+        cape = Gravity._solve_kepler(mean_anomaly, e, 1.e-12, 20)
+        resid = cape - e * np.sin(cape) - mean_anomaly
+        self.assertTrue(np.all(np.abs(resid) < 1.e-12))
+
+    def test_state_from_osc_broadcast(self):
+
+        # Elements that only broadcast together, including a high e that needs
+        # refinement by state_from_osc()
+        a = SATURN.rp * np.array([[1.5], [2.]])
+        long_peri = np.array([[1.], [2.]])
+
+        for (method, e) in [(SATURN.state_from_osc,  [0., 0.1, 0.95]),
+                            (SATURN.state_from_geom, [0., 0.001, 0.01])]:
+            elements = (a, np.array(e), 0.01, 3., long_peri, 0.5)
+            full = tuple(np.broadcast_to(x, (2,3)) for x in elements)
+
+            (pos, vel, jac) = method(elements, jacobian=True)
+            self.assertEqual(pos.shape, (2,3,3))
+            self.assertEqual(jac.shape, (2,3,6,6))
+
+            expected = method(full, jacobian=True)
+            self.assertTrue(np.all(pos == expected[0]))
+            self.assertTrue(np.all(vel == expected[1]))
+            self.assertTrue(np.all(jac == expected[2]))
+
+    def test_convert_npy(self):
+
+        import os
+        import shutil
+        import tempfile
+
+        N = 1000
+        elements = np.empty((N,6))
+        elements[:,0] = SATURN.rp * (1.2 + np.random.rand(N))
+        elements[:,1] = np.random.rand(N) * 0.01
+        elements[:,2] = np.random.rand(N) * 0.01
+        elements[:,3:] = np.random.rand(N,3) * TWOPI
+
+        (pos, vel) = SATURN.state_from_osc(tuple(elements.T))
+        states = np.hstack((pos, vel))
+
+        # Generator, with chunks that do not divide the row count
+        results = np.empty((N,6))
+        for (start, result) in SATURN.convert_chunks('osc_from_state', states,
+                                                     chunk_size=300):
+            self.assertTrue(result.shape[0] in (300, 100))
+            results[start:start + result.shape[0]] = result
+
+        expected = SATURN.osc_from_state(pos, vel)
+        for k in range(6):
+            self.assertTrue(np.all(results[:,k] == expected[k]))
+
+        # Memory-mapped files
+        tempdir = tempfile.mkdtemp()
+        try:
+            input_file = os.path.join(tempdir, 'elements.npy')
+            output_file = os.path.join(tempdir, 'states.npy')
+            np.save(input_file, elements)
+
+            shape = SATURN.convert_npy('state_from_osc', input_file,
+                                       output_file, chunk_size=256)
+            self.assertEqual(shape, (N,6))
+
+            result = np.load(output_file)
+            self.assertTrue(np.all(result == states))
+        finally:
+            shutil.rmtree(tempdir)
+
+        # One warning for the whole conversion, or the status codes
+        (_, codes) = SATURN.geom_from_state(pos, vel, max_iters=1,
+                                            status=True)
+        self.assertTrue(np.any(codes != STATUS_CONVERGED))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            chunks = list(SATURN.convert_chunks('geom_from_state', states,
+                                                chunk_size=300, max_iters=1))
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(len(caught), 1)
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            results = list(SATURN.convert_chunks('geom_from_state', states,
+                                                 chunk_size=300, status=True,
+                                                 max_iters=1))
+        self.assertEqual(len(caught), 0)
+        test = np.concatenate([chunk[2] for chunk in results])
+        self.assertTrue(np.all(test == codes))
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            input_file = os.path.join(tempdir, 'states.npy')
+            output_file = os.path.join(tempdir, 'elements.npy')
+            np.save(input_file, states.reshape(10,100,6))
+
+            (shape, test) = SATURN.convert_npy('geom_from_state', input_file,
+                                               output_file, chunk_size=256,
+                                               status=True, max_iters=1)
+            self.assertEqual(test.shape, (10,100))
+            self.assertTrue(np.all(test.ravel() == codes))
+        finally:
+            shutil.rmtree(tempdir)
+
+        self.assertRaises(ValueError, list,
+                          SATURN.convert_chunks('osc_from_geom', states))
+        self.assertRaises(ValueError, list,
+                          SATURN.convert_chunks('osc_from_state', pos))
+
+    def test_convert_parallel(self):
+
+        import os
+        import shutil
+        import tempfile
+
+        N = 1000
+        elements = np.empty((N,6))
+        elements[:,0] = SATURN.rp * (1.2 + np.random.rand(N))
+        elements[:,1] = np.random.rand(N) * 0.01
+        elements[:,2] = np.random.rand(N) * 0.01
+        elements[:,3:] = np.random.rand(N,3) * TWOPI
+
+        (pos, vel) = SATURN.state_from_geom(tuple(elements.T))
+        states = np.hstack((pos, vel))
+
+        result = SATURN.convert_parallel('state_from_geom', elements,
+                                         workers=2, chunk_size=300)
+        self.assertTrue(np.all(result == states))
+
+        expected = np.column_stack(SATURN.geom_from_state(pos, vel))
+        result = SATURN.convert_parallel('geom_from_state',
+                                         states.reshape(10,100,6),
+                                         workers=2, chunk_size=300)
+        self.assertEqual(result.shape, (10,100,6))
+        self.assertTrue(np.all(result.reshape(N,6) == expected))
+
+        # Status codes are gathered from the workers, with one warning for the
+        # whole conversion
+        (_, codes) = SATURN.geom_from_state(pos, vel, max_iters=1,
+                                            status=True)
+        for workers in (1, 2):
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                SATURN.convert_parallel('geom_from_state', states,
+                                        workers=workers, chunk_size=300,
+                                        max_iters=1)
+            self.assertEqual(len(caught), 1)
+
+            (result, test) = SATURN.convert_parallel('geom_from_state',
+                                        states.reshape(10,100,6),
+                                        workers=workers, chunk_size=300,
+                                        status=True, max_iters=1)
+            self.assertEqual(test.shape, (10,100))
+            self.assertTrue(np.all(test.ravel() == codes))
+
+        # The input is streamed from a memory map and the result is written
+        # into the output, straight to its file if it is also a memory map
+        tempdir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tempdir, 'elements.npy')
+            np.save(source, elements.reshape(10,100,6))
+            array = np.load(source, mmap_mode='r')
+
+            filename = os.path.join(tempdir, 'states.npy')
+            output = np.lib.format.open_memmap(filename, mode='w+',
+                                               dtype='float64',
+                                               shape=(12,100,6))
+            result = SATURN.convert_parallel('state_from_geom', array,
+                                             workers=2, chunk_size=300,
+                                             out=output[2:])
+            output.flush()
+            del output, result
+
+            test = np.load(filename)
+            self.assertTrue(np.all(test[2:].reshape(N,6) == states))
+            self.assertTrue(np.all(test[:2] == 0.))
+
+            output = np.empty((10,100,6))
+            result = SATURN.convert_parallel('state_from_geom', array,
+                                             workers=2, chunk_size=300,
+                                             out=output)
+            self.assertIs(result, output)
+            self.assertTrue(np.all(output.reshape(N,6) == states))
+            del array
+        finally:
+            shutil.rmtree(tempdir)
+
+        self.assertRaises(ValueError, SATURN.convert_parallel,
+                          'state_from_geom', elements, out=np.empty((N,5)))
+
+    def test_threads(self):
+
+        a = SATURN.rp * (1.2 + np.random.rand(10,100))
+        e = np.random.rand(10,100) * 0.01
+        factors = (np.random.randint(-3, 4, (10,100)), -1, 0)
+
+        expected = (SATURN.omega(a), SATURN.dnu_da(a, 0.01),
+                    SATURN.frequencies(a, e), SATURN.combo(a, factors),
+                    SATURN.combo(a, (2,-1,-1)), SATURN.combo(a, (1,0,0), 0.01, 0.005))
+
+        set_threads(4, min_size=100)
+        try:
+            results = (SATURN.omega(a), SATURN.dnu_da(a, 0.01),
+                       SATURN.frequencies(a, e), SATURN.combo(a, factors),
+                       SATURN.combo(a, (2,-1,-1)),
+                       SATURN.combo(a, (1,0,0), 0.01, 0.005))
+        finally:
+            set_threads(1)
+
+        self.assertTrue(np.all(results[0] == expected[0]))
+        self.assertTrue(np.all(results[1] == expected[1]))
+        for k in range(6):
+            self.assertTrue(np.all(results[2][k] == expected[2][k]))
+        self.assertTrue(np.all(results[3] == expected[3]))
+        self.assertTrue(np.all(results[4] == expected[4]))
+        self.assertTrue(np.all(results[5] == expected[5]))
+
+        # Factors given as a list are divided like a tuple
+        import gravity
+        calls = []
+        run_chunk = gravity._run_chunk
+        def counted(*args):
+            calls.append(args)
+            return run_chunk(*args)
+
+        gravity._run_chunk = counted
+        set_threads(4, min_size=100)
+        try:
+            results = (SATURN.combo(a, [factors[0], -1, 0]),
+                       SATURN.dcombo_da(a, factors=[2,-1,-1]))
+        finally:
+            set_threads(1)
+            gravity._run_chunk = run_chunk
+
+        self.assertEqual(len(calls), 8)
+        self.assertTrue(np.all(results[0] == expected[3]))
+        self.assertTrue(np.all(results[1] == SATURN.dcombo_da(a, (2,-1,-1))))
+
+        self.assertRaises(ValueError, set_threads, 0)
+
+    def test_immutable(self):
+
+        import pickle
+
+        self.assertRaises(AttributeError, setattr, SATURN, 'gm', 1.)
+        self.assertRaises(AttributeError, setattr, SATURN, 'extra', 1.)
+        self.assertRaises(ValueError, SATURN.omega_jn.__setitem__, 0, 1.)
+
+        copy = Gravity(SATURN.gm, list(SATURN.jn), SATURN.rp)
+        self.assertEqual(copy, SATURN)
+        self.assertEqual(hash(copy), hash(SATURN))
+        self.assertEqual(len(set([copy, SATURN, JUPITER])), 2)
+
+        self.assertEqual(pickle.loads(pickle.dumps(SATURN)), SATURN)
+
+        altered = SATURN.with_jn(SATURN.jn[:2])
+        self.assertEqual(altered.jn, SATURN.jn[:2])
+        self.assertEqual(altered.gm, SATURN.gm)
+        self.assertNotEqual(altered, SATURN)
+
+        altered = SATURN.with_gm(2. * SATURN.gm)
+        self.assertAlmostEqual(altered.omega(1.e5)/SATURN.omega(1.e5),
+                               np.sqrt(2.), places=14)
+
+    def test_benchmarks(self):
+
+        import bench_gravity
+
+        results = bench_gravity.run_benchmarks(sizes=(1, 10),
+                                               bodies=('SATURN', 'MOON'),
+                                               only='combo', repeat=1,
+                                               min_time=0.)
+        names = [b[0] for b in bench_gravity.BENCHMARKS if 'combo' in b[0]]
+        self.assertEqual(len(results), len(names) * 4)
+        self.assertTrue(all(r['seconds'] > 0. for r in results))
+
+    def test_diagnostics(self):
+
+        a = SATURN.rp * (1.2 + np.random.rand(100))
+        freq = SATURN.combo(a, (2,-1,-1))
+
+        diagnostics = SolverDiagnostics()
+        (result, counts) = SATURN.solve_a(freq, (2,-1,-1), iters=True,
+                                          diagnostics=diagnostics)
+        self.assertEqual(diagnostics.solver, 'solve_a')
+        self.assertEqual(diagnostics.size, 100)
+        self.assertTrue(np.all(diagnostics.iterations == counts))
+        self.assertEqual(diagnostics.unconverged, 0)
+        self.assertTrue(np.all(diagnostics.residuals <= 1.e-12 * result))
+
+        summary = diagnostics.summary()
+        self.assertEqual(summary['max_iterations'], np.max(counts))
+        self.assertEqual(set(summary['phases']),
+                         set(['setup', 'iterate', 'finish']))
+        self.assertTrue(summary['seconds'] >= 0.)
+
+        # Hooks receive a new object for each call
+        calls = []
+        add_diagnostics_hook(calls.append)
+        try:
+            e = 0.1 + np.random.rand(100) * 0.2
+            (pos, vel) = SATURN.state_from_geom((a, e, 0., 0., 0., 0.))
+            (elements, status) = SATURN.geom_from_state(pos, vel, max_iters=20,
+                                                        status=True)
+            SATURN.solve_a(freq[0], (2,-1,-1))
+        finally:
+            remove_diagnostics_hook(calls.append)
+
+        SATURN.solve_a(freq, (2,-1,-1))
+        self.assertEqual([d.solver for d in calls],
+                         ['geom_from_state', 'solve_a'])
+        self.assertTrue(np.all(calls[0].status == status))
+        self.assertEqual(calls[0].unconverged,
+                         np.sum(status != STATUS_CONVERGED))
+        self.assertTrue(np.all(calls[0].iterations <= 20))
+        self.assertEqual(calls[0].size, 100)
+        self.assertTrue(calls[0].phases['setup'] > 0.)
+        self.assertEqual(calls[1].size, 1)
+
+    def test_warm_start(self):
+
+        a = SATURN.rp * 10. ** (np.random.rand(1000) * 2.)
+        for f in [(1,0,0), (1,-1,0), (2,-1,-1), (3,-2,0)]:
+            freq = SATURN.combo(a, f)
+            (b, counts) = SATURN.solve_a(freq, f, iters=True)
+            (c, counts2) = SATURN.solve_a(freq, f, iters=True,
+                                          warm_start=True)
+            self.assertTrue(np.all(np.abs((c - a) / a) < 1.e-14))
+            self.assertTrue(np.mean(counts2) < np.mean(counts))
+
+        # The table is cached
+        table = SATURN._inverse_table((1,-1,0))
+        self.assertTrue(SATURN._inverse_table((1.,-1.,0.)) is table)
+
+        # Outside the table, the usual guess is used
+        freq = SATURN.omega(SATURN.rp * np.array([0.5, 2., 2.e4]))
+        b = SATURN.solve_a(freq, warm_start=True)
+        self.assertTrue(np.allclose(SATURN.omega(b), freq, rtol=1.e-14))
+
+        # Without J-terms there is no table for a cancelled combination
+        self.assertTrue(MOON._inverse_table((1,-1,0)) is None)
+        self.assertEqual(MOON.solve_a(MOON.omega(3000.), warm_start=True),
+                         MOON.solve_a(MOON.omega(3000.)))
+
+    def test_ensemble(self):
+
+        # Perturbed J-values for Saturn, compared model by model with Gravity
+        rng = np.random.default_rng(17)
+        jn = np.array(SATURN.jn) * (1. + 1.e-3 * rng.standard_normal((20,4)))
+        ensemble = GravityEnsemble(SATURN.gm, jn, SATURN.rp)
+        self.assertEqual(len(ensemble), 20)
+
+        a = SATURN.rp * (1.2 + 2. * rng.random(100))
+        for factors in [(1,0,0), (1,-1,0), (3,-2,0), (2,-1,-1)]:
+            freqs = ensemble.combo(a, factors, e=0.01, sin_i=0.02)
+            derivs = ensemble.dcombo_da(a, factors, e=0.01, sin_i=0.02)
+            self.assertEqual(freqs.shape, (20,100))
+
+            for k in (0, 7, 19):
+                gravity = ensemble[k]
+                test = gravity.combo(a, factors, e=0.01, sin_i=0.02)
+                self.assertTrue(np.all(np.abs(freqs[k] / test - 1.) < 1.e-13))
+
+                test = gravity.dcombo_da(a, factors, e=0.01, sin_i=0.02)
+                self.assertTrue(np.all(np.abs(derivs[k] / test - 1.) < 1.e-9))
+
+        # Each model solved at its own frequencies recovers the radii
+        freqs = ensemble.combo(a, (1,-1,0))
+        (test, counts) = ensemble.solve_a(freqs, (1,-1,0), iters=True)
+        self.assertTrue(np.all(np.abs(test / a - 1.) < 1.e-14))
+        self.assertTrue(np.all(counts <= 20))
+
+        # A shared frequency gives one radius per model
+        test = ensemble.solve_a(SATURN.omega(2. * SATURN.rp))
+        self.assertEqual(test.shape, (20,1))
+
+        # Bodies with different numbers of J-values
+        ensemble = GravityEnsemble.from_bodies([SATURN, MOON, URANUS])
+        test = ensemble.omega(1.e5)
+        for (k, body) in enumerate([SATURN, MOON, URANUS]):
+            self.assertEqual(test[k,0], body.omega(1.e5))
+
+    def test_uncertainty_bands(self):
+
+        # Reference percentiles from a full set of samples
+        sigmas = np.array((1.e-6 * SATURN.gm,) + SATURN.jn) * 1.e-3
+        a = SATURN.rp * np.linspace(1.3, 2.3, 20)
+        rng = np.random.default_rng(18)
+        params = (np.array((SATURN.gm,) + SATURN.jn) +
+                  np.abs(sigmas) * rng.standard_normal((100000,5)))
+        ensemble = GravityEnsemble(params[:,0], params[:,1:], SATURN.rp)
+        values = ensemble.combo(a, (1,-1,0))
+        test = np.percentile(values, (2.5, 50., 97.5), axis=0)
+        spread = test[2] - test[0]
+
+        # Batches smaller than the sample count exercise the streaming sums
+        bands = uncertainty_bands(SATURN, sigmas**2, 'combo', a, ((1,-1,0),),
+                                  samples=10000, batch=3000)
+        self.assertEqual(bands.bands.shape, (3,20))
+        self.assertTrue(np.all(bands.valid == 10000))
+        self.assertTrue(np.all(np.abs(bands.bands - test) < 0.01 * spread))
+        self.assertTrue(np.all(np.abs(bands.mean - values.mean(axis=0))
+                               < 0.01 * spread))
+        self.assertTrue(np.all(np.abs(bands.std / values.std(axis=0) - 1.)
+                               < 0.01))
+
+        # The histogram ranges come from a pilot of at least 256 samples, so
+        # tiny batches give the same bands
+        bands = uncertainty_bands(SATURN, sigmas**2, 'combo', a, ((1,-1,0),),
+                                  samples=400, batch=256)
+        tiny = uncertainty_bands(SATURN, sigmas**2, 'combo', a, ((1,-1,0),),
+                                 samples=400, batch=1)
+        self.assertTrue(np.all(tiny.bands == bands.bands))
+        self.assertTrue(np.all(np.abs(tiny.bands - test) < 0.05 * spread))
+
+        # Resonance radii, near the planet and far away
+        freq = SATURN.combo(1.8 * SATURN.rp, (2,-1,0))
+        bands = uncertainty_bands(SATURN, sigmas**2, 'solve_a', [freq, 1.e-9],
+                                  ((2,-1,0),), samples=1000, sampling='random',
+                                  seed=1)
+        self.assertEqual(list(bands.valid), [1000, 1000])
+        self.assertTrue(np.all(np.diff(bands.bands, axis=0) > 0.))
+
+        # Without J-values there is no apsidal precession, so every sample is
+        # excluded
+        bands = uncertainty_bands(MOON, [MOON.gm * 1.e-6], 'solve_a', 1.e-5,
+                                  ((1,-1,0),), samples=100)
+        self.assertEqual(bands.valid, 0)
+        self.assertTrue(np.all(np.isnan(bands.bands)))
+
+        self.assertRaises(ValueError, uncertainty_bands, SATURN, np.eye(3),
+                          'combo', a)
+
+    def test_ephemeris(self):
+
+        rng = np.random.default_rng(19)
+        elements = (SATURN.rp * (1.5 + rng.random(50)), 0.01 * rng.random(50),
+                    0.005 * rng.random(50), TWOPI * rng.random(50),
+                    TWOPI * rng.random(50), TWOPI * rng.random(50))
+        times = np.linspace(0., 1.e6, 40)
+
+        for (kind, method) in [('geom', SATURN.state_from_geom),
+                               ('osc',  SATURN.state_from_osc)]:
+            pos = np.empty((40,50,3))
+            vel = np.empty((40,50,3))
+            starts = [chunk[0] for chunk in
+                      SATURN.ephemeris(elements, times, kind, epoch=2.e5,
+                                       chunk_size=300, out=(pos, vel))]
+            self.assertEqual(starts, list(range(0, 40, 6)))
+
+            # Compare with elements advanced by hand
+            (a, e, inc, mean_lon, long_peri, long_node) = elements
+            sin_i = np.sin(inc)
+            for k in (0, 17, 39):
+                dt = times[k] - 2.e5
+                test = method((a, e, inc,
+                               mean_lon + SATURN.n(a, e, sin_i) * dt,
+                               long_peri + SATURN.dperi_dt(a, e, sin_i) * dt,
+                               long_node + SATURN.dnode_dt(a, e, sin_i) * dt))
+                self.assertTrue(np.all(np.abs(pos[k] - test[0]) < 1.e-6))
+                self.assertTrue(np.all(np.abs(vel[k] - test[1]) < 1.e-12))
+
+        # The rates include the GM of the orbiting body
+        body_gm = 1.e-4 * SATURN.gm
+        heavy = SATURN.with_gm(SATURN.gm + body_gm)
+        (start, pos, vel) = list(SATURN.ephemeris(elements, times[-1:],
+                                                  body_gm=body_gm))[0]
+        dt = times[-1]
+        test = SATURN.state_from_geom((a, e, inc,
+                               mean_lon + heavy.n(a, e, sin_i) * dt,
+                               long_peri + heavy.dperi_dt(a, e, sin_i) * dt,
+                               long_node + heavy.dnode_dt(a, e, sin_i) * dt),
+                                      body_gm)
+        self.assertTrue(np.all(np.abs(pos[0] - test[0]) < 1.e-6))
+
+        # Scalar elements give one particle per time
+        chunks = list(SATURN.ephemeris((2. * SATURN.rp, 0., 0., 0., 0., 0.),
+                                       [0., 1.]))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0][1].shape, (2,3))
+
+        self.assertRaises(ValueError, list,
+                          SATURN.ephemeris(elements, times, 'mean'))
+
+    def test_single_precision(self):
+
+        rng = np.random.default_rng(20)
+        a = SATURN.rp * (1.05 + 10. * rng.random(10000))
+        e = 0.05 * rng.random(10000)
+        sin_i = 0.05 * rng.random(10000)
+        single = SinglePrecision(SATURN)
+
+        # Results are float32 and within their error bounds
+        for (ee, ss, circular) in ((0., 0., True), (e, sin_i, False)):
+            for name in ('omega', 'kappa', 'nu'):
+                (value, bound) = getattr(single, name)(a, ee, ss, error=True)
+                self.assertEqual(value.dtype, np.float32)
+                test = getattr(SATURN, name)(a, ee, ss)
+                self.assertTrue(np.all(np.abs(value - test) <= bound))
+                self.assertTrue(np.all(bound < 2.e-6 * test))
+
+            for factors in [(1,0,0), (1,-1,0), (1,0,-1), (2,-1,-1), (3,-2,0)]:
+                (value, bound) = single.combo(a, factors, ee, ss, error=True)
+                test = SATURN.combo(a, factors, ee, ss)
+                self.assertTrue(np.all(np.abs(value - test) <= bound))
+                if circular:
+                    self.assertTrue(np.all(bound < 1.e-5 * np.abs(test)))
+
+                (value, bound) = single.dcombo_da(a, factors, ee, ss, error=True)
+                test = SATURN.dcombo_da(a, factors, ee, ss)
+                self.assertTrue(np.all(np.abs(value - test) <= bound))
+
+        # Bounds hold where the J-series cancel, near the zero of kappa and at
+        # its maximum for PLUTO_CHARON
+        pluto = SinglePrecision(PLUTO_CHARON)
+        near = PLUTO_CHARON.rp * np.concatenate([np.linspace(1.08, 1.10, 1001),
+                                                 np.linspace(1.28, 1.30, 1001)])
+        with np.errstate(invalid='ignore'):
+            (value, bound) = pluto.kappa(near, error=True)
+            test = PLUTO_CHARON.kappa(near)
+            valid = np.isfinite(test)
+            self.assertTrue(np.all(np.abs(value - test)[valid] <= bound[valid]))
+
+            for factors in [(0,1,0), (1,-1,0), (2,-1,-1)]:
+                for method in ('combo', 'dcombo_da'):
+                    (value, bound) = getattr(pluto, method)(near, factors,
+                                                            error=True)
+                    test = getattr(PLUTO_CHARON, method)(near, factors)
+                    valid = np.isfinite(test)
+                    self.assertTrue(np.all(np.abs(value - test)[valid]
+                                           <= bound[valid]))
+
+        # State vectors, including high eccentricities
+        elements = (a, 0.99 * rng.random(10000), rng.random(10000),
+                    100. * rng.random(10000), TWOPI * rng.random(10000),
+                    TWOPI * rng.random(10000))
+        (pos, vel, pos_error, vel_error) = single.state_from_osc(elements,
+                                                                 error=True)
+        self.assertEqual(pos.dtype, np.float32)
+        (test_pos, test_vel) = SATURN.state_from_osc(elements)
+        self.assertTrue(np.all(np.abs(pos - test_pos) <= pos_error[...,None]))
+        self.assertTrue(np.all(np.abs(vel - test_vel) <= vel_error[...,None]))
+
+        elements = (a, 0.01 * rng.random(10000), 0.01 * rng.random(10000),
+                    100. * rng.random(10000), TWOPI * rng.random(10000),
+                    TWOPI * rng.random(10000))
+        (pos, vel, pos_error, vel_error) = single.state_from_geom(elements,
+                                                                  error=True)
+        (test_pos, test_vel) = SATURN.state_from_geom(elements)
+        self.assertTrue(np.all(np.abs(pos - test_pos) <= pos_error[...,None]))
+        self.assertTrue(np.all(np.abs(vel - test_vel) <= vel_error[...,None]))
+
+        # Elements from float32 states
+        for (method, test_method) in [(single.osc_from_state,
+                                       SATURN.osc_from_state),
+                                      (single.geom_from_state,
+                                       SATURN.geom_from_state)]:
+            (values, errors) = method(pos, vel, error=True)
+            tests = test_method(pos.astype('float64'), vel.astype('float64'))
+            for (value, bound, test) in zip(values, errors, tests):
+                self.assertEqual(value.dtype, np.float32)
+                self.assertTrue(np.all(np.abs(value - test) <= bound))
+
+    def test_jacobian(self):
+
+        rng = np.random.default_rng(21)
+        for (method, emax) in [(SATURN.state_from_osc,  0.9),
+                               (SATURN.state_from_geom, 0.02)]:
+            elements = np.array([SATURN.rp * (1.5 + rng.random(100)),
+                                 emax * rng.random(100),
+                                 0.02 * rng.random(100),
+                                 TWOPI * rng.random(100),
+                                 TWOPI * rng.random(100),
+                                 TWOPI * rng.random(100)])
+
+            (pos, vel, jac) = method(tuple(elements), jacobian=True)
+            self.assertEqual(jac.shape, (100,6,6))
+
+            # The state itself is unchanged
+            test = method(tuple(elements))
+            self.assertTrue(np.all(pos == test[0]))
+            self.assertTrue(np.all(vel == test[1]))
+
+            # Compare with Richardson-extrapolated central differences
+            def difference(k, step):
+                plus = elements.copy()
+                plus[k] += step
+                minus = elements.copy()
+                minus[k] -= step
+                return (np.concatenate(method(tuple(plus)), axis=-1) -
+                        np.concatenate(method(tuple(minus)), axis=-1)) \
+                        / (2. * step[:,np.newaxis])
+
+            for k in range(6):
+                step = np.full(100, 1.e-3)
+                if k == 0:
+                    step = 1.e-5 * elements[0]
+
+                test = (4. * difference(k, step/2.) - difference(k, step)) / 3.
+                scale = np.abs(test).max(axis=1)[:,np.newaxis]
+                self.assertTrue(np.all(np.abs(jac[...,k] - test)
+                                       < 1.e-6 * scale))
+
+        # A preallocated Jacobian
+        jac = np.empty((6,6))
+        result = SATURN.state_from_geom((1.e5, 0., 0., 0., 0., 0.),
+                                        out=(np.empty(3), np.empty(3), jac),
+                                        jacobian=True)
+        self.assertIs(result[2], jac)
+
+    def test_fit_geom(self):
+
+        rng = np.random.default_rng(22)
+        (T, K) = (50, 40)
+        truth = np.column_stack([SATURN.rp * (1.3 + rng.random(T)),
+                                 0.01 * rng.random(T),
+                                 0.005 * rng.random(T),
+                                 TWOPI * rng.random(T),
+                                 TWOPI * rng.random(T),
+                                 TWOPI * rng.random(T)])
+        times = np.sort(rng.random((T,K)), axis=1) * 3 * 86400.
+
+        def angle_error(x, y):
+            return np.abs((x - y + np.pi) % TWOPI - np.pi)
+
+        # Noise-free positions recover the elements
+        (pos, _) = SATURN._fit_model(truth, times, 0.)
+        pos = pos.reshape(T,K,3)
+        diagnostics = SolverDiagnostics()
+        (fit, codes) = SATURN.fit_geom(times, pos, status=True,
+                                       diagnostics=diagnostics)
+        self.assertEqual(fit.shape, (T,6))
+        self.assertTrue(np.all(codes == STATUS_CONVERGED))
+        self.assertEqual(diagnostics.solver, 'fit_geom')
+        self.assertTrue(np.all(np.abs(fit[:,0] / truth[:,0] - 1.) < 1.e-10))
+        self.assertTrue(np.all(np.abs(fit[:,1] - truth[:,1]) < 1.e-8))
+        self.assertTrue(np.all(np.abs(fit[:,2] - truth[:,2]) < 1.e-8))
+        self.assertTrue(np.all(angle_error(fit[:,3], truth[:,3]) < 1.e-8))
+        self.assertTrue(np.all(angle_error(fit[:,4], truth[:,4]) * truth[:,1]
+                               < 1.e-8))
+        self.assertTrue(np.all(angle_error(fit[:,5], truth[:,5]) * truth[:,2]
+                               < 1.e-8))
+
+        # The rates include the GM of the orbiting bodies
+        body_gm = 1.e-4 * SATURN.gm
+        heavy = SATURN.with_gm(SATURN.gm + body_gm)
+        (a, e, inc) = [truth[:,k,np.newaxis] for k in range(3)]
+        sin_i = np.sin(inc)
+        elements = [np.broadcast_to(x, times.shape) for x in (a, e, inc)]
+        elements += [truth[:,3+k,np.newaxis] +
+                     heavy.combo(a, factors, e, sin_i) * times
+                     for (k, factors) in enumerate(((1,0,0), (1,-1,0),
+                                                    (1,0,-1)))]
+        (heavy_pos, _) = SATURN.state_from_geom(elements, body_gm)
+        fit = SATURN.fit_geom(times, heavy_pos, body_gm=body_gm)
+        self.assertTrue(np.all(np.abs(fit[:,0] / truth[:,0] - 1.) < 1.e-10))
+        fit = SATURN.fit_geom(times, heavy_pos)
+        self.assertFalse(np.all(np.abs(fit[:,0] / truth[:,0] - 1.) < 1.e-10))
+
+        # Zero-weighted observations are ignored
+        weights = np.ones((T,K))
+        weights[:,::5] = 0.
+        bad = pos.copy()
+        bad[:,::5] = 1.e9
+        test = SATURN.fit_geom(times, bad, weights=weights)
+        self.assertTrue(np.all(np.abs(test[:,0] / truth[:,0] - 1.) < 1.e-10))
+
+        # Fixed elements keep their initial values
+        guess = truth.copy()
+        guess[:,1] *= 1.01
+        test = SATURN.fit_geom(times, pos, guess=guess,
+                               free=(True,False,True,True,True,True))
+        self.assertTrue(np.all(test[:,1] == guess[:,1]))
+
+        # Radii at given longitudes recover a, e and the pericenter
+        truth[:,2] = 0.
+        longitudes = TWOPI * rng.random((T,K))
+        (radii, _) = SATURN._fit_model(truth, times, 0., longitudes)
+        radii = radii.reshape(T,K)
+        (fit, codes) = SATURN.fit_geom(times, radii=radii,
+                                       longitudes=longitudes, status=True)
+        self.assertTrue(np.all(codes == STATUS_CONVERGED))
+        self.assertTrue(np.all(np.abs(fit[:,0] / truth[:,0] - 1.) < 1.e-10))
+        self.assertTrue(np.all(np.abs(fit[:,1] - truth[:,1]) < 1.e-8))
+        self.assertTrue(np.all(angle_error(fit[:,4], truth[:,4]) * truth[:,1]
+                               < 1.e-8))
+
+        # Invalid inputs
+        self.assertRaises(ValueError, SATURN.fit_geom, times)
+        self.assertRaises(ValueError, SATURN.fit_geom, times, pos,
+                          radii=radii, longitudes=longitudes)
+        self.assertRaises(ValueError, SATURN.fit_geom, times, radii=radii)
+        self.assertRaises(ValueError, SATURN.fit_geom, times, pos[...,:2])
+
+    def test_orbit_array(self):
+
+        import os
+        import shutil
+        import tempfile
+
+        rng = np.random.default_rng(23)
+        elements = (SATURN.rp * (1.5 + rng.random(200)),
+                    0.01 * rng.random(200),
+                    0.005 * rng.random(200),
+                    TWOPI * rng.random(200),
+                    TWOPI * rng.random(200),
+                    TWOPI * rng.random(200))
+
+        for (kind, to_state, from_state) in [
+                ('osc',  SATURN.state_from_osc,  SATURN.osc_from_state),
+                ('geom', SATURN.state_from_geom, SATURN.geom_from_state)]:
+
+            orbits = OrbitArray.from_elements(elements, kind)
+            self.assertEqual(orbits.shape, (200,))
+            self.assertTrue(np.shares_memory(orbits.a, orbits.array))
+            self.assertTrue(np.all(orbits.long_node == elements[5]))
+
+            # Conversions match the tuple interface and return OrbitArrays
+            states = to_state(orbits)
+            self.assertEqual(states.kind, 'state')
+            (pos, vel) = to_state(elements)
+            self.assertTrue(np.all(states.pos == pos))
+            self.assertTrue(np.all(states.vel == vel))
+
+            result = from_state(states)
+            self.assertEqual(result.kind, kind)
+            test = from_state(pos, vel)
+            for k in range(6):
+                self.assertTrue(np.all(result.elements[k] == test[k]))
+
+            # Results are written into an OrbitArray given as out
+            out = OrbitArray.empty(200, 'state')
+            self.assertTrue(to_state(orbits, out=out) is out)
+            self.assertTrue(np.all(out.array == states.array))
+
+            # Slices are views
+            part = states[50:60]
+            self.assertTrue(np.shares_memory(part.array, states.array))
+            self.assertTrue(np.all(to_state(orbits[50:60]).array ==
+                                   part.array))
+
+        # The kinds are checked
+        self.assertRaises(ValueError, SATURN.state_from_geom,
+                          OrbitArray.from_elements(elements, 'osc'))
+        self.assertRaises(ValueError, SATURN.osc_from_state, states, vel)
+        self.assertRaises(ValueError, OrbitArray, np.zeros((4,5)), 'state')
+        self.assertRaises(ValueError, OrbitArray, np.zeros((4,6)), 'other')
+        self.assertRaises(AttributeError, getattr, states, 'a')
+        self.assertRaises(AttributeError, getattr, orbits, 'pos')
+
+        # Memory-mapped files
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'states.npy')
+            mapped = OrbitArray.create(filename, 200, 'state')
+            SATURN.state_from_geom(orbits, out=mapped)
+            del mapped
+
+            mapped = OrbitArray.load(filename, 'state')
+            self.assertTrue(isinstance(mapped.array, np.memmap))
+            self.assertTrue(np.all(mapped.array == states.array))
+            del mapped
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_frequency_cache(self):
+
+        a = SATURN.rp * np.linspace(1.5, 3., 100)
+        n = SATURN.omega(a)
+        expected = (SATURN.ilr_pattern(n, 3), SATURN.olr_pattern(n, 3, 2),
+                    SATURN.solve_a(n, (1,0,0)), SATURN.combo(a, (2,-1,0)))
+
+        cache = set_cache(4)
+        try:
+            for k in range(2):
+                results = (SATURN.ilr_pattern(n.copy(), 3),
+                           SATURN.olr_pattern(n, 3, 2),
+                           SATURN.solve_a(n, (1,0,0)),
+                           SATURN.combo(a, (2,-1,0)))
+                for (result, value) in zip(results, expected):
+                    self.assertTrue(np.all(result == value))
+
+            info = cache.info()
+            self.assertEqual((info['hits'], info['misses'], info['size']),
+                             (4, 4, 4))
+
+            # Results are copies, so callers cannot alter the cache
+            results[0][:] = 0.
+            self.assertTrue(np.all(SATURN.ilr_pattern(n, 3) == expected[0]))
+
+            # Different bodies, factors and contents are distinct entries
+            self.assertNotEqual(URANUS.ilr_pattern(n[:1], 3)[0], expected[0][0])
+            SATURN.combo(a, (2,-1,-1))
+            SATURN.combo(a + 1.e-6, (2,-1,0))
+            info = cache.info()
+            self.assertEqual(info['hits'], 5)
+            self.assertEqual(info['evictions'], 3)
+            self.assertEqual(len(cache), 4)
+
+            # Diagnostics are always filled in
+            diagnostics = SolverDiagnostics()
+            SATURN.solve_a(n, (1,0,0), diagnostics=diagnostics)
+            self.assertEqual(diagnostics.size, 100)
+
+            for k in range(5):
+                diagnostics = SolverDiagnostics()
+                SATURN.solve_a(n, (1,0,0), 0., 0., 0., False, diagnostics)
+                self.assertEqual(diagnostics.size, 100)
+
+            # Defaults and keywords give the same entry; arguments that cannot
+            # be fingerprinted by value are never cached
+            SATURN.solve_a(n)
+            info = cache.info()
+            SATURN.solve_a(n, (1,0,0), e=0.)
+            self.assertEqual(cache.info()['hits'], info['hits'] + 1)
+            SATURN.combo(a, (2,-1,0), e=np.array([0.], dtype='object'))
+            self.assertEqual(cache.info()['misses'], info['misses'])
+
+            # Invalidation
+            cache.clear(URANUS)
+            self.assertEqual(len(cache), 3)
+            cache.clear()
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(cache.info()['misses'], 0)
+        finally:
+            set_cache(0)
+
+        self.assertRaises(ValueError, set_cache, -1)
+
+    def test_command_line(self):
+
+        import gravity
+        import io
+        import os
+        import shutil
+        import sys
+        import tempfile
+
+        N = 1000
+        elements = np.empty((N,6))
+        elements[:,0] = SATURN.rp * (1.5 + np.random.rand(N))
+        elements[:,1] = np.random.rand(N) * 0.01
+        elements[:,2] = np.random.rand(N) * 0.005
+        elements[:,3:] = np.random.rand(N,3) * TWOPI
+        (pos, vel) = SATURN.state_from_osc(tuple(elements.T))
+        states = np.hstack((pos, vel))
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            paths = dict((name, os.path.join(tempdir, name)) for name in
+                         ('osc.npy', 'osc.csv', 'states.npy', 'states.csv',
+                          'geom.npy', 'catalog.npy'))
+            np.save(paths['osc.npy'], elements)
+            np.savetxt(paths['osc.csv'], elements, fmt='%.17g', delimiter=',')
+
+            # Conversions between .npy and CSV files, in chunks
+            gravity.main(['convert', 'saturn', 'osc', 'state',
+                          paths['osc.npy'], paths['states.npy'],
+                          '--chunk-size', '300'])
+            self.assertTrue(np.all(np.load(paths['states.npy']) == states))
+
+            gravity.main(['convert', 'SATURN', 'osc', 'state',
+                          paths['osc.csv'], paths['states.csv'],
+                          '--chunk-size', '300', '--workers', '2'])
+            self.assertTrue(np.all(np.loadtxt(paths['states.csv'],
+                                              delimiter=',') == states))
+
+            # Conversion between element kinds passes through the states
+            gravity.main(['convert', 'SATURN', 'osc', 'geom',
+                          paths['osc.npy'], paths['geom.npy']])
+            expected = SATURN.geom_from_state(pos, vel)
+            result = np.load(paths['geom.npy'])
+            for k in range(6):
+                self.assertTrue(np.all(result[:,k] == expected[k]))
+
+            # Resonance catalogs
+            gravity.main(['catalog', 'SATURN', '--a', '1221870.',
+                          '--m-max', '4', '--kinds', 'ILR', 'OLR',
+                          '--output', paths['catalog.npy']])
+            catalog = np.load(paths['catalog.npy'])
+            expected = SATURN.resonance_catalog(a=1221870., m=np.arange(1,5),
+                                                kinds=('ILR', 'OLR'))
+            self.assertTrue(np.all(catalog == expected))
+
+        finally:
+            shutil.rmtree(tempdir)
+
+        # Semimajor axes written to standard output
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            gravity.main(['solve', 'saturn', '1.e-4', '2.e-4'])
+            lines = sys.stdout.getvalue().split('\n')
+        finally:
+            sys.stdout = stdout
+
+        self.assertEqual(lines[0], '# freq,a')
+        a = SATURN.solve_a(np.array([1.e-4, 2.e-4]))
+        for k in range(2):
+            self.assertEqual(float(lines[k+1].split(',')[1]), a[k])
+
+        # Errors exit through argparse
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            self.assertRaises(SystemExit, gravity.main,
+                              ['solve', 'NOT_A_BODY', '1.e-4'])
+            self.assertRaises(SystemExit, gravity.main,
+                              ['convert', 'SATURN', 'osc', 'osc', 'x', 'y'])
+            self.assertRaises(SystemExit, gravity.main, ['catalog', 'SATURN'])
+        finally:
+            sys.stderr = stderr
+
+    def test_frequencies(self):
+
+        planets = [JUPITER, SATURN, URANUS, NEPTUNE, PLUTO_CHARON, MIMAS]
+        for obj in planets:
+          a = obj.rp * 10. ** (np.random.rand(100) * 2. + 0.2)
+          for e in (0., 0.1):
+            for i in (0., 0.1):
+              values = obj.frequencies(a, e, i)
+              self.assertEqual(len(values), 6)
+
+              expected = (obj.omega(a, e, i), obj.kappa(a, e, i),
+                          obj.nu(a, e, i), obj.domega_da(a, e, i),
+                          obj.dkappa_da(a, e, i), obj.dnu_da(a, e, i))
+              for (value, exp) in zip(values, expected):
+                  self.assertTrue(np.allclose(value, exp, rtol=1.e-14,
+                                              atol=0., equal_nan=True))
+
+              values = obj.frequencies(a, e, i, derivatives=False)
+              self.assertEqual(len(values), 3)
+              for (value, exp) in zip(values, expected[:3]):
+                  self.assertTrue(np.allclose(value, exp, rtol=1.e-14,
+                                              atol=0., equal_nan=True))
+
+        # Scalar input
+        (omega, kappa, nu) = SATURN.frequencies(100000., derivatives=False)
+        self.assertEqual(omega, SATURN.omega(100000.))
+        self.assertEqual(kappa, SATURN.kappa(100000.))
+        self.assertEqual(nu, SATURN.nu(100000.))
+
+    def test_frequency_table(self):
+
+        rel_error = 1.e-12
+        for obj in [JUPITER, SATURN, URANUS, NEPTUNE, MIMAS]:
+            table = FrequencyTable(obj, obj.rp, 100. * obj.rp, rel_error)
+            a = obj.rp * 10. ** (np.random.rand(1000) * 2.)
+
+            # Scalar lookup
+            self.assertTrue(abs(table.omega(2. * obj.rp) /
+                                obj.omega(2. * obj.rp) - 1.) < 1.e-14)
+
+            for e in (0., 0.1):
+              for i in (0., 0.1):
+                for (func, exp) in [(table.omega, obj.omega),
+                                    (table.kappa, obj.kappa),
+                                    (table.nu,    obj.nu)]:
+                    c = np.abs(func(a, e, i) / exp(a, e, i) - 1.)
+                    self.assertTrue(np.all(c < 1.e-14))
+
+                for f in [(1,0,0), (0,1,0), (0,0,1), (3,-1,0), (2,0,-1)]:
+                    c = np.abs(table.combo(a, f, e, i) /
+                               obj.combo(a, f, e, i) - 1.)
+                    self.assertTrue(np.all(c < 1.e-14))
+
+                    c = np.abs(table.dcombo_da(a, f, e, i) /
+                               obj.dcombo_da(a, f, e, i) - 1.)
+                    self.assertTrue(np.all(c < 1.e-8))
+
+            # First- and second-order cancellation
+            if not len(obj.jn): continue
+            for f in [(1,-1,0), (1,0,-1), (0,1,-1), (2,-1,-1)]:
+                c = np.abs(table.combo(a, f) / obj.combo(a, f) - 1.)
+                self.assertTrue(np.all(c < 4. * rel_error))
+
+                # Gravity.dcombo_da() loses precision here; use differences
+                da = a * 1.e-5
+                dcombo = (obj.combo(a + da, f) - obj.combo(a - da, f)) / (2*da)
+                c = np.abs(table.dcombo_da(a, f) / dcombo - 1.)
+                self.assertTrue(np.all(c < 1.e-7))
+
+        # Out of range
+        table = FrequencyTable(SATURN, 60330., 140000.)
+        self.assertRaises(ValueError, table.omega, 50000.)
+        self.assertRaises(ValueError, table.combo, [70000., 150000.], (1,0,0))
+
+        # Undefined frequencies inside the range, without a warning
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertRaises(ValueError, FrequencyTable, PLUTO_CHARON,
+                              0.5 * PLUTO_CHARON.rp, PLUTO_CHARON.rp)
+        self.assertEqual(len(caught), 0)
+
+if __name__ == '__main__':
+    unittest.main()
+
+################################################################################